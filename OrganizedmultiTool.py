@@ -11,22 +11,44 @@ except ImportError:
 import pickle
 import time
 import socket
+import sys
 import numpy as np
 import matplotlib.pyplot as plt
 from pylab import Line2D, gca
 from scipy.stats import describe
-from gurobipy import *
+try:
+    from gurobipy import *
+    from rollingHorizon import solveRollingHorizon
+    have_gurobi = True
+except ImportError:
+    have_gurobi = False
+    print("GUROBI is not available. Only the native solvers can be used")
 import math
 from itertools import product
 import pylab as pl
 from matplotlib import collections as mc
 import os
+from doseOperator import buildDoseMatrix, lowrankdose, penaltyTable
+from leafDecomposition import lagrangianDecomposition
+from fmoSolver import solveFMO, benchmarkAgainstGurobi
+from compactCase import hasCompactCase, readCompactCase
+from dijReaders import hasCompressedCase, streamCompressedCase, chunkedreader
+from caseCache import CASEARRAYS, caseKey, caseDirectory, storeCase, loadCase
+from resultStore import resultsDirectory, aperturesFromIntervals, writeRun
+from apertures import imrtApertures, pairApertures, fullApertures, apertureStatistics, aperturesAsLists
+from sinogramRaster import plotSinogramRaster
+from dvhEngine import dvhStructures, batchDVH
+from fullDose import fullResolutionRun
+from deliverySimulator import simulatePlan, doseGap, worstProjection
+from plotPipeline import renderRuns
+from caseServer import serverKey, serveCase, attachCase
 
 # User input goes here and only here
 tumorsite = "HelycalGyn"
 tumorsite = "Prostate"
 
 numcores = 12
+gurobiThreads = 0 # GUROBI Threads parameter. 0 lets GUROBI use every core
 initialProjections = 51
 numberOfLeaves = 64
 timeA = 0.077 #secs
@@ -41,9 +63,27 @@ do_subsample = True
 maxvoxels = 2000 # Never run less than 300. Only useful if do_subsample is True
 imrt = False
 imrtwith20msecondsconstraint = False      #Only active if imrt activated
+imrtSolver = 'gurobi' # 'lbfgsb' or 'fista' solve the IMRT model without GUROBI. Not with the 20 msec constraint
+lowRankError = 0.0 # If > 0 the native IMRT solver iterates on a low-rank dose operator with this relative error
+benchmarkFMO = False # Also solve the IMRT model with GUROBI and compare the objectives. Only if imrtSolver is not gurobi
 loadWarmStart = False
 relaxedProblem = False
 pairSolution = True
+leafwiseLagrangian = False # Solve the full model leaf by leaf through Lagrangian decomposition instead of GUROBI
+rollingHorizon = False # Solve the LOT model one window of projections at a time
+windowSize = 20 # Projections per window of the rolling horizon. Only useful if rollingHorizon is True
+windowOverlap = 4 # Projections shared by consecutive windows
+dijThreshold = 0.0 # Drop the Dij entries below this fraction of the largest entry of their voxel. 0.0 keeps everything
+dijThresholdPerBeamlet = False # Compare against the largest entry of the beamlet instead of the voxel
+dijRescale = False # Rescale the remaining entries of each voxel so that its total dose coefficient is preserved
+useCompactCase = False # Read the compact (quantized) version of the case written by compactCase.py if it has one. Tagged Compact
+ingestionThreads = 0 # If > 0 read the raw case files in parallel chunks with this many threads
+writeLegacyPickles = False # Also write the -z, -dataobject, calculateT and pickleresults pickles next to the results store
+rasterSinogram = False # Draw the sinograms as an image instead of a line per aperture. Much faster on large plans
+fullResolution = False # Also compute the dose and the DVHs of the stored plan on every voxel of the case
+parallelPlots = False # Draw the DVH, sinogram and histogram figures from the results store in worker processes
+simulateDelivery = '' # 'window' or 'gantry' simulates the delivery of the sinogram and reports its gap with z_output
+caseServer = '' # 'serve' publishes the preprocessed case in shared memory, 'attach' uses the one published by a server
 
 # If called externally
 executor = ''
@@ -74,6 +114,14 @@ if len(sys.argv) > 1:
     if len(sys.argv) > 9:
         maxvoxels = int(sys.argv[9])
         do_subsample = True
+    # Cores of this run, when several runs share the machine (sweepScheduler.py)
+    if len(sys.argv) > 10:
+        gurobiThreads = int(sys.argv[10])
+        numcores = max(1, gurobiThreads)
+    if len(sys.argv) > 11:
+        tumorsite = sys.argv[11]
+    if len(sys.argv) > 12:
+        caseServer = sys.argv[12]
 
 # Logical fixes:
 if imrtwith20msecondsconstraint and not imrt:
@@ -82,6 +130,22 @@ if imrt:
     loadWarmStart = False
     relaxedProblem = False
     pairSolution = False
+if leafwiseLagrangian or rollingHorizon:
+    imrt = False
+    imrtwith20msecondsconstraint = False
+    relaxedProblem = False
+if imrtwith20msecondsconstraint and 'gurobi' != imrtSolver:
+    print('The 20 msec constraint needs GUROBI. Ignoring imrtSolver', imrtSolver)
+    imrtSolver = 'gurobi'
+if leafwiseLagrangian:
+    loadWarmStart = False
+    pairSolution = False
+    rollingHorizon = False
+# Only the leaf-wise Lagrangian and the native IMRT solvers run without GUROBI. A case server does not solve anything
+if not have_gurobi and 'serve' != caseServer and not leafwiseLagrangian and not (imrt and 'gurobi' != imrtSolver):
+    print('GUROBI is not available and this model needs it. Set leafwiseLagrangian = True, or imrt with imrtSolver',
+          "'lbfgsb' or 'fista'")
+    sys.exit(1)
 print('Arguments are: timeM', timeM, 'timeA', timeA, 'maxvoxels', maxvoxels, 'effective?', str(do_subsample), 'imrt', str(imrt),
       'imrtwithConstraint', str(imrtwith20msecondsconstraint), 'relaxedProblem',
       str(relaxedProblem), 'pairSolution', str(pairSolution), 'warmStart', str(loadWarmStart))
@@ -111,6 +175,10 @@ def getvector(necfile,dtype):
             f.close()
     return(data)
 
+## Smallest unsigned integer type that can hold every index below n, and n itself
+def smallestIndexType(n):
+    return(np.min_scalar_type(n))
+
 def get_subsampled_mask(struct_img_mask_full_res, subsampling_img):
     sub_sampled_img_struct = np.zeros_like(struct_img_mask_full_res)
     sub_sampled_img_struct[np.where(subsampling_img)] =  struct_img_mask_full_res[np.where(subsampling_img)]
@@ -136,9 +204,40 @@ def get_sub_sub_sample(subsampling_img, numelems):
     sub_sub[sublocations] = 1
     return(sub_sub)
 
+## Property of tomodata for one of the large triplet arrays. After unpickling it is read back from the case cache the
+# first time it is used. Assigning it changes the case, so its key is forgotten.
+def caseArray(name):
+    def getter(self):
+        if getattr(self, '_' + name) is None:
+            self.reattachCase()
+        return(getattr(self, '_' + name))
+    def setter(self, value):
+        setattr(self, '_' + name, value)
+        self.caseKey = None
+    return(property(getter, setter))
+
 class tomodata:
+    # Tables derived from the triplets and the mask. They are built on demand and are not pickled
+    derivedTables = ('leafsD', 'projectionsD', 'bdata', 'quadHelperThresh', 'quadHelperUnder', 'quadHelperOver')
+    # Names of the run. They are built on demand from the settings of the run
+    runNames = ('treatmentName', 'chunkName', 'feasibleName', 'logFile')
+    __slots__ = ('base_dir', 'ProjectionsPerLoop', 'bixelsintween', 'yBar', 'maxvoxels', 'img_filename', 'header_filename',
+                 'struct_img_filename', 'struct_img_header', 'outputDirectory', 'roinames', 'L', 'voxelsBigSpace',
+                 'totalbeamlets', 'OARDict', 'TARGETDict', 'SUPPORTDict', 'AllDict', 'timeA', 'timeM', 'OARList',
+                 'OARThresholds', 'TARGETList', 'TARGETThresholds', 'ALLList', 'mask', 'voxels', 'smallToBig',
+                 'totalsmallvoxels', 'dijWorstCaseError', 'numProjections', 'penaltyTable', 'caseKey') + \
+                tuple('_' + name for name in derivedTables + runNames + CASEARRAYS)
+    # The triplets. They are not pickled but stored in the case cache
+    bixels = caseArray('bixels')
+    smallvoxels = caseArray('smallvoxels')
+    Dijs = caseArray('Dijs')
+
     ## Initialization of the data
     def __init__(self):
+        self.forgetDerived()
+        for name in tomodata.runNames + CASEARRAYS:
+            setattr(self, '_' + name, None)
+        self.caseKey = None
         print('hostname:', socket.gethostname())
         self.base_dir = 'data/dij/HelicalGyn/'
         #self.base_dir = 'data/dij153/HelicalGyn/'
@@ -167,6 +266,14 @@ class tomodata:
         self.roinames = {}
         # N Value: Number of beamlets in the gantry (overriden in Wilmer's Case)
         self.L = numberOfLeaves
+        # Start reading the binary files of the case before the headers are parsed
+        reader = None
+        if ingestionThreads > 0 and not self.readsCompactCase() and os.path.exists(self.base_dir + 'dij/Dijs_out.bin'):
+            reader = chunkedreader([('img', self.base_dir + self.img_filename, np.uint32),
+                                    ('struct', self.base_dir + self.struct_img_filename, np.uint32),
+                                    ('bixels', self.base_dir + 'dij/Bixels_out.bin', np.int32),
+                                    ('voxels', self.base_dir + 'dij/Voxels_out.bin', np.int32),
+                                    ('Dijs', self.base_dir + 'dij/Dijs_out.bin', np.float32)], ingestionThreads)
         self.get_dim(self.base_dir, 'samplemask.header')
         self.get_totalbeamlets(self.base_dir, 'dij/Size_out.txt')
         self.roimask_reader(self.base_dir, 'roimask.header')
@@ -174,7 +281,8 @@ class tomodata:
         self.timeM = timeM
         #self.argumentVariables()
         print('Read vectors...')
-        self.readWeiguosCase(  )
+        self.readWeiguosCase(reader)
+        self.mask = self.mask.astype(smallestIndexType(int(self.mask.max()) + 1))
         self.maskNamesGetter(self.base_dir + self.struct_img_header)
         print('done')
         # Create a space in smallvoxel coordinates
@@ -184,104 +292,204 @@ class tomodata:
         #Do the smallvoxels again:
         _, _, self.smallvoxels, _ = np.unique(self.smallvoxels, return_index=True, return_inverse=True, return_counts=True)
         print('Build sparse matrix.')
-        self.totalsmallvoxels = max(self.smallvoxels) + 1 #12648448
+        self.totalsmallvoxels = int(self.smallvoxels.max()) + 1 #12648448
+        self.smallvoxels = self.smallvoxels.astype(smallestIndexType(self.totalsmallvoxels))
+        # Only the big space voxel of each small voxel is kept from the voxels of the triplets
+        self.smallToBig = np.unique(self.voxels).astype(np.int32)
+        del self.voxels
         print('totalsmallvoxels:', self.totalsmallvoxels)
+        if dijThreshold > 0.0:
+            self.sparsifyDijs(dijThreshold, dijThresholdPerBeamlet, dijRescale)
         print('a brief description of Dijs array', describe(self.Dijs))
         #self.D = sps.csr_matrix((self.Dijs, (self.smallvoxels, self.bixels)), shape=(self.totalsmallvoxels, self.totalbeamlets))
-        self.quadHelperThresh = np.zeros(len(self.mask))
-        self.quadHelperUnder = np.zeros(len(self.mask))
-        self.quadHelperOver = np.zeros(len(self.mask))
         self.numProjections = self.getNumProjections()
         #######################################
-        projIni = 1 + np.floor(max(self.bixels / self.L)).astype(int)
+        projIni = 1 + int(self.bixels.max()) // self.L
         self.numProjections = k10 + projIni
-        self.leafsD = (self.bixels % self.L).astype(int)
-        self.projectionsD = np.floor(self.bixels / self.L).astype(int)
-        self.bdata = np.zeros((self.numProjections, self.L))
+        # Penalty weights of the targets and the OARs. The quadHelper arrays of the voxels are built from them on demand
         if "Prostate" == tumorsite:
-            for i in range(len(self.mask)):
-                # Constraint on TARGETS
-                T = None
-                if self.mask[i] in self.TARGETList:
-                    T = self.TARGETThresholds[np.where(self.mask[i] == self.TARGETList)[0][0]]
-                    self.quadHelperOver[i] = 15.5 #PROSTATE! FOR GYN SEE BELOW!
-                    self.quadHelperUnder[i] = 2.3 #PROSTATE! FOR GYN SEE BELOW!
-                # Constraint on OARs
-                elif self.mask[i] in self.OARList:
-                    T = self.OARThresholds[np.where(self.mask[i] == self.OARList)[0][0]]
-                    self.quadHelperOver[i] = 5E-3 #PROSTATE! FOR GYN SEE BELOW!
-                    self.quadHelperUnder[i] = 0.0 #PROSTATE! FOR GYN SEE BELOW!
-                    #if 7 == self.mask[i]: # RECTUM!!!
-                    #    self.quadHelperOver[i] = 50E-3  # PROSTATE! FOR GYN SEE BELOW!
-                    #    self.quadHelperUnder[i] = 0.0  # PROSTATE! FOR GYN SEE BELOW!
-                elif 0 == self.mask[i]:
-                    print('there is an element in the voxels that is also mask 0')
-                self.quadHelperThresh[i] = T
-                ########################
+            self.penaltyTable = self.penaltyTableCreator(15.5, 2.3, 5E-3, 0.0) #PROSTATE! FOR GYN SEE BELOW!
         elif "Lung"  == tumorsite:
             print('Lung Case parameters')
-            for i in range(len(self.mask)):
-                # Constraint on TARGETS
-                T = None
-                if self.mask[i] in self.TARGETList:
-                    T = self.TARGETThresholds[np.where(self.mask[i] == self.TARGETList)[0][0]]
-                    self.quadHelperOver[i] = 0.0001 #GYN! FOR PROSTATE SEE BELOW!
-                    self.quadHelperUnder[i] = 1E1 #GYN! FOR PROSTATE SEE BELOW!
-                # Constraint on OARs
-                elif self.mask[i] in self.OARList:
-                    T = self.OARThresholds[np.where(self.mask[i] == self.OARList)[0][0]]
-                    self.quadHelperOver[i] = 0.003 #GYN! FOR PROSTATE SEE BELOW!
-                    self.quadHelperUnder[i] = 0.0 #GYN! FOR PROSTATE SEE BELOW!
-                elif 0 == self.mask[i]:
-                    print('there is an element in the voxels that is also mask 0')
-                self.quadHelperThresh[i] = T
-                ########################
+            self.penaltyTable = self.penaltyTableCreator(0.0001, 1E1, 0.003, 0.0)
         else:
             print('Gyn Case parameters')
-            for i in range(len(self.mask)):
-                # Constraint on TARGETS
-                T = None
-                if self.mask[i] in self.TARGETList:
-                    T = self.TARGETThresholds[np.where(self.mask[i] == self.TARGETList)[0][0]]
-                    self.quadHelperOver[i] = 0.0001 #GYN! FOR PROSTATE SEE BELOW!
-                    self.quadHelperUnder[i] = 9E11 #GYN! FOR PROSTATE SEE BELOW!
-                # Constraint on OARs
-                elif self.mask[i] in self.OARList:
-                    T = self.OARThresholds[np.where(self.mask[i] == self.OARList)[0][0]]
-                    self.quadHelperOver[i] = 0.003 #GYN! FOR PROSTATE SEE BELOW!
-                    self.quadHelperUnder[i] = 0.0 #GYN! FOR PROSTATE SEE BELOW!
-                elif 0 == self.mask[i]:
-                    print('there is an element in the voxels that is also mask 0')
-                self.quadHelperThresh[i] = T
-                ########################
-        for i in range(len(self.bixels)):
-            beamP = self.projectionsD[i] + k10
-            beamL = self.leafsD[i]
-            if self.bdata[beamP, beamL] < self.Dijs[i]:
-                self.bdata[beamP, beamL] = self.Dijs[i]
-        # Logging
-        self.treatmentName = 'IMRT'
-        if imrtwith20msecondsconstraint:
-            self.treatmentName += '20msec'
-        if not imrt:
-            if pairSolution:
-                self.treatmentName = 'pairModel'
+            self.penaltyTable = self.penaltyTableCreator(0.0001, 9E11, 0.003, 0.0)
+        if np.any(0 == self.mask):
+            print('there is an element in the voxels that is also mask 0')
+
+    ## Table of threshold, under and over weights by structure. When a structure appears several times in the lists the
+    # first appearance counts, and targets take precedence over OARs. Structures in neither list get a NaN threshold.
+    def penaltyTableCreator(self, targetOver, targetUnder, oarOver, oarUnder):
+        return(penaltyTable(self.TARGETList, self.TARGETThresholds, self.OARList, self.OARThresholds, targetOver,
+                            targetUnder, oarOver, oarUnder, max(max(self.ALLList), int(self.mask.max())) + 1))
+
+    ## Forget the derived tables, so that they are rebuilt after the triplets change
+    def forgetDerived(self):
+        for name in tomodata.derivedTables:
+            setattr(self, '_' + name, None)
+
+    @property
+    def leafsD(self):
+        if self._leafsD is None:
+            self._leafsD = (self.bixels % self.L).astype(smallestIndexType(self.L))
+        return(self._leafsD)
+
+    @property
+    def projectionsD(self):
+        if self._projectionsD is None:
+            self._projectionsD = (self.bixels // self.L).astype(smallestIndexType(self.numProjections))
+        return(self._projectionsD)
+
+    ## Largest Dij of each beamlet
+    @property
+    def bdata(self):
+        if self._bdata is None:
+            self._bdata = np.zeros((self.numProjections, self.L))
+            np.maximum.at(self._bdata, (self.projectionsD.astype(np.intp) + k10, self.leafsD), self.Dijs)
+        return(self._bdata)
+
+    @property
+    def quadHelperThresh(self):
+        if self._quadHelperThresh is None:
+            self._quadHelperThresh = self.penaltyTable[0][self.mask]
+        return(self._quadHelperThresh)
+
+    @property
+    def quadHelperUnder(self):
+        if self._quadHelperUnder is None:
+            self._quadHelperUnder = self.penaltyTable[1][self.mask]
+        return(self._quadHelperUnder)
+
+    @property
+    def quadHelperOver(self):
+        if self._quadHelperOver is None:
+            self._quadHelperOver = self.penaltyTable[2][self.mask]
+        return(self._quadHelperOver)
+
+    # Logging
+    @property
+    def treatmentName(self):
+        if self._treatmentName is None:
+            self._treatmentName = 'IMRT'
+            if imrtwith20msecondsconstraint:
+                self._treatmentName += '20msec'
+            if 'gurobi' != imrtSolver:
+                self._treatmentName += imrtSolver
+            if not imrt:
+                if pairSolution:
+                    self._treatmentName = 'pairModel'
+                else:
+                    self._treatmentName = 'fullModel'
+                if leafwiseLagrangian:
+                    self._treatmentName += 'Lagrangian'
+                if rollingHorizon:
+                    self._treatmentName += 'RollingHorizon'
+                if relaxedProblem:
+                    self._treatmentName += 'relaxedVersion'
+            if dijThreshold > 0.0:
+                self._treatmentName += 'Pruned' + np.format_float_positional(dijThreshold)
+            if self.readsCompactCase():
+                self._treatmentName += 'Compact'
+        return(self._treatmentName)
+
+    ## Whether the triplets come from the compact version of the case (only if useCompactCase)
+    def readsCompactCase(self):
+        return(useCompactCase and hasCompactCase(self.base_dir))
+
+    @property
+    def chunkName(self):
+        if self._chunkName is None:
+            self._chunkName = tumorsite + '-' + str(initialProjections) + '-' + self.treatmentName + '-MinLOT-' + str(timeM) + '-minAvgLot-' + str(timeA) + '-vxls-' + str(self.totalsmallvoxels) + '-ntnsty-'+str(self.yBar)
+        return(self._chunkName)
+
+    @property
+    def feasibleName(self):
+        if self._feasibleName is None:
+            self._feasibleName = tumorsite + '-' + str(initialProjections)  + self.treatmentName + '-MinLOT-' + str(timeM) + '-minAvgLot-' + str(timeA) + '-vxls-' + str(maxvoxels) + '-ntnsty-' + str(self.yBar)
+        return(self._feasibleName)
+
+    @property
+    def logFile(self):
+        if self._logFile is None:
+            if imrt:
+                self._logFile = self.outputDirectory + 'logFile' + self.chunkName + 'IMRT.log'
             else:
-                self.treatmentName = 'fullModel'
-            if relaxedProblem:
-                self.treatmentName += 'relaxedVersion'
-        self.chunkName = tumorsite + '-' + str(initialProjections) + '-' + self.treatmentName + '-MinLOT-' + str(timeM) + '-minAvgLot-' + str(timeA) + '-vxls-' + str(self.totalsmallvoxels) + '-ntnsty-'+str(self.yBar)
-        self.feasibleName = tumorsite + '-' + str(initialProjections)  + self.treatmentName + '-MinLOT-' + str(timeM) + '-minAvgLot-' + str(timeA) + '-vxls-' + str(maxvoxels) + '-ntnsty-' + str(self.yBar)
-        self.logfile = ''
-        if imrt:
-            self.logFile = self.outputDirectory + 'logFile' + self.chunkName + 'IMRT.log'
-        else:
-            if relaxedProblem:
-                self.logFile = self.outputDirectory + 'logFile' + self.chunkName + 'relaxed.log'
-            elif pairSolution:
-                self.logFile = self.outputDirectory + 'logFile' + self.chunkName + 'pairSolution.log'
+                if relaxedProblem:
+                    self._logFile = self.outputDirectory + 'logFile' + self.chunkName + 'relaxed.log'
+                elif pairSolution:
+                    self._logFile = self.outputDirectory + 'logFile' + self.chunkName + 'pairSolution.log'
+                else:
+                    self._logFile = self.outputDirectory + 'logFile' + self.chunkName + 'completeSolution.log'
+        return(self._logFile)
+
+    ## Store the triplets in the case cache if they are not there yet and return their key
+    def storeCase(self):
+        if self.caseKey is None:
+            arrays = {name: getattr(self, name) for name in CASEARRAYS}
+            key = caseKey([arrays[name] for name in CASEARRAYS])
+            storeCase(caseDirectory(self.outputDirectory), key, arrays)
+            self.caseKey = key
+        return(self.caseKey)
+
+    ## Read the triplets back from the case cache
+    def reattachCase(self):
+        if self.caseKey is None:
+            raise AttributeError('the triplets of this tomodata object were never read')
+        for name, array in loadCase(caseDirectory(self.outputDirectory), self.caseKey).items():
+            setattr(self, '_' + name, array)
+
+    ## Arrays that a case server shares: the triplets, the mask, the penalties and the derived tables
+    def sharedArrays(self):
+        return({name: getattr(self, name) for name in CASEARRAYS + ('mask', 'smallToBig', 'penaltyTable') +
+                tomodata.derivedTables})
+
+    ## Attributes that a case server publishes with the arrays. The names of the run are left out, the runs that attach
+    # build their own
+    def sharedState(self):
+        self.storeCase()
+        arrays = self.sharedArrays()
+        return({name: getattr(self, name) for name in tomodata.__slots__ if not name.startswith('_') and
+                name not in arrays and hasattr(self, name)})
+
+    ## tomodata object of a case published by a case server. Its arrays are read only views of the shared memory
+    @staticmethod
+    def fromServer(state, arrays):
+        data = tomodata.__new__(tomodata)
+        data.__setstate__(state)
+        for name, array in arrays.items():
+            if name in CASEARRAYS or name in tomodata.derivedTables:
+                setattr(data, '_' + name, array)
             else:
-                self.logFile = self.outputDirectory + 'logFile' + self.chunkName + 'completeSolution.log'
+                setattr(data, name, array)
+        # The case does not depend on the times of the run
+        data.timeA = timeA
+        data.timeM = timeM
+        return(data)
+
+    ## Pickle the slots that are set and the names of the run, but neither the derived tables nor the triplets. The
+    # names are pickled because they depend on the settings of the run that wrote them. The triplets go to the case
+    # cache and only their key is pickled.
+    def __getstate__(self):
+        state = {name: getattr(self, name) for name in tomodata.__slots__ if not name.startswith('_') and hasattr(self, name)}
+        for name in tomodata.runNames:
+            state[name] = getattr(self, name)
+        state['caseKey'] = self.storeCase()
+        return(state)
+
+    ## Accepts the states written by __getstate__ and the __dict__ of the pickles written before tomodata had slots
+    def __setstate__(self, state):
+        if isinstance(state, tuple):
+            state = state[1]
+        self.forgetDerived()
+        for name in tomodata.runNames + CASEARRAYS:
+            setattr(self, '_' + name, None)
+        self.caseKey = None
+        for name, value in state.items():
+            if name in tomodata.derivedTables or name in tomodata.runNames or name in CASEARRAYS:
+                setattr(self, '_' + name, value)
+            elif name in tomodata.__slots__:
+                setattr(self, name, value)
 
     ## Keep the ROI's in a dictionary
     def maskNamesGetter(self, maskfile):
@@ -385,6 +593,34 @@ class tomodata:
         self.voxels = np.delete(self.voxels, indices)
         self.Dijs = np.delete(self.Dijs, indices)
 
+    ## Drop the Dij entries smaller than threshold times the largest entry of the same voxel (or of the same beamlet if
+    # perBeamlet). If rescale, the entries left in each voxel are scaled to keep its total dose coefficient. For any
+    # plan with 0 <= t <= t51 the dose of a voxel changes by at most yBar * t51 * (sum of its dropped entries).
+    def sparsifyDijs(self, threshold, perBeamlet=False, rescale=False):
+        keys = self.bixels if perBeamlet else self.smallvoxels
+        groupMax = np.zeros(int(keys.max()) + 1 if perBeamlet else self.totalsmallvoxels)
+        np.maximum.at(groupMax, keys, self.Dijs)
+        keep = self.Dijs >= threshold * groupMax[keys]
+        rowSum = np.bincount(self.smallvoxels, weights=self.Dijs, minlength=self.totalsmallvoxels)
+        dropped = np.bincount(self.smallvoxels[~keep], weights=self.Dijs[~keep], minlength=self.totalsmallvoxels)
+        self.bixels = self.bixels[keep]
+        self.smallvoxels = self.smallvoxels[keep]
+        self.Dijs = self.Dijs[keep]
+        self.forgetDerived()
+        if rescale:
+            keptSum = rowSum - dropped
+            factor = np.ones(self.totalsmallvoxels)
+            factor[keptSum > 0] = rowSum[keptSum > 0] / keptSum[keptSum > 0]
+            self.Dijs = (self.Dijs * factor[self.smallvoxels]).astype(np.float32)
+        worstCase = self.yBar * t51 * dropped
+        relative = np.zeros(self.totalsmallvoxels)
+        relative[rowSum > 0] = dropped[rowSum > 0] / rowSum[rowSum > 0]
+        print('Dij sparsification removed', len(keep) - keep.sum(), 'of', len(keep), 'entries (',
+              100.0 * (len(keep) - keep.sum()) / len(keep), '% of the dose constraint nonzeros)')
+        print('worst case dose error:', worstCase.max(), 'Gy, dropped share of the total dose coefficient of the voxel:',
+              relative.max())
+        self.dijWorstCaseError = worstCase.max()
+
     def removebixels(self, pitch):
         bixelkill = np.where(0 != (self.bixels % pitch) )
         bixelkill = np.where(self.bixels < 60)
@@ -392,9 +628,11 @@ class tomodata:
         self.smallvoxels = np.delete(self.smallvoxels, bixelkill)
         self.Dijs = np.delete(self.Dijs, bixelkill)
         self.mask = self.mask[np.unique(self.smallvoxels)]
+        self.forgetDerived()
 
     ## Read Weiguo's Case
-    def readWeiguosCase(self):
+    ## If a chunkedreader is given, the masks and the triplets come from it instead of getvector
+    def readWeiguosCase(self, reader = None):
         # Assign structures and thresholds for each of them in order of how important they are
         if "Prostate" == tumorsite:
             self.OARList = [21, 6, 11, 13, 14, 8, 12, 15, 7, 9, 5, 4, 20, 19, 18, 10, 22, 10, 11, 17, 12, 3, 15, 16, 9, 5, 4, 20, 21, 19]
@@ -413,26 +651,47 @@ class tomodata:
             self.TARGETThresholds = [35, 45]
         dtype=np.uint32
 
-        self.bixels = getvector(self.base_dir + 'dij/Bixels_out.bin', np.int32)
-        self.voxels = getvector(self.base_dir + 'dij/Voxels_out.bin', np.int32)
-        self.Dijs = getvector(self.base_dir + 'dij/Dijs_out.bin', np.float32)
         self.ALLList = self.TARGETList + self.OARList
         # get subsample mask (img_arr will have 1 in the positions where there is data)
-        img_arr = getvector(self.base_dir + self.img_filename, dtype=dtype)
+        if reader is None:
+            img_arr = getvector(self.base_dir + self.img_filename, dtype=dtype)
+        else:
+            img_arr = reader.result('img')
         # Only use a subsample of img_arr
         if do_subsample:
             img_arr = get_sub_sub_sample(img_arr, self.maxvoxels)
         # get structure file (used for the mask)
-        struct_img_arr = getvector(self.base_dir + self.struct_img_filename, dtype=dtype)
+        if reader is None:
+            struct_img_arr = getvector(self.base_dir + self.struct_img_filename, dtype=dtype)
+        else:
+            struct_img_arr = reader.result('struct')
         # Convert the mask into a list of unitary structures. A voxel gets assigned to only one place
         img_struct = get_structure_mask(reversed(self.ALLList), struct_img_arr)
         # Get the subsampled list of voxels
         self.mask = get_subsampled_mask(img_struct, img_arr)
         # Select only the voxels that exist in the small voxel space provided.
         if tumorsite == "Prostate":
-            self.removezeroes([0, 18])
+            toremove = [0, 18]
         else:
-            self.removezeroes([0, 10, 14, 15, 8, 16, 9, 17])
+            toremove = [0, 10, 14, 15, 8, 16, 9, 17]
+        if self.readsCompactCase():
+            # Quantized voxel-sorted version of the case written by compactCase.py
+            self.bixels, self.voxels, self.Dijs = readCompactCase(self.base_dir)
+        elif not os.path.exists(self.base_dir + 'dij/Dijs_out.bin') and hasCompressedCase(self.base_dir):
+            # Only the compressed archives exist. Filter the voxels while decoding instead of calling removezeroes
+            self.bixels, self.voxels, self.Dijs, seen = streamCompressedCase(self.base_dir, ~np.isin(self.mask, toremove))
+            self.mask = self.mask[seen]
+            return
+        elif reader is not None:
+            self.bixels = reader.result('bixels')
+            self.voxels = reader.result('voxels')
+            self.Dijs = reader.result('Dijs')
+            reader.shutdown()
+        else:
+            self.bixels = getvector(self.base_dir + 'dij/Bixels_out.bin', np.int32)
+            self.voxels = getvector(self.base_dir + 'dij/Voxels_out.bin', np.int32)
+            self.Dijs = getvector(self.base_dir + 'dij/Dijs_out.bin', np.float32)
+        self.removezeroes(toremove)
 
     def maxTgtDoses(self, numProjections, k10):
         # This function will calculate the maximum bixel to a target coming from a particular beamlet
@@ -456,6 +715,8 @@ def solveModel(data):
     if relaxedProblem:
         m.params.TimeLimit = 2 * 3600
     m.params.partitionPlace = 18
+    if gurobiThreads > 0:
+        m.params.Threads = gurobiThreads
     m.params.CutPasses = 1
     if imrt:
         m.params.Method = 2
@@ -556,17 +817,19 @@ def solveModel(data):
             z_minus[v_actual].Partition = mypartition
             v_actual += 1
         if thereisaHint:
-            hintfile = data.outputDirectory + 'hints' + data.chunkName + '.pkl'
-            hintfile = hintfile.replace("Model-Min", "ModelrelaxedVersion-Min")
+            # The relaxed run has the same name with relaxedVersion after the model
+            relaxedName = data.treatmentName.replace('Model', 'ModelrelaxedVersion', 1)
+            hintfile = data.outputDirectory + 'hints' + data.chunkName.replace('-' + data.treatmentName + '-MinLOT',
+                                                                            '-' + relaxedName + '-MinLOT', 1) + '.pkl'
             try:
                 myhints = pickle.load(open(hintfile, 'rb'))
             except:
                 print('----Running a relaxed version of the problem--------------')
-                callerstring = 'C:\Intel\python\intelpython3\python ' + executor + ' ' + str(timeM) + ' ' + str(
+                callerstring = sys.executable + ' ' + executor + ' ' + str(timeM) + ' ' + str(
                     timeA) + ' ' + str(int(imrt)) + ' ' + str(int(imrtwith20msecondsconstraint)) + ' ' + str(
                     int(pairSolution)) + ' ' + str(1) + ' ' + str(initialProjections) + ' ' + str(int(loadWarmStart))
                 if do_subsample:
-                   callerstring += ' ' + str(maxvoxels)
+                   callerstring += ' ' + str(maxvoxels) + ' ' + str(gurobiThreads) + ' ' + tumorsite
                 print('------- Invoking a version of the model that will create hints file with callerstring:', callerstring)
                 os.system(callerstring)
                 myhints = pickle.load(open(hintfile, 'rb'))
@@ -577,9 +840,10 @@ def solveModel(data):
                 try:
                     wst = pickle.load(open(warmstartFile, 'rb'))
                 except:
-                    callerstring = 'C:\Intel\python\intelpython3\python ' + executor + ' '  + str(timeM) + ' ' + str(
+                    callerstring = sys.executable + ' ' + executor + ' '  + str(timeM) + ' ' + str(
                         timeA) + ' ' + str(int(imrt)) + ' ' + str(int(imrtwith20msecondsconstraint)) + ' ' + str(
-                        int(pairSolution)) + ' ' + str(0) + ' ' + str(initialProjections) + ' ' + str(0) + ' 2000'
+                        int(pairSolution)) + ' ' + str(0) + ' ' + str(initialProjections) + ' ' + str(0) + ' 2000 ' + str(
+                        gurobiThreads) + ' ' + tumorsite
                     print('------- Invoking a version of the model that will create warm start file with callerstring:', callerstring)
                     os.system(callerstring)
                     wst = pickle.load(open(warmstartFile, 'rb'))
@@ -744,6 +1008,11 @@ def solveModel(data):
                  "mlittle_out": mlittle_output, "blittle_out": blittle_output,
                  "elittle_out": elittle_output, "beta_output": beta_output, "slackAvgLOT": Average_LOT_c.getAttr("Slack"),
                  "gurobisT": mathcalT.x, "gurobisN": mathcalN.x, "objVal": m.objVal}
+    d["runtime"] = m.Runtime
+    d["MIPGap"] = np.nan
+    if m.IsMIP:
+        d["MIPGap"] = m.MIPGap
+    if not imrt:
         if relaxedProblem:
             print('printing the relaxed hints file: ', data.outputDirectory + 'Feasible' + data.chunkName + '.pkl')
             outputFile = open(data.outputDirectory + 'hints' + data.chunkName + '.pkl', 'wb')
@@ -755,23 +1024,60 @@ def solveModel(data):
     print(m.params)
     return(d)
 
+## Solve the full model through the leaf-wise Lagrangian decomposition instead of GUROBI. The leaf subproblems run in a
+# pool of numcores processes. Returns the same dictionary as solveModel plus the Lagrangian lower bound.
+def solveModelLagrangian(data):
+    numProjections = data.numProjections
+    D = buildDoseMatrix(data, numProjections, k10)
+    d = lagrangianDecomposition(data, D, numProjections, k10, t51, data.timeM, data.timeA, numworkers = numcores)
+    print('Lagrangian lower bound:', d['lowerBound'], 'objective value of the heuristic plan:', d['objVal'])
+    outputFile = open(data.outputDirectory + 'Feasible' + data.feasibleName + '.pkl', 'wb')
+    pickle.dump(d, outputFile)
+    outputFile.close()
+    return(d)
+
+## Solve the IMRT model with the native first-order solver. If benchmarkFMO, solve it with GUROBI too and compare.
+def solveModelFMO(data):
+    numProjections = data.numProjections
+    D = buildDoseMatrix(data, numProjections, k10)
+    operator = None
+    if lowRankError > 0.0:
+        operator = lowrankdose(data, D, errorBound = lowRankError)
+        operator.approximationError(D, t51 = t51)
+    d = solveFMO(data, D, numProjections, k10, t51, method = imrtSolver, operator = operator)
+    if benchmarkFMO and have_gurobi:
+        gurobiStart = time.time()
+        dGurobi = solveModel(data)
+        benchmarkAgainstGurobi(d, dGurobi, time.time() - gurobiStart)
+    return(d)
+
+## Solve the LOT model (pair or full) by rolling horizon over windows of projections. The windows that are not
+# neighbours share the numcores cores. Starts from the warm start file if loadWarmStart, else from the closed plan.
+def solveModelRollingHorizon(data):
+    numProjections = data.numProjections
+    D = buildDoseMatrix(data, numProjections, k10)
+    initial = None
+    if loadWarmStart:
+        warmstartFile = data.outputDirectory + 'Feasible' + data.feasibleName + '.pkl'
+        warmstartFile = warmstartFile.replace(str(maxvoxels), '2000')
+        try:
+            initial = pickle.load(open(warmstartFile, 'rb'))
+        except:
+            print('No warm start file', warmstartFile, 'starting from the closed plan')
+    d = solveRollingHorizon(data, D, numProjections, k10, t51, data.timeM, data.timeA, pairSolution, numcores,
+                            windowSize = windowSize, windowOverlap = windowOverlap, initial = initial)
+    outputFile = open(data.outputDirectory + 'Feasible' + data.feasibleName + '.pkl', 'wb')
+    pickle.dump(d, outputFile)
+    outputFile.close()
+    return(d)
+
 # Plot the dose volume histogram
 def plotDVHNoClass(data, z, NameTag='', showPlot=False):
-    voxDict = {}
-    data.TARGETList = np.intersect1d(np.array(data.TARGETList), np.unique(data.mask))
-    data.OARList = np.intersect1d(np.array(data.OARList), np.unique(data.mask))
-    for t in data.TARGETList:
-        voxDict[t] = np.where(data.mask == t)[0]
-    for o in data.OARList:
-        voxDict[o] = np.where(data.mask == o)[0]
-    dose = np.array([z[j] for j in range(data.totalsmallvoxels)])
+    structures = dvhStructures(data.TARGETList, data.OARList, data.mask)
+    dvhs = batchDVH([(z, data.mask)], structures)
     plt.clf()
-    for index, sValues in voxDict.items():
-        sVoxels = sValues
-        hist, bins = np.histogram(dose[sVoxels], bins=100)
-        dvh = 1. - np.cumsum(hist) / float(sVoxels.shape[0])
-        dvh = np.insert(dvh, 0, 1)
-        plt.plot(bins, dvh, label=data.AllDict[index], linewidth=2)
+    for s, index in enumerate(dvhs['structures']):
+        plt.plot(dvhs['bins'], dvhs['dvh'][0, s], label=data.AllDict[index], linewidth=2)
     lgd = plt.legend(fancybox=True, framealpha=0.5, bbox_to_anchor=(1.05, 1), loc=2)
     plt.grid(True)
     plt.xlabel('Dose Gray')
@@ -789,9 +1095,14 @@ def plotDVHNoClass(data, z, NameTag='', showPlot=False):
         plt.show()
     plt.close()
 
-def plotSinogram(t, L, data):
-    plt.figure()
-    ax = gca()
+## Draw the apertures of t (one list of [begin, end] pairs per leaf). With rasterSinogram the apertures (the structured
+# array of apertures.py, built from t if not given) are drawn as an image instead of a line each.
+def plotSinogram(t, L, data, apertures = None):
+    if rasterSinogram:
+        if apertures is None:
+            apertures = aperturesFromIntervals(t)
+        plotSinogramRaster(apertures, L, data.outputDirectory + 'Sinogram' + data.chunkName + '.png')
+        return
     lines = []
     for l in range(L):
         for aperture in range(len(t[l])):
@@ -805,88 +1116,16 @@ def plotSinogram(t, L, data):
     plt.xlabel('time in seconds')
     plt.ylabel('leaves')
     plt.savefig(data.outputDirectory + 'Sinogram' + data.chunkName + '.png')
+    plt.close(fig)
 
+## t is a list that contains a list per leaf. In this inner list, you get the time when it opens and the time when it
+# closes as a pair. leavelengths will contain the total opening times
 def calculateTIMRT(numProjections, t51, tim, data):
-    # t is a list that contains a list per leaf. In this inner list, you get the time when it opens and the time when it
-    # closes as a pair. leavelengths will contain the total opening times
-    t = [list() for _ in range(data.L)] # there is one for each of the leaves
-    leavelengths = []
-    projectionsEven = range(0, numProjections - 1, 2)
-    for p in projectionsEven:
-        time1 = t51 * p
-        time2 = t51 * (p + 1)
-        for l in range(data.L):
-            if tim[p, l] > 0:
-                t[l].append([time1, time1 + tim[p, l]])
-                leavelengths.append(tim[p, l])
-            if tim[p + 1, l] > 0:
-                t[l].append([time2, time2 + tim[p + 1, l]])
-                leavelengths.append(tim[p + 1, l])
-    return([t, leavelengths])
+    return(aperturesAsLists(imrtApertures(tim[:numProjections, :], t51), data.L))
 
 def calculateT(numProjections, t51, tim, data, elittle, mlittle, blittle):
-    # t is a list that contains a list per leaf. In this inner list, you get the time when it opens and the time when it
-    # closes as a pair. leavelengths will contain the total opening times
-
-    t = [list() for _ in range(data.L)] # there is one for each of the leaves
-    projections = range(0, numProjections)
-    leavelengths = []
-    for l in range(data.L):
-        # This implies that the opening is new or continuing from before
-        continuousopening = False
-        for p in projections:
-            timeright = t51 * (p + 1)
-            timeleft = t51 * p
-            # Handle special case of last projection
-            if p == numProjections - 1:
-                if continuousopening:
-                    endingtime = timeleft + tim[p, l]
-                    t[l].append([beginningtime, endingtime])
-                    leavelengths.append(endingtime - beginningtime)
-                    continuousopening = False
-                else:
-                    if 1 == elittle[p, l]:
-                        # If it opened in the right projection it HAS to be centered
-                        midtime = timeleft + t51 / 2.0
-                        beginningtime = midtime - tim[p, l] / 2.0
-                        endingtime = midtime + tim[p, l] / 2.0
-                        t[l].append([beginningtime, endingtime])
-                        leavelengths.append(endingtime - beginningtime)
-                        continuousopening = False  # this line unnecessary
-            else:
-                if continuousopening:
-                    if (1 == blittle[p, l] or (0 == mlittle[p + 1, l] + blittle[p + 1, l])):
-                        # This is when a continuing aperture closes in this projection
-                        if 1 == blittle[p, l]:
-                            endingtime = timeleft + tim[p, l]
-                        else:
-                            endingtime = timeright
-                        t[l].append([beginningtime, endingtime])
-                        leavelengths.append(endingtime - beginningtime)
-                        continuousopening = False
-                    else:
-                        # The aperture continues
-                        pass
-                else:
-                    if elittle[p, l] == 1 and tim[p, l] > 0:
-                        # A new opening event started.
-                        if 0 == mlittle[p + 1, l] + blittle[p + 1, l] or p == (numProjections - 1):
-                            # If it closed right now it HAS to be centered
-                            midtime = timeleft + t51 / 2.0
-                            beginningtime = midtime - tim[p, l] / 2.0
-                            endingtime = midtime + tim[p, l] / 2.0
-                            t[l].append([beginningtime, endingtime])
-                            leavelengths.append(endingtime - beginningtime)
-                            continuousopening = False #this line unnecessary
-                        # But if didn't close it must continue
-                        else:
-                            beginningtime = timeright - tim[p, l]
-                            # endingtime, leavelengths and t not assigned
-                            continuousopening = True
-                    else:
-                        #Leaves were closed and they continue to be closed. Nothing happened
-                        pass
-    return([t, leavelengths])
+    return(aperturesAsLists(fullApertures(tim[:numProjections, :], elittle[:numProjections, :], mlittle[:numProjections, :],
+                                          blittle[:numProjections, :], t51), data.L))
 
 def sinogramAndHistogramYesIMRT(d, data):
     projIni = 1 + np.floor(max(data.bixels / data.L)).astype(int)
@@ -898,71 +1137,45 @@ def sinogramAndHistogramYesIMRT(d, data):
     abc['t51'] = t51
     abc['tim'] = tim
     abc['data'] = data
-    with open(data.outputDirectory + 'calculateT' + data.chunkName + '.pkl', "wb") as f:
-        pickle.dump(abc, f, pickle.HIGHEST_PROTOCOL)
-    f.close()
-    t, leavelengths = calculateTIMRT(numProjections, t51, tim, data)
-    plotSinogram(t, data.L, data)
-    plt.clf()
-    binsequence = [i for i in np.arange(min(leavelengths), max(leavelengths), 0.01)] + [max(leavelengths)]
-    plt.hist(np.array(leavelengths), bins = binsequence)
-    # Add a few extra ticks to the labels
-    #extraticks = [a['minLength'], a['avLength']]
-    #plt.xticks(list(plt.xticks()[0]) + extraticks)
-    plt.xlabel('Leaf Opening Times')
-    if imrtwith20msecondsconstraint:
-        plt.title('histogram IMRT with intensity: ' + str(data.yBar) + 'with cutoff 20 msecs')
-    else:
-        plt.title('histogram IMRT with intensity: ' + str(data.yBar))
-    plt.savefig(data.outputDirectory + 'histogram' + data.chunkName  + '.png')
+    if writeLegacyPickles:
+        with open(data.outputDirectory + 'calculateT' + data.chunkName + '.pkl', "wb") as f:
+            pickle.dump(abc, f, pickle.HIGHEST_PROTOCOL)
+    apertures = imrtApertures(tim, t51)
+    t, leavelengths = aperturesAsLists(apertures, data.L)
+    if not parallelPlots:
+        plotSinogram(t, data.L, data, apertures)
+        plt.clf()
+        binsequence = [i for i in np.arange(min(leavelengths), max(leavelengths), 0.01)] + [max(leavelengths)]
+        plt.hist(np.array(leavelengths), bins = binsequence)
+        # Add a few extra ticks to the labels
+        #extraticks = [a['minLength'], a['avLength']]
+        #plt.xticks(list(plt.xticks()[0]) + extraticks)
+        plt.xlabel('Leaf Opening Times')
+        if imrtwith20msecondsconstraint:
+            plt.title('histogram IMRT with intensity: ' + str(data.yBar) + 'with cutoff 20 msecs')
+        else:
+            plt.title('histogram IMRT with intensity: ' + str(data.yBar))
+        plt.savefig(data.outputDirectory + 'histogram' + data.chunkName  + '.png')
     abc = dict()
-    totalLength = 0.0
-    n = 0
-    minLength = 1000.0
-    maxLength = -1.0
-    for l in range(data.L):
-        for aperture in range(len(t[l])):
-            a, b  = t[l][aperture]
-            totalLength += b - a
-            maxLength = max(maxLength, b-a)
-            n += 1
-            # min length
-            if b-a > 0.000001:
-                minLength = min(b-a, minLength)
-    abc['avLength'] = totalLength / n
-    abc['totalLength'] = totalLength
-    abc['minLength'] = minLength
-    abc['modFactor'] = maxLength / (totalLength / n)
+    stats = apertureStatistics(apertures)
+    abc['avLength'] = stats['avLength']
+    abc['totalLength'] = stats['totalLength']
+    abc['minLength'] = stats['minLength']
+    abc['modFactor'] = stats['modFactor']
+    abc['apertures'] = apertures
     abc['t'] = t
     abc['leavelengths'] = leavelengths
     abc['objVal'] = d['objVal']
     print('average length measured by me:', abc['avLength'])
     print('objective Value:', abc['objVal'])
-    output3 = open(data.outputDirectory + 'pickleresults-' + data.chunkName + '.pkl', 'wb')
-    pickle.dump(abc, output3, pickle.HIGHEST_PROTOCOL)
-    output3.close()
+    if writeLegacyPickles:
+        output3 = open(data.outputDirectory + 'pickleresults-' + data.chunkName + '.pkl', 'wb')
+        pickle.dump(abc, output3, pickle.HIGHEST_PROTOCOL)
+        output3.close()
+    return(abc)
 
 def calculateTpairSolution(numProjections, t51, tim, data, gamma):
-    # t is a list that contains a list per leaf. In this inner list, you get the time when it opens and the time when it
-    # closes as a pair. leavelengths will contain the total opening times
-    t = [list() for _ in range(data.L)] # there is one for each of the leaves
-    projections = range(0, numProjections)
-    projectionsEven = range(0, numProjections, 2)
-    leavelengths = []
-    for l in range(data.L):
-        # This implies that the opening is new or continuing from before
-        for p in projectionsEven:
-            timemiddle = t51 * (p + 1)
-            if p == numProjections - 1: # last projections
-                if gamma[p, l]:
-                    beginningtime = t51 * p; endingtime = beginningtime + t[p, l]
-                    t[l].append([beginningtime, endingtime])
-                    leavelengths.append(endingtime - beginningtime)
-            if gamma[p, l]:
-                beginningtime = timemiddle - tim[p, l]; endingtime = timemiddle + tim[p + 1, l]
-                t[l].append([beginningtime, endingtime])
-                leavelengths.append(endingtime - beginningtime)
-    return([t, leavelengths])
+    return(aperturesAsLists(pairApertures(tim[:numProjections, :], gamma[:numProjections, :], t51), data.L))
 
 def sinogramAndHistogramNoIMRT(d, data):
     projIni = 1 + np.floor(max(data.bixels / data.L)).astype(int)
@@ -987,34 +1200,25 @@ def sinogramAndHistogramNoIMRT(d, data):
     abc['data'] = data
     abc['z_output'] = d['z_output']
 
-    with open(data.outputDirectory + 'calculateT' + data.chunkName + '.pkl', "wb") as f:
-        pickle.dump(abc, f, pickle.HIGHEST_PROTOCOL)
-    f.close()
+    if writeLegacyPickles:
+        with open(data.outputDirectory + 'calculateT' + data.chunkName + '.pkl', "wb") as f:
+            pickle.dump(abc, f, pickle.HIGHEST_PROTOCOL)
 
     # contains pairs when the aperture opens and closes
     if pairSolution:
-        t, leavelengths = calculateTpairSolution(numProjections, t51, tim, data, gamma)
+        apertures = pairApertures(tim, gamma, t51)
     else:
-        t, leavelengths = calculateT(numProjections, t51, tim, data, elittle, mlittle, blittle)
+        apertures = fullApertures(tim, elittle, mlittle, blittle, t51)
+    t, leavelengths = aperturesAsLists(apertures, data.L)
     abc = dict()
-    totalLength = 0.0
-    n = 0
-    minLength = 1000.0
-    maxLength = -1.0
-    for l in range(data.L):
-        for aperture in range(len(t[l])):
-            a, b  = t[l][aperture]
-            totalLength += b - a
-            #print('mynumbers', b - a)
-            maxLength = max(maxLength, b-a)
-            n += 1
-            # min length
-            if b-a > 0.000001:
-                minLength = min(b-a, minLength)
-    abc['avLength'] = totalLength / n
-    abc['totalLength'] = totalLength
+    stats = apertureStatistics(apertures)
+    n = stats['n']
+    minLength = stats['minLength']
+    abc['avLength'] = stats['avLength']
+    abc['totalLength'] = stats['totalLength']
     abc['minLength'] = minLength
-    abc['modFactor'] = maxLength / (totalLength / n)
+    abc['modFactor'] = stats['modFactor']
+    abc['apertures'] = apertures
     abc['t'] = t
     abc['leavelengths'] = leavelengths
     abc['t_output'] = tim
@@ -1031,44 +1235,118 @@ def sinogramAndHistogramNoIMRT(d, data):
     print('objective Value:', abc['objVal'])
     print('minimum length:', minLength)
     print('modulation factor:', abc['modFactor'])
-    plotSinogram(t, data.L, data)
-    plt.clf()
-    binsequence = [i for i in np.arange(min(leavelengths), max(leavelengths), 0.01)] + [max(leavelengths)]
-    plt.hist(np.array(leavelengths), bins = binsequence)
-    # Add a few extra ticks to the labels
-    plt.xlabel('Leaf Opening Times')
-    plt.text(abc['minLength'], 7, str(abc['minLength'])[0:6], color='r', rotation=89)
-    plt.text(abc['avLength'], 7, str(abc['avLength'])[0:6], color='r', rotation=89)
-    plt.title('histogram: Min LOT Goal: ' + str(data.timeM) + ' Actual:' + str(abc['minLength'])[0:6] +
-              ' AvgLOT goal:' + str(data.timeA) + ' Actual: ' + str(abc['avLength'])[0:6] )
-    plt.savefig(data.outputDirectory + 'histogram' + data.chunkName + '.png')
+    if not parallelPlots:
+        plotSinogram(t, data.L, data, apertures)
+        plt.clf()
+        binsequence = [i for i in np.arange(min(leavelengths), max(leavelengths), 0.01)] + [max(leavelengths)]
+        plt.hist(np.array(leavelengths), bins = binsequence)
+        # Add a few extra ticks to the labels
+        plt.xlabel('Leaf Opening Times')
+        plt.text(abc['minLength'], 7, str(abc['minLength'])[0:6], color='r', rotation=89)
+        plt.text(abc['avLength'], 7, str(abc['avLength'])[0:6], color='r', rotation=89)
+        plt.title('histogram: Min LOT Goal: ' + str(data.timeM) + ' Actual:' + str(abc['minLength'])[0:6] +
+                  ' AvgLOT goal:' + str(data.timeA) + ' Actual: ' + str(abc['avLength'])[0:6] )
+        plt.savefig(data.outputDirectory + 'histogram' + data.chunkName + '.png')
     # Let's pickle save the data results
-    output2 = open(data.outputDirectory + 'pickleresults-' + data.chunkName + '.pkl', 'wb')
-    pickle.dump(abc, output2)
-    output2.close()
-    return(t)
+    if writeLegacyPickles:
+        output2 = open(data.outputDirectory + 'pickleresults-' + data.chunkName + '.pkl', 'wb')
+        pickle.dump(abc, output2)
+        output2.close()
+    return(abc)
+
+## Write the run to the results store: the solution arrays, the aperture intervals and LOT statistics of abc (the
+# results of the sinogram functions, None if they did not run), the solver statistics and the parameters of the run.
+def storeRun(d, data, abc = None):
+    parameters = {'tumorsite': tumorsite, 'initialProjections': initialProjections, 'treatmentName': data.treatmentName,
+                  'timeM': data.timeM, 'timeA': data.timeA, 'totalsmallvoxels': data.totalsmallvoxels,
+                  'maxvoxels': maxvoxels, 'yBar': data.yBar, 'imrt': imrt,
+                  'imrtwith20msecondsconstraint': imrtwith20msecondsconstraint, 'imrtSolver': imrtSolver,
+                  'pairSolution': pairSolution, 'relaxedProblem': relaxedProblem, 'dijThreshold': dijThreshold,
+                  'L': data.L, 't51': t51, 'k10': k10, 'base_dir': data.base_dir, 'feasibleName': data.feasibleName, 'caseKey': data.storeCase(),
+                  'structures': [[index, name] for index, name in data.AllDict.items()],
+                  'TARGETList': data.TARGETList, 'OARList': data.OARList}
+    arrays = {'mask': data.mask, 'smallToBig': data.smallToBig, 'penaltyTable': data.penaltyTable}
+    stats = dict()
+    for name, value in d.items():
+        if isinstance(value, (np.ndarray, list)):
+            arrays[name] = np.asarray(value)
+        elif np.isscalar(value) and not isinstance(value, str):
+            stats[name] = value
+    apertures = None
+    if abc is not None:
+        apertures = abc['apertures'] if 'apertures' in abc else aperturesFromIntervals(abc['t'])
+        arrays['leavelengths'] = np.asarray(abc['leavelengths'], dtype=float)
+        for name in ['avLength', 'totalLength', 'minLength', 'modFactor', 'gurobiAvLength', 'myN']:
+            if name in abc:
+                stats[name] = abc[name]
+    writeRun(resultsDirectory(data.outputDirectory), data.chunkName, parameters, stats, arrays, apertures)
+    print('Run stored in', resultsDirectory(data.outputDirectory) + data.chunkName)
+
+## Settings that decide the preprocessed case. The runs with the same settings can share it through a case server
+def caseSettings():
+    return({'tumorsite': tumorsite, 'initialProjections': initialProjections, 'maxvoxels': maxvoxels,
+            'do_subsample': do_subsample, 'L': numberOfLeaves, 'k10': k10, 'dijThreshold': dijThreshold,
+            'dijThresholdPerBeamlet': dijThresholdPerBeamlet, 'dijRescale': dijRescale, 'useCompactCase': useCompactCase})
 
-dataobject = tomodata()
-d = solveModel(dataobject)
+dataobject = None
+if 'attach' == caseServer:
+    served = attachCase('outputMultiProj/', serverKey(caseSettings()))
+    if served is None:
+        print('No case server is running for these settings. Reading the case')
+    else:
+        dataobject = tomodata.fromServer(*served)
+        print('Attached to the case server', serverKey(caseSettings()))
+if dataobject is None:
+    dataobject = tomodata()
+if 'serve' == caseServer:
+    serveCase(dataobject.outputDirectory, serverKey(caseSettings()), dataobject.sharedState(), dataobject.sharedArrays())
+    sys.exit()
+solveStart = time.time()
+if leafwiseLagrangian:
+    d = solveModelLagrangian(dataobject)
+elif rollingHorizon:
+    d = solveModelRollingHorizon(dataobject)
+elif imrt and 'gurobi' != imrtSolver:
+    d = solveModelFMO(dataobject)
+else:
+    d = solveModel(dataobject)
 # Save info to create dvhs later
 #####################################
 #####################################
 #####################################
-output2 = open(dataobject.outputDirectory + dataobject.chunkName + '-z.pkl', 'wb')
-pickle.dump(d["z_output"], output2)
-output2.close()
-output = open(dataobject.outputDirectory + dataobject.chunkName + '-dataobject.pkl', 'wb')
-pickle.dump(dataobject, output)
-output.close()
+d.setdefault("runtime", time.time() - solveStart)
+if writeLegacyPickles:
+    output2 = open(dataobject.outputDirectory + dataobject.chunkName + '-z.pkl', 'wb')
+    pickle.dump(d["z_output"], output2)
+    output2.close()
+    output = open(dataobject.outputDirectory + dataobject.chunkName + '-dataobject.pkl', 'wb')
+    pickle.dump(dataobject, output)
+    output.close()
 #####################################
 #####################################
 #####################################
-plotDVHNoClass(dataobject, d["z_output"], 'dvh')
+if not parallelPlots:
+    plotDVHNoClass(dataobject, d["z_output"], 'dvh')
+abc = None
 if imrt:
-    sinogramAndHistogramYesIMRT(d, dataobject)
+    abc = sinogramAndHistogramYesIMRT(d, dataobject)
 else:
     if not relaxedProblem:
-        t = sinogramAndHistogramNoIMRT(d, dataobject)
+        abc = sinogramAndHistogramNoIMRT(d, dataobject)
+storeRun(d, dataobject, abc)
+if parallelPlots:
+    renderRuns(dataobject.outputDirectory, numcores, rasterSinogram, [dataobject.chunkName])
+if fullResolution:
+    fullResolutionRun(dataobject.outputDirectory, dataobject.chunkName, dataobject.base_dir)
+if simulateDelivery and abc is not None:
+    numProjections = d["t_out"].shape[0]
+    fluence, delivered = simulatePlan(buildDoseMatrix(dataobject, numProjections, k10), abc['apertures'], numProjections,
+                                      dataobject.L, t51, dataobject.yBar, simulateDelivery)
+    gap = doseGap(np.asarray(d["z_output"])[:, None], delivered[:, None])
+    print('Delivery simulated with the', simulateDelivery, 'model. Largest dose gap:', gap['maxDoseGap'][0],
+          'relative gap:', gap['relativeDoseGap'][0], 'fluence gap:', np.abs(fluence - d["t_out"]).sum())
+    projection, angle = worstProjection(fluence, np.asarray(d["t_out"]), t51, speed, k10)
+    print('Largest fluence gap in projection', projection, 'at', angle, 'degrees')
 
 print('total time:', time.time() - initialTime)
 sys.exit()
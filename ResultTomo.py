@@ -7,11 +7,13 @@ except ImportError:
     have_mkl = False
     print("Running with normal backends")
 
-import pickle
 import numpy as np
 import matplotlib.pyplot as plt
 import matplotlib.colors as mcolors
 import sys
+from caseCache import CASEARRAYS, caseDirectory, loadCase
+from resultsCatalog import resultsCatalog
+from dvhEngine import dvhStructures, batchDVH
 
 outputDirectory = "outputMultiProj/"
 imrt = False
@@ -321,6 +323,15 @@ class tomodata:
     def maxTgtDoses(self, numProjections, k10):
         # This function will calculate the maximum bixel to a target coming from a particular beamlet
         bdoses = np.zeros(self.L, numProjections)
+
+    ## The pickles of OrganizedmultiTool.py keep only the key of the triplets in the case cache. Read them back the first
+    # time that they are used
+    def __getattr__(self, name):
+        if name in CASEARRAYS and 'caseKey' in self.__dict__:
+            arrays = loadCase(caseDirectory(self.outputDirectory), self.caseKey)
+            self.__dict__.update(arrays)
+            return(arrays[name])
+        raise AttributeError(name)
 # Plot a few histograms again:
 def histogramPlotter(abc, thismodel):
     leavelengths = abc['leavelengths']
@@ -340,19 +351,23 @@ def counterBlinker(ll):
     return(len(ll['leavelengths']))
 
 
-p40 = pickle.load(open("outputMultiProj/pickleresults-Prostate-51-fullModel-MinLOT-0.04-minAvgLot-0.17-vxls-8340-ntnsty-700.pkl", "rb"))
-p20 = pickle.load(open("outputMultiProj/pickleresults-Prostate-51-fullModel-MinLOT-0.02-minAvgLot-0.17-vxls-8340-ntnsty-700.pkl", "rb"))
+# The results are found through the catalog of the output directory. Every fetch starts loading in the background
+catalog = resultsCatalog(outputDirectory)
+prostate51 = dict(site = 'Prostate', projections = 51, intensity = 700)
+prostate153 = dict(site = 'Prostate', projections = 153, intensity = 700)
+p40 = catalog.fetch('pickleresults', model = 'fullModel', minLOT = 0.04, minAvgLot = 0.17, voxels = 8340, **prostate51)
+p20 = catalog.fetch('pickleresults', model = 'fullModel', minLOT = 0.02, minAvgLot = 0.17, voxels = 8340, **prostate51)
 
 print('40 avgLOT:', p40['avLength'], '20 avgLOT:', p20['avLength'])
 
-p1 = pickle.load(open("outputMultiProj/pickleresults-Prostate-51-fullModel-MinLOT-0.02-minAvgLot-0.17-vxls-16677-ntnsty-700.pkl", "rb"))
-p2 = pickle.load(open("outputMultiProj/pickleresults-Prostate-51-fullModel-MinLOT-0.02-minAvgLot-0.17-vxls-8340-ntnsty-700.pkl", "rb"))
-p3 = pickle.load(open("outputMultiProj/pickleresults-Prostate-51-fullModel-MinLOT-0.04-minAvgLot-0.17-vxls-8340-ntnsty-700.pkl", "rb"))
-p4 = pickle.load(open("outputMultiProj/pickleresults-Prostate-51-pairModel-MinLOT-0.02-minAvgLot-0.17-vxls-16677-ntnsty-700.pkl", "rb"))
-p5 = pickle.load(open("outputMultiProj/pickleresults-Prostate-153-pairModel-MinLOT-0.02-minAvgLot-0.17-vxls-16686-ntnsty-700.pkl", "rb"))
-p6 = pickle.load(open("outputMultiProj/pickleresults-Prostate-153-fullModel-MinLOT-0.02-minAvgLot-0.17-vxls-8344-ntnsty-700.pkl", "rb"))
-p7 = pickle.load(open("outputMultiProj/pickleresults-Prostate-51-IMRT-MinLOT-0.02-minAvgLot-0.077-vxls-16677-ntnsty-700.pkl", "rb"))
-p8 = pickle.load(open("outputMultiProj/pickleresults-Prostate-51-IMRT20msec-MinLOT-0.02-minAvgLot-0.077-vxls-16677-ntnsty-700.pkl", "rb"))
+p1 = catalog.fetch('pickleresults', model = 'fullModel', minLOT = 0.02, minAvgLot = 0.17, voxels = 16677, **prostate51)
+p2 = p20
+p3 = p40
+p4 = catalog.fetch('pickleresults', model = 'pairModel', minLOT = 0.02, minAvgLot = 0.17, voxels = 16677, **prostate51)
+p5 = catalog.fetch('pickleresults', model = 'pairModel', minLOT = 0.02, minAvgLot = 0.17, voxels = 16686, **prostate153)
+p6 = catalog.fetch('pickleresults', model = 'fullModel', minLOT = 0.02, minAvgLot = 0.17, voxels = 8344, **prostate153)
+p7 = catalog.fetch('pickleresults', model = 'IMRT', minLOT = 0.02, minAvgLot = 0.077, voxels = 16677, **prostate51)
+p8 = catalog.fetch('pickleresults', model = 'IMRT20msec', minLOT = 0.02, minAvgLot = 0.077, voxels = 16677, **prostate51)
 
 print(counterBlinker(p1))
 print(counterBlinker(p4))
@@ -366,28 +381,25 @@ print(counterBlinker(p8))
 histogramPlotter(p6, 'detailed')
 # Plot the dose volume histogram
 versus = ''
-def plotDVH(plotList, ct1, noPlot, secondPlot, doublePlot, titlestring):
+## DVHs of several calculateT results on the same dose bins, for the structures of plotList of the first one
+def planDVHs(plotList, cts):
+    data = cts[0]['data']
+    structures = dvhStructures(data.TARGETList, data.OARList, data.mask, plotList)
+    return(batchDVH([(ct['z_output'], ct['data'].mask) for ct in cts], structures))
+
+## dvhs and planIndex give the DVHs already computed by planDVHs. Without them the DVHs of ct1 are computed here
+def plotDVH(plotList, ct1, noPlot, secondPlot, doublePlot, titlestring, dvhs = None, planIndex = 0):
     if not doublePlot:
         plt.clf()
     mycolors = list(mcolors.TABLEAU_COLORS)
     data = ct1['data']
-    z = ct1['z_output']
-    voxDict = {}
-    data.TARGETList = np.intersect1d(np.array(data.TARGETList), np.unique(data.mask))
-    data.TARGETList = np.intersect1d(np.array(data.TARGETList), plotList)
-    data.OARList = np.intersect1d(np.array(data.OARList), np.unique(data.mask))
-    data.OARList = np.intersect1d(np.array(data.OARList), plotList)
-    for t in data.TARGETList:
-        voxDict[t] = np.where(data.mask == t)[0]
-    for o in data.OARList:
-        voxDict[o] = np.where(data.mask == o)[0]
-    dose = np.array([z[j] for j in range(data.totalsmallvoxels)])
+    if dvhs is None:
+        dvhs = planDVHs(plotList, [ct1])
+        planIndex = 0
+    bins = dvhs['bins']
     i = 0
-    for index, sValues in voxDict.items():
-        sVoxels = sValues
-        hist, bins = np.histogram(dose[sVoxels], bins=100)
-        dvh = 1. - np.cumsum(hist) / float(sVoxels.shape[0])
-        dvh = np.insert(dvh, 0, 1)
+    for s, index in enumerate(dvhs['structures']):
+        dvh = dvhs['dvh'][planIndex, s]
         if noPlot:
             if secondPlot:
                 plt.plot(bins, dvh, '-.', c=mycolors[i + 3], linewidth=2)
@@ -423,8 +435,9 @@ def plotDVH(plotList, ct1, noPlot, secondPlot, doublePlot, titlestring):
 
 def plotDVHcompare(plotList, ct1, ct2, titlestring = 'Comparison of different Minimum LOT constraints on treatment quality'):
     plt.clf()
-    plotDVH(plotList, ct1, True, False, True, titlestring)
-    plotDVH(plotList, ct2, False, False, True, titlestring)
+    dvhs = planDVHs(plotList, [ct1, ct2])
+    plotDVH(plotList, ct1, True, False, True, titlestring, dvhs, 0)
+    plotDVH(plotList, ct2, False, False, True, titlestring, dvhs, 1)
 
 def compareSinogram():
     pass
@@ -432,18 +445,18 @@ def compareSinogram():
 
 tumorsite = "Prostate"
 plotList = [6, 7, 8, 10, 13, 14, 2]
-ct = pickle.load(open("outputMultiProj/calculateTProstate-51-fullModel-MinLOT-0.02-minAvgLot-0.17-vxls-16677-ntnsty-700.pkl", "rb"))
+ct = catalog.fetch('calculateT', model = 'fullModel', minLOT = 0.02, minAvgLot = 0.17, voxels = 16677, **prostate51)
 
 # Compare DVH side to side:
-#ct2 = pickle.load(open("outputMultiProj/calculateTProstate-51-IMRT-MinLOT-0.02-minAvgLot-0.077-vxls-16677-ntnsty-700.pkl", "rb"))
-ct2 = pickle.load(open("outputMultiProj/calculateTProstate-51-pairModel-MinLOT-0.02-minAvgLot-0.17-vxls-16677-ntnsty-700.pkl", "rb"))
+#ct2 = catalog.fetch('calculateT', model = 'IMRT', minLOT = 0.02, minAvgLot = 0.077, voxels = 16677, **prostate51)
+ct2 = catalog.fetch('calculateT', model = 'pairModel', minLOT = 0.02, minAvgLot = 0.17, voxels = 16677, **prostate51)
 titlestring = "'DVH-' + tumorsite + 'min. LOT = ' + str(data.timeM) + ' and min.AvgLOT = ' + str(data.timeA)"
-ctm1 = pickle.load(open("outputMultiProj/calculateTProstate-51-fullModel-MinLOT-0.02-minAvgLot-0.17-vxls-8340-ntnsty-700.pkl", "rb"))
-ctm2 = pickle.load(open("outputMultiProj/calculateTProstate-51-pairModel-MinLOT-0.03-minAvgLot-0.17-vxls-8340-ntnsty-700.pkl", "rb"))
-ctm3 = pickle.load(open("outputMultiProj/calculateTProstate-51-fullModel-MinLOT-0.04-minAvgLot-0.17-vxls-8340-ntnsty-700.pkl", "rb"))
-ctmIMRT = pickle.load(open("outputMultiProj/calculateTProstate-51-IMRT-MinLOT-0.02-minAvgLot-0.077-vxls-16677-ntnsty-700.pkl", "rb"))
-ctSimple153 = pickle.load(open("outputMultiProj/calculateTProstate-153-fullModel-MinLOT-0.02-minAvgLot-0.17-vxls-16686-ntnsty-700.pkl", "rb"))
-ctDetailed153 = pickle.load(open("outputMultiProj/calculateTProstate-153-pairModel-MinLOT-0.02-minAvgLot-0.17-vxls-16686-ntnsty-700.pkl", "rb"))
+ctm1 = catalog.fetch('calculateT', model = 'fullModel', minLOT = 0.02, minAvgLot = 0.17, voxels = 8340, **prostate51)
+ctm2 = catalog.fetch('calculateT', model = 'pairModel', minLOT = 0.03, minAvgLot = 0.17, voxels = 8340, **prostate51)
+ctm3 = catalog.fetch('calculateT', model = 'fullModel', minLOT = 0.04, minAvgLot = 0.17, voxels = 8340, **prostate51)
+ctmIMRT = catalog.fetch('calculateT', model = 'IMRT', minLOT = 0.02, minAvgLot = 0.077, voxels = 16677, **prostate51)
+ctSimple153 = catalog.fetch('calculateT', model = 'fullModel', minLOT = 0.02, minAvgLot = 0.17, voxels = 16686, **prostate153)
+ctDetailed153 = catalog.fetch('calculateT', model = 'pairModel', minLOT = 0.02, minAvgLot = 0.17, voxels = 16686, **prostate153)
 
 titlestring = 'DVH FMO Treatment'
 #plotDVH(plotList, ctmIMRT, False, False, False, titlestring)
@@ -457,9 +470,10 @@ sys.exit()
 def plotDVHtriplecompare(plotList, ctm1, ctm2, ctm3):
     plt.clf()
     titlestring = 'Comparison of different Minimum LOT constraints on treatment quality'
-    plotDVH(plotList, ctm1, True, False, True, titlestring)
-    plotDVH(plotList, ctm2, True, True, True, titlestring)
-    plotDVH(plotList, ctm3, False, False, True, titlestring)
+    dvhs = planDVHs(plotList, [ctm1, ctm2, ctm3])
+    plotDVH(plotList, ctm1, True, False, True, titlestring, dvhs, 0)
+    plotDVH(plotList, ctm2, True, True, True, titlestring, dvhs, 1)
+    plotDVH(plotList, ctm3, False, False, True, titlestring, dvhs, 2)
 
 #plotDVHtriplecompare(plotList, ctm1, ctm2, ctm3)
 plotDVHcompare(plotList, ctm1, ctm3)
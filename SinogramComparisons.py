@@ -8,6 +8,7 @@ except ImportError:
     have_mkl = False
     print("Running with normal backends")
 
+import sys
 import pickle
 import time
 import socket
@@ -21,10 +22,13 @@ from itertools import product
 import pylab as pl
 from matplotlib import collections as mc
 import itertools
+import os
+from resultStore import resultsDirectory, loadRunApertures, aperturesFromIntervals
+from sinogramRaster import plotSinogramRasterComparison
+from intervalSweep import sweepIntervals, difference, intersection, overlapMetrics
+from sinogramSimilarity import similarityMatrix, plotSimilarityMatrix
 
 def plotSinogramIndependent(t, L, nameChunk, outputDirectory):
-    plt.figure()
-    ax = gca()
     lines = []
     for l in range(L):
         for aperture in range(len(t[l])):
@@ -38,77 +42,66 @@ def plotSinogramIndependent(t, L, nameChunk, outputDirectory):
     plt.xlabel('time in seconds')
     plt.ylabel('leaves')
     plt.savefig(outputDirectory + 'SinogramIndependent' + nameChunk + '.png')
+    plt.close(fig)
 
 nameoutputdirectory = 'outputMultiProj/'
+rasterSinogram = False # Draw the sinograms as images instead of a line per aperture. Much faster on large plans
+allPairs = False # Compare the sinograms of every pair of runs of the output directory instead of the two runs below
+numworkers = 4 # Worker processes of the comparisons of allPairs
 #nameChunk1 = 'pickleresults-ProstatefullModel-MinLOT-0.03-minAvgLot-0.17-vxls-8340-ntnsty-700'
 #nameChunk1 = 'pickleresults-ProstatefullModel-MinLOT-0.03-minAvgLot-0.17-vxls-8340-ntnsty-700'
 #nameChunk2 = 'pickleresults-ProstatepairModel-MinLOT-0.03-minAvgLot-0.17-vxls-16677-ntnsty-700'
 #nameChunk1 = 'pickleresults-Prostate-51-pairModel-MinLOT-0.02-minAvgLot-0.17-vxls-16677-ntnsty-700'
 #nameChunk2 = 'pickleresults-Prostate-51-fullModel-MinLOT-0.02-minAvgLot-0.17-vxls-16677-ntnsty-700'
-nameChunk1 = 'pickleresults-Prostate-51-fullModel-MinLOT-0.02-minAvgLot-0.17-vxls-1385-ntnsty-700'
-nameChunk2 = 'pickleresults-Prostate-51-fullModel-MinLOT-0.02-minAvgLot-0.17-vxls-16677-ntnsty-700'
-picklefile1 = nameoutputdirectory + nameChunk1 + '.pkl'
-picklefile2 = nameoutputdirectory + nameChunk2 + '.pkl'
-input = open(picklefile1, 'rb')
-sData1 = pickle.load(input)
-input = open(picklefile2, 'rb')
-sData2 = pickle.load(input)
+nameChunk1 = 'Prostate-51-fullModel-MinLOT-0.02-minAvgLot-0.17-vxls-1385-ntnsty-700'
+nameChunk2 = 'Prostate-51-fullModel-MinLOT-0.02-minAvgLot-0.17-vxls-16677-ntnsty-700'
+# Runs written before the results store only have their pickleresults file
+def loadApertures(nameChunk):
+    if os.path.exists(resultsDirectory(nameoutputdirectory) + nameChunk):
+        return(loadRunApertures(resultsDirectory(nameoutputdirectory), nameChunk))
+    input = open(nameoutputdirectory + 'pickleresults-' + nameChunk + '.pkl', 'rb')
+    return(pickle.load(input)['t'])
 
-t1 = sData1['t']
-t2 = sData2['t']
+if allPairs:
+    similarity = similarityMatrix(nameoutputdirectory, numworkers)
+    plotSimilarityMatrix(similarity, nameoutputdirectory + 'Sinogram-Similarity.pdf')
+    sys.exit()
+
+t1 = loadApertures(nameChunk1)
+t2 = loadApertures(nameChunk2)
 L = 64
 #plotSinogramIndependent(t1, L, nameChunk1, nameoutputdirectory)
 #plotSinogramIndependent(t2, L, nameChunk2, nameoutputdirectory)
 
-#bothOn = [[max(first[0], second[0]), min(first[1], second[1])] for first in t1 for second in t2 if max(first[0], second[0]) <= min(first[1], second[1])]
 myeps = 0.001
-def range_diff(r1, r2):
-    s1, e1 = r1
-    s2, e2 = r2
-    endpoints = sorted((s1, s2, e1, e2))
-    result = []
-    if endpoints[0] == s1 and (endpoints[1] - endpoints[0]) > myeps:
-        result.append((endpoints[0], endpoints[1]))
-    if endpoints[3] == e1 and (endpoints[3] - endpoints[2]) > myeps:
-        result.append((endpoints[2], endpoints[3]))
-    return result
-
+## Parts of the intervals of r1_list that are not in any interval of r2_list, without the parts shorter than myeps
 def multirange_diff(r1_list, r2_list):
-    for r2 in r2_list:
-        r1_list = list(itertools.chain(*[range_diff(r1, r2) for r1 in r1_list]))
-    return r1_list
+    plans = [aperturesFromIntervals([list(r1_list)]), aperturesFromIntervals([list(r2_list)])]
+    apertures = difference(sweepIntervals(plans), 0, [1], myeps)
+    return([(begin, end) for begin, end in zip(apertures['begin'], apertures['end'])])
 
 r1_list = [(1, 1001), (1100, 1201)]
 r2_list = [(30, 51), (60, 201), (1150, 1301)]
 print(multirange_diff(r1_list, r2_list))
 
-firstOnly = []
-secondOnly = []
-bothOn = []
-for l in range(L):
-    firstOnly.append(multirange_diff(t1[l], t2[l]))
-    secondOnly.append(multirange_diff(t2[l], t1[l]))
-    if len(t1[l]) > 0 and len(t2[l]) > 0:
-        bothOn.append([[max(first[0], second[0]), min(first[1], second[1])] for first in t1[l] for second in t2[l] if max(first[0], second[0]) <= min(first[1], second[1])])
-    else:
-        bothOn.append([])
+# One sweep over the apertures of both plans gives the times of every leaf when only the first, only the second or both
+# are open
+apertures1 = aperturesFromIntervals(t1)
+apertures2 = aperturesFromIntervals(t2)
+sweep = sweepIntervals([apertures1, apertures2])
+firstOnly = difference(sweep, 0, [1], myeps)
+secondOnly = difference(sweep, 1, [0], myeps)
+bothOn = intersection(sweep)
+overlap = overlapMetrics(sweep, L)
+print('Shared open time:', overlap['sharedTime'].sum(), 'of', overlap['unionTime'].sum(), 'seconds. Mean Jaccard index of',
+      'the leaves:', np.nanmean(overlap['jaccard']) if np.any(overlap['unionTime'] > 0) else np.nan)
 
+## Draw the aperture arrays (of intervalSweep) of the times when only the first plan, only the second plan or both are
+# open
 def plotSinogramIndependentMixed(firstOnly, secondOnly, middleOnly, L, nameChunk1, nameChunk2, outputDirectory):
-    plt.figure()
-    ax = gca()
-    linesFirst = []
-    linesSecond = []
-    linesMiddle = []
-    for l in range(L):
-        for aperture in range(len(firstOnly[l])):
-            a, b = firstOnly[l][aperture]
-            linesFirst.append([(a, l), (b, l)])
-        for aperture in range(len(secondOnly[l])):
-            a, b = secondOnly[l][aperture]
-            linesSecond.append([(a, l), (b, l)])
-        for aperture in range(len(middleOnly[l])):
-            a, b = middleOnly[l][aperture]
-            linesMiddle.append([(a, l), (b, l)])
+    linesFirst, linesSecond, linesMiddle = [np.stack([np.column_stack([a['begin'], a['leaf']]),
+                                                      np.column_stack([a['end'], a['leaf']])], axis=1)
+                                            for a in [firstOnly, secondOnly, middleOnly]]
     lc = mc.LineCollection(linesFirst, linewidths = 3, colors = 'red')
     rc = mc.LineCollection(linesSecond, linewidths = 3, colors = 'blue')
     middlec = mc.LineCollection(linesMiddle, linewidths = 3, colors = 'purple')
@@ -129,5 +122,11 @@ def plotSinogramIndependentMixed(firstOnly, secondOnly, middleOnly, L, nameChunk
         labelbottom=True)  #
     ax.set_yticklabels([])
     plt.savefig(outputDirectory + 'Sinogram-Comparison-FullModelvspairModel.pdf', format = 'pdf')
+    plt.close(fig)
 
-plotSinogramIndependentMixed(firstOnly, secondOnly, bothOn, L, nameChunk1, nameChunk2, nameoutputdirectory)
\ No newline at end of file
+if rasterSinogram:
+    plotSinogramRasterComparison(apertures1, apertures2, L,
+                                 nameoutputdirectory + 'Sinogram-Comparison-FullModelvspairModel.png',
+                                 'Sinograms of Low Resolution Model (red) vs. Full Resolution Model (blue)')
+else:
+    plotSinogramIndependentMixed(firstOnly, secondOnly, bothOn, L, nameChunk1, nameChunk2, nameoutputdirectory)
\ No newline at end of file
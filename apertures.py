@@ -0,0 +1,129 @@
+# Aperture extraction from the (numProjections, L) arrays of a plan. The openings of every leaf are found at once with
+# edge detection over the projections instead of a walk over every leaf and projection. The result is a structured
+# array with one (leaf, begin, end) row per aperture, sorted by leaf and by time, in the same order as the [begin, end]
+# lists of calculateT.
+import numpy as np
+from resultStore import APERTUREDTYPE, intervalsFromApertures
+
+## Build the structured array from the leaf, the projection that opened it (only used for the order), the beginning and
+# the end of every aperture
+def sortedApertures(leaves, projections, begins, ends):
+    order = np.lexsort((projections, leaves))
+    apertures = np.zeros(len(order), dtype=APERTUREDTYPE)
+    apertures['leaf'] = np.asarray(leaves)[order]
+    apertures['begin'] = np.asarray(begins)[order]
+    apertures['end'] = np.asarray(ends)[order]
+    return(apertures)
+
+## IMRT plans (calculateTIMRT). Every projection with a positive opening time opens the leaf at the beginning of the
+# projection. The projections are read in pairs, so with an odd number of projections the last one is not used.
+def imrtApertures(tim, t51):
+    numProjections = tim.shape[0]
+    used = np.zeros(tim.shape, dtype=bool)
+    used[:numProjections - numProjections % 2, :] = True
+    p, l = np.nonzero(used & (tim > 0))
+    begins = t51 * p
+    return(sortedApertures(l, p, begins, begins + tim[p, l]))
+
+## Plans of the pair model (calculateTpairSolution). An opening in the even projection p spans the boundary with p + 1:
+# it starts tim[p] before the boundary and ends tim[p + 1] after it. An opening in a last even projection starts at the
+# beginning of the projection (the loop version indexed the aperture list there instead of tim).
+def pairApertures(tim, gamma, t51):
+    numProjections = tim.shape[0]
+    opens = np.zeros(tim.shape, dtype=bool)
+    opens[0:numProjections:2, :] = gamma[0:numProjections:2, :] != 0
+    p, l = np.nonzero(opens)
+    last = p == numProjections - 1
+    middle = t51 * (p + 1)
+    begins = np.where(last, t51 * p, middle - tim[p, l])
+    ends = np.where(last, t51 * p + tim[p, l], middle + tim[np.minimum(p + 1, numProjections - 1), l])
+    return(sortedApertures(l, p, begins, ends))
+
+## Walk of calculateT over the projections of one leaf. Returns the projection that opened each aperture, its beginning
+# and its end. Used for the leaves where the openings overlap, which the vectorized version does not handle.
+def fullLeafApertures(tim, elittle, mlittle, blittle, t51):
+    numProjections = len(tim)
+    result = []
+    continuousopening = False
+    for p in range(numProjections):
+        timeleft = t51 * p
+        timeright = t51 * (p + 1)
+        if continuousopening:
+            if p == numProjections - 1 or 1 == blittle[p]:
+                result.append((start, beginningtime, timeleft + tim[p]))
+                continuousopening = False
+            elif 0 == mlittle[p + 1] + blittle[p + 1]:
+                result.append((start, beginningtime, timeright))
+                continuousopening = False
+        elif 1 == elittle[p] and (tim[p] > 0 or p == numProjections - 1):
+            if p == numProjections - 1 or 0 == mlittle[p + 1] + blittle[p + 1]:
+                # If it closed right now it HAS to be centered
+                midtime = timeleft + t51 / 2.0
+                result.append((p, midtime - tim[p] / 2.0, midtime + tim[p] / 2.0))
+            else:
+                start = p
+                beginningtime = timeright - tim[p]
+                continuousopening = True
+    return(result)
+
+## Plans of the full model (calculateT). An opening event (elittle) followed by a closed projection is centered in its
+# projection. Otherwise the leaf opens tim[p] before the end of the projection and stays open until the first
+# projection q that closes it (blittle, where it stays open tim[q]) or that is followed by a closed projection (where it
+# stays open until the end of q).
+def fullApertures(tim, elittle, mlittle, blittle, t51):
+    numProjections, L = tim.shape
+    index = np.arange(numProjections)[:, None]
+    nextMB = np.zeros(tim.shape)
+    nextMB[:-1, :] = mlittle[1:, :] + blittle[1:, :]
+    notLast = index < numProjections - 1
+    closes = (1 == blittle) | (0 == nextMB) | ~notLast
+    opens = (1 == elittle) & (tim > 0) & notLast
+    longOpen = opens & (0 != nextMB)
+    centered = (opens & (0 == nextMB)) | ((1 == elittle) & ~notLast)
+    # First projection at or after each projection that closes an opening
+    nextClose = np.minimum.accumulate(np.where(closes, index, numProjections)[::-1, :], axis=0)[::-1, :]
+    closedAt = np.full(tim.shape, -1)
+    closedAt[:-1, :] = nextClose[1:, :]
+    # An opening inside the aperture of an earlier opening is ignored by calculateT. Those leaves are walked instead
+    lastLongOpen = np.maximum.accumulate(np.where(longOpen, index, -1), axis=0)
+    previousLongOpen = np.full(tim.shape, -1)
+    previousLongOpen[1:, :] = lastLongOpen[:-1, :]
+    previousEnd = np.where(previousLongOpen >= 0, np.take_along_axis(closedAt, np.maximum(previousLongOpen, 0), axis=0), -1)
+    overlapping = ((longOpen | centered) & (index <= previousEnd)).any(axis=0)
+    fast = ~overlapping[None, :]
+    p, l = np.nonzero(longOpen & fast)
+    q = closedAt[p, l]
+    longEnds = np.where((1 == blittle[q, l]) | (q == numProjections - 1), t51 * q + tim[q, l], t51 * (q + 1))
+    pc, lc = np.nonzero(centered & fast)
+    midtime = t51 * pc + t51 / 2.0
+    leaves = [l, lc]
+    projections = [p, pc]
+    begins = [t51 * (p + 1) - tim[p, l], midtime - tim[pc, lc] / 2.0]
+    ends = [longEnds, midtime + tim[pc, lc] / 2.0]
+    for leaf in np.nonzero(overlapping)[0]:
+        walked = fullLeafApertures(tim[:, leaf], elittle[:, leaf], mlittle[:, leaf], blittle[:, leaf], t51)
+        leaves.append(np.full(len(walked), leaf))
+        projections.append(np.array([w[0] for w in walked], dtype=int))
+        begins.append(np.array([w[1] for w in walked], dtype=float))
+        ends.append(np.array([w[2] for w in walked], dtype=float))
+    return(sortedApertures(np.concatenate(leaves), np.concatenate(projections), np.concatenate(begins),
+                           np.concatenate(ends)))
+
+## Statistics of the apertures that the sinogram functions report: number of apertures, total, average, minimum
+# (ignoring openings shorter than a microsecond) and maximum length and the modulation factor
+def apertureStatistics(apertures):
+    lengths = apertures['end'] - apertures['begin']
+    n = len(lengths)
+    stats = {'n': n, 'totalLength': lengths.sum(), 'minLength': 1000.0, 'maxLength': -1.0,
+             'avLength': np.nan, 'modFactor': np.nan}
+    if n > 0:
+        stats['maxLength'] = lengths.max()
+        stats['avLength'] = stats['totalLength'] / n
+        stats['modFactor'] = stats['maxLength'] / stats['avLength']
+    if np.any(lengths > 0.000001):
+        stats['minLength'] = min(lengths[lengths > 0.000001].min(), 1000.0)
+    return(stats)
+
+## The apertures as the [t, leavelengths] pair that the calculateT functions return
+def aperturesAsLists(apertures, L):
+    return([intervalsFromApertures(apertures, L), list(apertures['end'] - apertures['begin'])])
@@ -0,0 +1,49 @@
+# Content-addressed cache of the Dij triplets of a case. The pickled tomodata objects keep only the key of their
+# triplets, so that the many pickles of a sweep over the same case do not carry their own copy. The arrays are read
+# back (memory mapped) from the cache when they are needed.
+import os
+import hashlib
+import numpy as np
+
+CASEARRAYS = ('bixels', 'smallvoxels', 'Dijs')
+CACHEFOLDER = 'caseCache/'
+
+## Key of a list of arrays. It depends on their contents, dtypes and shapes
+def caseKey(arrays):
+    h = hashlib.blake2b(digest_size = 20)
+    for array in arrays:
+        array = np.ascontiguousarray(array)
+        h.update((str(array.dtype) + str(array.shape)).encode())
+        h.update(array)
+    return(h.hexdigest())
+
+## Folder of the cache of the runs that write to outputDirectory
+def caseDirectory(outputDirectory):
+    return(outputDirectory + CACHEFOLDER)
+
+def casePath(directory, key, name):
+    return(directory + key + '-' + name + '.npy')
+
+## Write the arrays (a dictionary by name) under key, unless they are already there. Each file is written under a
+# temporary name and then renamed, so that runs of a sweep that share the case can store it at the same time.
+def storeCase(directory, key, arrays):
+    if not os.path.exists(directory):
+        os.makedirs(directory, exist_ok = True)
+    for name, array in arrays.items():
+        path = casePath(directory, key, name)
+        if os.path.exists(path):
+            continue
+        temporary = path + '.' + str(os.getpid()) + '.tmp'
+        with open(temporary, 'wb') as f:
+            np.save(f, array)
+        os.replace(temporary, path)
+
+## Memory map the arrays stored under key
+def loadCase(directory, key, names = CASEARRAYS):
+    arrays = dict()
+    for name in names:
+        path = casePath(directory, key, name)
+        if not os.path.exists(path):
+            raise IOError('the case ' + key + ' is not in the cache ' + directory)
+        arrays[name] = np.load(path, mmap_mode = 'r')
+    return(arrays)
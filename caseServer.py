@@ -0,0 +1,141 @@
+# Shared memory copies of a preprocessed case. One process (OrganizedmultiTool.py with caseServer = 'serve') reads and
+# preprocesses the case once, copies the arrays of its tomodata object into multiprocessing.shared_memory blocks and
+# writes a manifest (the other attributes of the object and the name, dtype and shape of every block) to
+# outputDirectory/caseServer/. The runs with caseServer = 'attach' and the same case settings map those blocks read only
+# instead of reading the case, so the runs of a sweep on one node share a single copy of the triplets. The blocks live
+# until the server is stopped (SIGTERM or Ctrl-C).
+import os
+import sys
+import time
+import pickle
+import signal
+import socket
+import hashlib
+import numpy as np
+from multiprocessing import shared_memory, resource_tracker
+
+SERVERFOLDER = 'caseServer/'
+READYMESSAGE = 'Case server ready:'
+# Blocks opened by this process. They stay open as long as the arrays that use them
+attachedBlocks = []
+
+## Key of the settings that decide the preprocessed case (a dictionary of scalars). The host is part of it because the
+# blocks only exist on the machine of the server
+def serverKey(settings):
+    h = hashlib.blake2b(digest_size = 8)
+    h.update(repr(sorted(settings.items())).encode())
+    h.update(socket.gethostname().encode())
+    return(h.hexdigest())
+
+def manifestPath(outputDirectory, key):
+    return(outputDirectory + SERVERFOLDER + key + '.pkl')
+
+def blockName(key, name):
+    return('tomo-' + key + '-' + name)
+
+## Whether the process pid is running
+def isRunning(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return(False)
+    except PermissionError:
+        pass
+    return(True)
+
+## Open an existing block without taking its ownership: the block must survive the runs that attach to it
+def openBlock(name):
+    try:
+        return(shared_memory.SharedMemory(name = name, track = False))
+    except TypeError:
+        # Before python 3.13 every process that opens a block unlinks it when it exits, unless it is unregistered
+        block = shared_memory.SharedMemory(name = name)
+        resource_tracker.unregister(block._name, 'shared_memory')
+        return(block)
+
+## Close and remove blocks
+def releaseBlocks(blocks):
+    for block in blocks:
+        block.close()
+        try:
+            block.unlink()
+        except FileNotFoundError:
+            pass
+
+## Copy the arrays (a dictionary by name) into new blocks. A block left by a server that was killed is replaced.
+# Returns the blocks and the (block name, dtype, shape) of every array
+def publishArrays(key, arrays):
+    blocks = []
+    layout = dict()
+    try:
+        for name, array in arrays.items():
+            array = np.ascontiguousarray(array)
+            try:
+                block = shared_memory.SharedMemory(name = blockName(key, name), create = True, size = max(array.nbytes, 1))
+            except FileExistsError:
+                releaseBlocks([openBlock(blockName(key, name))])
+                block = shared_memory.SharedMemory(name = blockName(key, name), create = True, size = max(array.nbytes, 1))
+            blocks.append(block)
+            np.ndarray(array.shape, dtype = array.dtype, buffer = block.buf)[...] = array
+            layout[name] = (block.name, array.dtype.str, array.shape)
+    except BaseException:
+        releaseBlocks(blocks)
+        raise
+    return(blocks, layout)
+
+## Read only views of the arrays of a manifest
+def attachArrays(layout):
+    arrays = dict()
+    for name, (shmName, dtype, shape) in layout.items():
+        block = openBlock(shmName)
+        attachedBlocks.append(block)
+        array = np.ndarray(shape, dtype = np.dtype(dtype), buffer = block.buf)
+        array.flags.writeable = False
+        arrays[name] = array
+    return(arrays)
+
+## Publish a case and serve it until the process is stopped. state is a dictionary of the attributes that are not
+# shared, arrays a dictionary of the arrays to share. Raises RuntimeError if a server of the same key is running
+def serveCase(outputDirectory, key, state, arrays):
+    path = manifestPath(outputDirectory, key)
+    if os.path.exists(path):
+        with open(path, 'rb') as f:
+            pid = pickle.load(f)['pid']
+        if isRunning(pid):
+            raise RuntimeError('the case server ' + str(pid) + ' already serves ' + key)
+    os.makedirs(outputDirectory + SERVERFOLDER, exist_ok = True)
+    # SIGTERM ends the process like Ctrl-C, so that the blocks are removed
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    blocks, layout = publishArrays(key, arrays)
+    try:
+        temporary = path + '.' + str(os.getpid()) + '.tmp'
+        with open(temporary, 'wb') as f:
+            pickle.dump({'pid': os.getpid(), 'state': state, 'arrays': layout}, f)
+        os.replace(temporary, path)
+        print(READYMESSAGE, key, 'shares', sum(block.size for block in blocks) / 2.0**20, 'MB in', len(blocks),
+              'blocks', flush = True)
+        while True:
+            time.sleep(3600)
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    finally:
+        if os.path.exists(path):
+            os.remove(path)
+        releaseBlocks(blocks)
+    print('Case server', key, 'stopped')
+
+## The (state, arrays) of the case published under key, or None if no server of this machine publishes it
+def attachCase(outputDirectory, key):
+    path = manifestPath(outputDirectory, key)
+    if not os.path.exists(path):
+        return(None)
+    with open(path, 'rb') as f:
+        manifest = pickle.load(f)
+    if not isRunning(manifest['pid']):
+        return(None)
+    try:
+        arrays = attachArrays(manifest['arrays'])
+    except FileNotFoundError:
+        # The server stopped after the manifest was read
+        return(None)
+    return(manifest['state'], arrays)
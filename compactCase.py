@@ -0,0 +1,123 @@
+# Compact storage format for the Dij cases produced by Weiguo.
+# The raw case stores int32 bixels, int32 CT-grid voxels and float32 doses, that is 12 bytes per nonzero. The compact
+# case stores the triplets sorted by voxel in the folder dij/compact/ of the case:
+#  - Leaves.bin       uint8   leaf of the bixel (bixel % L)
+#  - Projections.bin  uint16  projection of the bixel (bixel // L)
+#  - VoxelDeltas.bin  uint8   difference with the voxel of the previous triplet. 255 means that the difference did not
+#                             fit, and it is the next entry of VoxelJumps.bin (uint32) instead
+#  - Doses.bin        uint16  dose quantized as round(dose / dose_scale)
+#  - compact.header   the number of triplets, L, dose_scale and dose_error_bound
+# That is 6 bytes per nonzero. Leaves, projections and voxels are exact. Every dose is within dose_error_bound of the
+# original value: half of dose_scale = (largest dose) / 65535, plus the float32 rounding of the decoded dose.
+import os
+import sys
+import numpy as np
+
+ESCAPE = 255
+
+## Write the compact version of the case in base_dir (the folder that contains the dij folder)
+def writeCompactCase(base_dir, L = 64):
+    bixels = np.fromfile(base_dir + 'dij/Bixels_out.bin', dtype=np.int32)
+    voxels = np.fromfile(base_dir + 'dij/Voxels_out.bin', dtype=np.int32)
+    Dijs = np.fromfile(base_dir + 'dij/Dijs_out.bin', dtype=np.float32)
+    order = np.lexsort((bixels, voxels))
+    bixels = bixels[order]
+    voxels = voxels[order].astype(np.int64)
+    Dijs = Dijs[order]
+    projections = bixels // L
+    if projections.max() > np.iinfo(np.uint16).max:
+        sys.exit('ERROR, the projections do not fit in the compact format')
+    deltas = np.diff(voxels, prepend=0)
+    escaped = deltas >= ESCAPE
+    jumps = deltas[escaped].astype(np.uint32)
+    deltas[escaped] = ESCAPE
+    doseScale = float(Dijs.max()) / np.iinfo(np.uint16).max
+    if 0.0 == doseScale:
+        doseScale = 1.0
+    doses = np.round(Dijs.astype(np.float64) / doseScale).astype(np.uint16)
+    outdir = base_dir + 'dij/compact/'
+    if not os.path.exists(outdir):
+        os.makedirs(outdir)
+    (bixels % L).astype(np.uint8).tofile(outdir + 'Leaves.bin')
+    projections.astype(np.uint16).tofile(outdir + 'Projections.bin')
+    deltas.astype(np.uint8).tofile(outdir + 'VoxelDeltas.bin')
+    jumps.tofile(outdir + 'VoxelJumps.bin')
+    doses.tofile(outdir + 'Doses.bin')
+    # Half a quantization step, plus the rounding of the decoded dose to float32
+    errorBound = doseScale / 2.0 + float(Dijs.max()) * np.finfo(np.float32).eps
+    with open(outdir + 'compact.header', 'w') as header:
+        header.write('triplets = ' + str(len(bixels)) + '\n')
+        header.write('L = ' + str(L) + '\n')
+        header.write('dose_scale = ' + repr(doseScale) + '\n')
+        header.write('dose_error_bound = ' + repr(errorBound) + '\n')
+    measured = np.abs((doses * doseScale).astype(np.float32) - Dijs).max()
+    print('Compact case written to', outdir, 'with', len(bixels), 'triplets. Dose error bound:', errorBound,
+          'largest measured error:', measured)
+    return(outdir)
+
+## Read the header of a compact case
+def readCompactHeader(directory):
+    header = dict()
+    with open(directory + 'compact.header', 'r') as f:
+        for line in f:
+            if ' = ' in line:
+                key, value = line.split(' = ')
+                header[key] = value.rstrip()
+    return(header)
+
+## True if the case in base_dir has a compact version
+def hasCompactCase(base_dir):
+    return(os.path.exists(base_dir + 'dij/compact/compact.header'))
+
+## Read a compact case and return the bixels, voxels and Dijs arrays with the same dtypes as the raw case (the triplets
+# are sorted by voxel). The dose quantization error bound is in the header.
+def readCompactCase(base_dir):
+    directory = base_dir + 'dij/compact/'
+    header = readCompactHeader(directory)
+    L = int(header['L'])
+    leaves = np.fromfile(directory + 'Leaves.bin', dtype=np.uint8)
+    projections = np.fromfile(directory + 'Projections.bin', dtype=np.uint16)
+    deltas = np.fromfile(directory + 'VoxelDeltas.bin', dtype=np.uint8).astype(np.int64)
+    jumps = np.fromfile(directory + 'VoxelJumps.bin', dtype=np.uint32)
+    doses = np.fromfile(directory + 'Doses.bin', dtype=np.uint16)
+    deltas[ESCAPE == deltas] = jumps
+    voxels = np.cumsum(deltas).astype(np.int32)
+    bixels = projections.astype(np.int32) * L + leaves
+    Dijs = (doses * float(header['dose_scale'])).astype(np.float32)
+    print('Read compact case with', header['triplets'], 'triplets. Dose error bound:', header['dose_error_bound'])
+    return(bixels, voxels, Dijs)
+
+## Decode a compact case chunk by chunk from memory maps of its files. Yields bixels, voxels and Dijs arrays of at most
+# chunkTriplets triplets each, so that the whole case is never in memory.
+def compactTripletChunks(base_dir, chunkTriplets = 1 << 22):
+    directory = base_dir + 'dij/compact/'
+    header = readCompactHeader(directory)
+    L = int(header['L'])
+    doseScale = float(header['dose_scale'])
+    triplets = int(header['triplets'])
+    if 0 == triplets:
+        return
+    leaves = np.memmap(directory + 'Leaves.bin', dtype=np.uint8, mode='r')
+    projections = np.memmap(directory + 'Projections.bin', dtype=np.uint16, mode='r')
+    deltas = np.memmap(directory + 'VoxelDeltas.bin', dtype=np.uint8, mode='r')
+    jumps = np.fromfile(directory + 'VoxelJumps.bin', dtype=np.uint32)
+    doses = np.memmap(directory + 'Doses.bin', dtype=np.uint16, mode='r')
+    # Voxel of the last triplet of the previous chunk and number of jumps used so far
+    voxel = 0
+    usedJumps = 0
+    for begin in range(0, triplets, chunkTriplets):
+        end = min(begin + chunkTriplets, triplets)
+        chunkDeltas = deltas[begin:end].astype(np.int64)
+        escaped = ESCAPE == chunkDeltas
+        numJumps = int(escaped.sum())
+        chunkDeltas[escaped] = jumps[usedJumps:usedJumps + numJumps]
+        usedJumps += numJumps
+        voxels = voxel + np.cumsum(chunkDeltas)
+        voxel = int(voxels[-1])
+        bixels = projections[begin:end].astype(np.int32) * L + leaves[begin:end]
+        yield([bixels, voxels.astype(np.int32), (doses[begin:end] * doseScale).astype(np.float32)])
+
+# Convert the cases given in the command line, for example: python compactCase.py data/dij/prostate/
+if __name__ == '__main__':
+    for case in sys.argv[1:]:
+        writeCompactCase(case)
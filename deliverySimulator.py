@@ -0,0 +1,125 @@
+# Simulation of the delivery of a sinogram. The opening intervals of the leaves (the aperture arrays of apertures.py)
+# are integrated against the rotation of the gantry to get the fluence that every (projection, leaf) beamlet actually
+# receives, and the delivered dose follows through the Dij. Two models of the rotation are available:
+#  - 'window': the open time counts for the projection during which it happens. It gives back t_out for the plans whose
+#    openings stay where the model put them.
+#  - 'gantry': the Dij of a projection is computed at its central angle, and the gantry keeps turning while the leaf is
+#    open. Open time at a fraction of the way between two central angles is shared linearly between both projections.
+# Every aperture contributes the difference of a cumulative kernel at its two ends, so all the apertures of a plan are
+# handled with a few array operations. The runs report the projection where the delivered fluence departs the most from
+# the plan and its central angle, from the speed of the gantry.
+import sys
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from resultStore import resultsDirectory, loadRunArray
+from resultsCatalog import resultsCatalog
+from doseOperator import batchPenalty
+from planRescoring import readRun, caseDoses
+from planMetrics import writeTable
+
+SIMULATIONFILE = 'deliverySimulation.csv'
+# Cumulative kernel of each model, the offset (in projections) of the time at which a projection starts counting and
+# the support of the kernel: C(y) = 0 for y <= left and 1 for y >= right
+KERNELS = {'window': (0.0, 0.0, 1.0), 'gantry': (-0.5, -1.0, 1.0)}
+
+def cumulativeKernel(model, y):
+    if 'window' == model:
+        return(np.clip(y, 0.0, 1.0))
+    y = np.clip(y, -1.0, 1.0)
+    return(np.where(y < 0.0, 0.5 * np.square(y + 1.0), 1.0 - 0.5 * np.square(1.0 - y)))
+
+## Fluence (numProjections, L) delivered by the apertures of a plan whose projections last t51 seconds. apertures can
+# also be a dictionary with the leaf, begin and end arrays
+def deliveredFluence(apertures, numProjections, L, t51, model = 'gantry'):
+    offset, left, right = KERNELS[model]
+    fluence = np.zeros((numProjections, L))
+    # Projections at or before which an aperture end has fully counted, as a difference array over the projections
+    full = np.zeros((numProjections + 1, L))
+    leaves = np.concatenate([apertures['leaf'], apertures['leaf']]).astype(np.intp)
+    x = np.concatenate([apertures['end'], apertures['begin']]) / t51 + offset
+    n = len(apertures['leaf'])
+    sign = np.concatenate([np.ones(n), -np.ones(n)])
+    lastFull = np.floor(x - right).astype(np.intp)
+    inside = lastFull >= 0
+    np.add.at(full, (np.minimum(lastFull[inside], numProjections - 1) + 1, leaves[inside]), -sign[inside])
+    np.add.at(full, (np.zeros(int(inside.sum()), dtype=np.intp), leaves[inside]), sign[inside])
+    fluence += np.cumsum(full, axis=0)[:numProjections]
+    # The projections where the kernel is partial
+    for shift in range(int(np.ceil(right - left))):
+        p = lastFull + 1 + shift
+        valid = (p >= 0) & (p < numProjections)
+        np.add.at(fluence, (p[valid], leaves[valid]), sign[valid] * cumulativeKernel(model, x[valid] - p[valid]))
+    return(t51 * fluence)
+
+## Angle of the gantry at the center of every projection, in degrees, for numProjections of t51 seconds at speed
+# degrees per second. The first k10 projections are the ghost projections before the treatment starts
+def projectionAngles(numProjections, t51, speed, k10):
+    return(np.mod((np.arange(numProjections) - k10 + 0.5) * t51 * speed, 360.0))
+
+## Projection with the largest fluence gap (over its leaves) between the delivered fluence and t_out, and its angle
+def worstProjection(fluence, t_out, t51, speed, k10):
+    p = int(np.argmax(np.abs(fluence - t_out).sum(axis=1)))
+    return(p, projectionAngles(len(t_out), t51, speed, k10)[p])
+
+## Differences between the planned doses Z (voxels, plans) and the delivered doses W
+def doseGap(Z, W):
+    difference = W - Z
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return({'maxDoseGap': np.abs(difference).max(axis=0) if len(Z) > 0 else np.zeros(Z.shape[1]),
+                'relativeDoseGap': np.linalg.norm(difference, axis=0) / np.linalg.norm(Z, axis=0)})
+
+## Delivered fluence and dose of one plan, with D the sparse dose matrix of doseOperator.buildDoseMatrix
+def simulatePlan(D, apertures, numProjections, L, t51, yBar, model = 'gantry'):
+    fluence = deliveredFluence(apertures, numProjections, L, t51, model)
+    return(fluence, yBar * D.dot(np.ravel(fluence)))
+
+## Simulate the delivery of the stored runs that match query (the parameters of resultsCatalog.query) with a model of
+# KERNELS. The planned doses come from t_out and the delivered ones from the apertures, both with one sparse product per
+# case. Writes the gaps, the projection with the largest fluence gap and its angle for a gantry turning speed degrees
+# per second, and the objectives under the stored penalty table to outputDirectory/deliverySimulation.csv
+def simulateRuns(outputDirectory = 'outputMultiProj/', model = 'gantry', numthreads = 8, speed = 24, **query):
+    catalog = resultsCatalog(outputDirectory, numthreads)
+    entries = [entry for entry in catalog.query(kind = 'store', **query)]
+    runs = [future.result() for future in
+            [catalog.executor.submit(readRun, outputDirectory, entry['chunkName']) for entry in entries]]
+    catalog.shutdown()
+    directory = resultsDirectory(outputDirectory)
+    groups = dict()
+    for i, (t_out, _, _, info) in enumerate(runs):
+        if 'apertures' in info['arrays']:
+            groups.setdefault((info['parameters']['caseKey'], t_out.shape), []).append(i)
+    executor = ThreadPoolExecutor(max_workers = numthreads)
+    rows = []
+    for members in groups.values():
+        delivered = []
+        for i in members:
+            t_out, mask, table, info = runs[i]
+            parameters = info['parameters']
+            apertures = loadRunArray(directory, entries[i]['chunkName'], 'apertures', mmap = False)
+            fluence = deliveredFluence(apertures, t_out.shape[0], parameters['L'], parameters['t51'], model)
+            delivered.append((fluence, mask, table, info))
+        # Planned and delivered doses of the group in the same product
+        doses = caseDoses(outputDirectory, [runs[i] for i in members] + delivered, executor, numthreads)
+        Z = doses[:, :len(members)]
+        W = doses[:, len(members):]
+        gap = doseGap(Z, W)
+        for j, i in enumerate(members):
+            t_out, mask, table, info = runs[i]
+            parameters = info['parameters']
+            projection, angle = worstProjection(delivered[j][0], t_out, parameters['t51'], speed, parameters['k10'])
+            row = {'runName': entries[i]['chunkName'], 'model': model,
+                   'fluenceGap': np.abs(delivered[j][0] - t_out).sum(), 'maxDoseGap': gap['maxDoseGap'][j],
+                   'relativeDoseGap': gap['relativeDoseGap'][j], 'worstProjection': projection, 'worstAngle': angle,
+                   'plannedObjVal': np.nan, 'deliveredObjVal': np.nan}
+            if table is not None:
+                for name, dose in [('plannedObjVal', Z[:, j]), ('deliveredObjVal', W[:, j])]:
+                    row[name] = batchPenalty(dose[:, None], table[0][mask], table[1][mask], table[2][mask])[0][0]
+            rows.append(row)
+    executor.shutdown()
+    writeTable(outputDirectory + SIMULATIONFILE, rows)
+    print('Delivery of', len(rows), 'runs simulated with the', model, 'model')
+    return(rows)
+
+# Simulate the delivery of the stored runs: python deliverySimulator.py [outputDirectory] [window|gantry]
+if __name__ == '__main__':
+    simulateRuns(*sys.argv[1:3])
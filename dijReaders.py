@@ -0,0 +1,140 @@
+# Readers for the Dij triplets (Bixels_out.bin, Voxels_out.bin, Dijs_out.bin) and masks of a case that do not go
+# through getvector: a streaming reader for compressed archives and a parallel chunked reader for the raw files.
+import os
+import time
+import gzip
+import lzma
+import bz2
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+try:
+    import zstandard
+    have_zstd = True
+except ImportError:
+    have_zstd = False
+
+TRIPLETFILES = [('Bixels_out.bin', np.int32), ('Voxels_out.bin', np.int32), ('Dijs_out.bin', np.float32)]
+COMPRESSEDEXTENSIONS = ['.gz', '.xz', '.zst', '.bz2']
+
+## Open a compressed file for streaming according to its extension
+def openCompressed(path):
+    if path.endswith('.gz'):
+        return(gzip.open(path, 'rb'))
+    if path.endswith('.xz'):
+        return(lzma.open(path, 'rb'))
+    if path.endswith('.bz2'):
+        return(bz2.open(path, 'rb'))
+    if path.endswith('.zst'):
+        if not have_zstd:
+            raise ImportError('the zstandard module is needed to read ' + path)
+        return(zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'), closefd=True))
+    raise ValueError('unknown compression for ' + path)
+
+## Path of the compressed archive of the file name in the dij folder of base_dir, or None
+def compressedArchive(base_dir, name):
+    for extension in COMPRESSEDEXTENSIONS:
+        if os.path.exists(base_dir + 'dij/' + name + extension):
+            return(base_dir + 'dij/' + name + extension)
+    return(None)
+
+## True if the three triplet files of the case are only available compressed
+def hasCompressedCase(base_dir):
+    return(all(compressedArchive(base_dir, name) is not None for name, _ in TRIPLETFILES))
+
+## Read nbytes from a stream, or less only at the end of the stream
+def readExactly(stream, nbytes):
+    parts = []
+    remaining = nbytes
+    while remaining > 0:
+        part = stream.read(remaining)
+        if not part:
+            break
+        parts.append(part)
+        remaining -= len(part)
+    return(b''.join(parts))
+
+## Decode the compressed triplets of the case chunk by chunk. Yields bixels, voxels and Dijs arrays of at most
+# chunkTriplets triplets each.
+def compressedTripletChunks(base_dir, chunkTriplets = 1 << 22):
+    streams = [openCompressed(compressedArchive(base_dir, name)) for name, _ in TRIPLETFILES]
+    try:
+        while True:
+            chunks = []
+            for stream, (name, dtype) in zip(streams, TRIPLETFILES):
+                itemsize = np.dtype(dtype).itemsize
+                chunks.append(np.frombuffer(readExactly(stream, chunkTriplets * itemsize), dtype=dtype))
+            if len(set(len(chunk) for chunk in chunks)) > 1:
+                raise IOError('the triplet archives of ' + base_dir + ' have different lengths')
+            if 0 == len(chunks[0]):
+                break
+            yield(chunks)
+    finally:
+        for stream in streams:
+            stream.close()
+
+## Decode the compressed triplets of the case chunk by chunk and keep only the triplets whose voxel has keepVoxel True.
+# keepVoxel is a boolean array over the voxels of the big space (the subsampled mask without the removed structures),
+# so that this does the work of removezeroes on the fly. Returns bixels, voxels, Dijs and the boolean array of the
+# big space voxels that appear in the kept triplets.
+def streamCompressedCase(base_dir, keepVoxel, chunkTriplets = 1 << 22):
+    kept = [[], [], []]
+    seen = np.zeros(len(keepVoxel), dtype=bool)
+    total = 0
+    for chunks in compressedTripletChunks(base_dir, chunkTriplets):
+        total += len(chunks[0])
+        keep = keepVoxel[chunks[1]]
+        for i in range(3):
+            kept[i].append(chunks[i][keep])
+        seen[chunks[1][keep]] = True
+    bixels, voxels, Dijs = [np.concatenate(k) for k in kept]
+    print('Streamed', total, 'compressed triplets and kept', len(Dijs))
+    return(bixels, voxels, Dijs, seen)
+
+## Read nbytes of the file at path starting at offset into the writable memoryview view. Returns when it started and
+# finished.
+def readChunk(path, view, offset, nbytes):
+    start = time.time()
+    with open(path, 'rb', buffering=0) as f:
+        f.seek(offset)
+        got = 0
+        while got < nbytes:
+            n = f.readinto(view[got:nbytes])
+            if not n:
+                break
+            got += n
+    return(start, time.time())
+
+## Reads several binary files concurrently through a thread pool, in chunks aligned to chunkBytes. The reads start as
+# soon as the reader is created, so the caller can parse headers and decode masks while they run. files is a list of
+# (name, path, dtype) in the order in which they should be scheduled.
+class chunkedreader:
+    def __init__(self, files, numthreads = 8, chunkBytes = 64 << 20):
+        chunkBytes = max(4096, chunkBytes - chunkBytes % 4096)
+        self.executor = ThreadPoolExecutor(max_workers = numthreads)
+        self.arrays = dict()
+        self.futures = dict()
+        self.sizes = dict()
+        for name, path, dtype in files:
+            size = os.path.getsize(path)
+            itemsize = np.dtype(dtype).itemsize
+            array = np.empty(size // itemsize, dtype=dtype)
+            view = memoryview(array.view(np.uint8))
+            self.arrays[name] = array
+            self.sizes[name] = array.nbytes
+            self.futures[name] = [self.executor.submit(readChunk, path, view[offset:offset + chunkBytes], offset,
+                                                       min(chunkBytes, array.nbytes - offset))
+                                  for offset in range(0, array.nbytes, chunkBytes)]
+
+    ## Wait for the chunks of one file and return its array. Prints the throughput achieved for the file.
+    def result(self, name):
+        times = [future.result() for future in self.futures[name]]
+        elapsed = 0.0
+        if len(times) > 0:
+            elapsed = max(end for _, end in times) - min(start for start, _ in times)
+        megabytes = self.sizes[name] / float(1 << 20)
+        print('Read', name, ':', megabytes, 'MB in', elapsed, 'seconds (', megabytes / max(elapsed, 1e-9), 'MB/s) in',
+              len(times), 'chunks')
+        return(self.arrays[name])
+
+    def shutdown(self):
+        self.executor.shutdown()
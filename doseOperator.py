@@ -0,0 +1,156 @@
+# Sparse dose deposition tools shared by the solvers that work outside of GUROBI.
+import numpy as np
+import scipy.sparse as sps
+
+## Build the sparse dose deposition matrix of a tomodata object. Rows are the small voxels and columns are the beamlets
+# in (projection, leaf) order, so that a fluence map t of shape (numProjections, L) is applied as D.dot(t.ravel()).
+# The first k10 projections are the ghost projections and they receive no columns with data.
+def buildDoseMatrix(data, numProjections, k10):
+    return(doseMatrixFromTriplets(data.bixels, data.smallvoxels, data.Dijs, data.L, data.totalsmallvoxels,
+                                  numProjections, k10))
+
+## Same matrix from the triplets of a case (for example the arrays of the case cache)
+def doseMatrixFromTriplets(bixels, smallvoxels, Dijs, L, totalsmallvoxels, numProjections, k10):
+    bixels = np.asarray(bixels, dtype=np.int64)
+    columns = (bixels // L + k10) * L + bixels % L
+    D = sps.csr_matrix((np.asarray(Dijs), (np.asarray(smallvoxels), columns)), shape=(totalsmallvoxels, numProjections * L))
+    D.sum_duplicates()
+    return(D)
+
+## Dose to every small voxel produced by the fluence map t (numProjections x L)
+def doseFromFluence(D, t, yBar):
+    return(yBar * D.dot(np.ravel(t)))
+
+## Piecewise quadratic penalty of solveModel. Returns the objective value and the gradient with respect to the doses z
+def voxelPenalty(z, data):
+    diff = z - data.quadHelperThresh
+    zplus = np.maximum(diff, 0.0)
+    zminus = np.maximum(-diff, 0.0)
+    objVal = np.dot(data.quadHelperUnder, zminus * zminus) + np.dot(data.quadHelperOver, zplus * zplus)
+    grad = 2.0 * (data.quadHelperOver * zplus - data.quadHelperUnder * zminus)
+    return(objVal, grad)
+
+## Piecewise quadratic penalty of many dose vectors at once. Z is (voxels, plans) and thresh, under and over are the
+# per voxel parameters, either (voxels,) or (voxels, plans). Voxels with a NaN threshold are not penalized. Returns the
+# objective value, the underdose part and the overdose part of every plan
+def batchPenalty(Z, thresh, under, over):
+    if 1 == np.ndim(thresh):
+        thresh, under, over = thresh[:, None], under[:, None], over[:, None]
+    diff = np.where(np.isnan(thresh), 0.0, Z - np.nan_to_num(thresh))
+    underPart = np.sum(under * np.square(np.maximum(-diff, 0.0)), axis=0)
+    overPart = np.sum(over * np.square(np.maximum(diff, 0.0)), axis=0)
+    return(underPart + overPart, underPart, overPart)
+
+## Table of threshold, under and over weights by structure (see tomodata.penaltyTableCreator). size is the number of
+# mask labels
+def penaltyTable(TARGETList, TARGETThresholds, OARList, OARThresholds, targetOver, targetUnder, oarOver, oarUnder, size):
+    table = np.zeros((3, size))
+    table[0, :] = np.nan
+    for s, T in reversed(list(zip(OARList, OARThresholds))):
+        table[:, s] = [T, oarUnder, oarOver]
+    for s, T in reversed(list(zip(TARGETList, TARGETThresholds))):
+        table[:, s] = [T, targetUnder, targetOver]
+    return(table)
+
+## Upper bound of every beamlet in a (numProjections, L) array. Ghost projections and the beamlets that never deliver
+# any dose (the close_zeros constraints of solveModel) are closed.
+def beamletUpperBounds(data, numProjections, k10, t51):
+    ub = np.full((numProjections, data.L), t51)
+    ub[:k10, :] = 0.0
+    ub[data.bdata[:numProjections, :] < 0.0001] = 0.0
+    return(ub)
+
+## Low-rank compressed version of the dose matrix D. The rows of every structure (same mask label) are factorized by a
+# randomized range finder followed by a truncated SVD, to a relative Frobenius error of at most errorBound. Structures
+# for which the factors would not be smaller than the sparse rows are kept exact.
+class lowrankdose:
+    def __init__(self, data, D, errorBound = 0.01, blockSize = 16, seed = 0):
+        self.yBar = data.yBar
+        self.shape = D.shape
+        self.errorBound = errorBound
+        self.blocks = []
+        D = sps.csr_matrix(D)
+        rng = np.random.default_rng(seed)
+        for s in np.unique(data.mask):
+            rows = np.where(data.mask == s)[0]
+            Ds = D[rows, :]
+            U, Vt, error = self.factorize(Ds, errorBound, blockSize, rng)
+            if U is None:
+                self.blocks.append((rows, Ds, None))
+                print('lowrankdose: structure', s, 'with', len(rows), 'voxels kept sparse')
+            else:
+                self.blocks.append((rows, U, Vt))
+                print('lowrankdose: structure', s, 'with', len(rows), 'voxels. Rank:', U.shape[1],
+                      'relative Frobenius error:', error)
+
+    ## Randomized range finder on Ds until the part of Ds outside of the range is at most errorBound (relative), then
+    # truncated SVD of the projection. Returns None if the factors would use more memory than the sparse rows.
+    @staticmethod
+    def factorize(Ds, errorBound, blockSize, rng):
+        m, n = Ds.shape
+        normD2 = Ds.multiply(Ds).sum()
+        maxRank = min(m, n)
+        if 0.0 == normD2:
+            return(np.zeros((m, 0)), np.zeros((0, n)), 0.0)
+        tolerance2 = (errorBound * errorBound) * normD2
+        Q = np.zeros((m, 0))
+        while True:
+            Y = Ds.dot(rng.standard_normal((n, blockSize)))
+            Y -= Q.dot(Q.T.dot(Y))
+            Qnew, _ = np.linalg.qr(Y)
+            Qnew -= Q.dot(Q.T.dot(Qnew))
+            Qnew, _ = np.linalg.qr(Qnew)
+            Q = np.hstack([Q, Qnew])
+            B = Ds.T.dot(Q).T
+            residual2 = normD2 - np.sum(B * B)
+            if residual2 <= tolerance2 or Q.shape[1] >= maxRank:
+                break
+            if Q.shape[1] * (m + n) >= Ds.nnz:
+                return(None, None, None)
+        Ub, S, Vt = np.linalg.svd(B, full_matrices=False)
+        kept = normD2 - np.cumsum(S * S)
+        r = min(int(np.searchsorted(-kept, -tolerance2)) + 1, len(S))
+        if r * (m + n) >= Ds.nnz:
+            return(None, None, None)
+        U = Q.dot(Ub[:, :r] * S[:r])
+        error = np.sqrt(max(kept[r - 1], 0.0) / normD2)
+        return(U, Vt[:r, :], error)
+
+    ## Dose to every voxel produced by the fluence map t
+    def dose(self, t):
+        t = np.ravel(t)
+        z = np.zeros(self.shape[0])
+        for rows, U, Vt in self.blocks:
+            if Vt is None:
+                z[rows] = U.dot(t)
+            else:
+                z[rows] = U.dot(Vt.dot(t))
+        return(self.yBar * z)
+
+    ## Gradient with respect to the fluence of a function of the doses whose gradient with respect to the doses is gz
+    def gradient(self, gz):
+        g = np.zeros(self.shape[1])
+        for rows, U, Vt in self.blocks:
+            if Vt is None:
+                g += U.T.dot(gz[rows])
+            else:
+                g += Vt.T.dot(U.T.dot(gz[rows]))
+        return(self.yBar * g)
+
+    ## Error of the compressed dose against the exact sparse product. Uses the fluence t if given, else samples random
+    # fluences with entries in [0, t51]. Returns the largest relative 2-norm error and the largest absolute voxel error.
+    def approximationError(self, D, t = None, samples = 5, t51 = 1.0, seed = 0):
+        if t is None:
+            rng = np.random.default_rng(seed)
+            fluences = [t51 * rng.random(self.shape[1]) for _ in range(samples)]
+        else:
+            fluences = [np.ravel(t)]
+        relative = 0.0
+        absolute = 0.0
+        for f in fluences:
+            exact = self.yBar * D.dot(f)
+            difference = self.dose(f) - exact
+            relative = max(relative, np.linalg.norm(difference) / max(np.linalg.norm(exact), 1e-30))
+            absolute = max(absolute, np.abs(difference).max())
+        print('lowrankdose error against the exact product. Relative:', relative, 'maximum voxel error:', absolute)
+        return(relative, absolute)
@@ -0,0 +1,94 @@
+# Cumulative dose volume histograms of many plans and structures in one pass. Every voxel is keyed by its plan, its
+# structure (through its mask label) and its dose bin, and a single bincount gives the histograms of all of them on the
+# same fixed dose bins. The result can be plotted and compared without recomputing anything. doseMetrics computes the
+# Dx, Vx, mean and maximum dose of the same plans and structures from a single sort of their doses.
+import numpy as np
+
+## Structures to draw: the targets and then the OARs that appear in the mask (and in plotList if given), without
+# modifying the lists of the data object
+def dvhStructures(TARGETList, OARList, mask, plotList = None):
+    present = np.unique(mask)
+    if plotList is not None:
+        present = np.intersect1d(present, plotList)
+    targets = np.intersect1d(np.array(TARGETList), present)
+    oars = np.setdiff1d(np.intersect1d(np.array(OARList), present), targets)
+    return(np.concatenate([targets, oars]).astype(int))
+
+## Fixed dose bins from 0 to maxDose
+def doseBins(maxDose, numBins = 200):
+    return(np.linspace(0.0, maxDose, numBins + 1))
+
+## Key (plan * structures + structure) and dose of every voxel of plans that belongs to one of structures
+def structureKeys(plans, structures):
+    S = len(structures)
+    labelSize = max([int(np.max(mask)) + 1 for _, mask in plans] + [int(structures.max()) + 1 if S > 0 else 1])
+    structureOf = np.full(labelSize, -1)
+    structureOf[structures] = np.arange(S)
+    planKeys = [np.zeros(0, dtype=int)]
+    doses = [np.zeros(0)]
+    for p, (dose, mask) in enumerate(plans):
+        s = structureOf[np.asarray(mask, dtype=np.intp)]
+        selected = s >= 0
+        planKeys.append(p * S + s[selected])
+        doses.append(np.asarray(dose, dtype=float)[selected])
+    return(np.concatenate(planKeys), np.concatenate(doses))
+
+## Cumulative DVHs of every plan and structure. plans is a list of (dose, mask) pairs (one dose per voxel and the mask
+# label of the voxels, which can differ between plans). Returns a dictionary with
+#  - bins: the dose bin edges. By default numBins bins up to the largest dose of the structures over all plans
+#  - structures: the mask labels, in the order of the dvh array
+#  - dvh: (plans, structures, bins) array. dvh[p, s, k] is the fraction of the voxels of structure s that receive at
+#    least bins[k] in plan p
+#  - volumes: (plans, structures) number of voxels of every structure
+#  - atLeast: (plans, structures, bins) number of voxels of structure s that receive at least bins[k]. It can be added
+#    over the chunks of a plan computed on the same bins
+def batchDVH(plans, structures, bins = None, numBins = 200):
+    structures = np.asarray(structures, dtype=int)
+    S = len(structures)
+    P = len(plans)
+    planKeys, doses = structureKeys(plans, structures)
+    if bins is None:
+        bins = doseBins(doses.max() if len(doses) > 0 else 1.0, numBins)
+    B = len(bins)
+    # Bin k holds the doses in [bins[k], bins[k + 1]). The doses above the last edge count in the last one
+    binIndex = np.clip(np.searchsorted(bins, doses, side='right') - 1, -1, B - 1)
+    below = binIndex < 0
+    counts = np.bincount(planKeys[~below] * B + binIndex[~below], minlength = P * S * B).reshape(P, S, B)
+    volumes = np.bincount(planKeys, minlength = P * S).reshape(P, S)
+    atLeast = np.cumsum(counts[:, :, ::-1], axis=2)[:, :, ::-1]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        dvh = atLeast / volumes[:, :, None].astype(float)
+    return({'bins': bins, 'structures': structures, 'dvh': dvh, 'volumes': volumes, 'atLeast': atLeast})
+
+## Dose metrics of every plan and structure, from the exact doses (no bins). Returns a dictionary of (plans, structures)
+# arrays with the number of voxels, the mean, minimum and maximum dose, Dx for every x of dosePercents (the dose that x
+# percent of the structure receives at least) and Vd for every d of volumeDoses (the fraction of the structure that
+# receives at least d Gray). The metrics of the structures without voxels in a plan are NaN.
+def doseMetrics(plans, structures, dosePercents = (95, 2), volumeDoses = (10, 30, 50, 70)):
+    structures = np.asarray(structures, dtype=int)
+    S = len(structures)
+    P = len(plans)
+    planKeys, doses = structureKeys(plans, structures)
+    # Sort by structure and then by dose, so that the doses of each (plan, structure) are a sorted slice
+    order = np.lexsort((doses, planKeys))
+    sortedDoses = doses[order]
+    volumes = np.bincount(planKeys, minlength = P * S)
+    starts = np.cumsum(volumes) - volumes
+    present = volumes > 0
+    ends = np.maximum(starts + volumes - 1, 0)
+    def byStructure(values):
+        return(np.where(present, values, np.nan).reshape(P, S))
+    metrics = {'structures': structures, 'volumes': volumes.reshape(P, S)}
+    with np.errstate(divide='ignore', invalid='ignore'):
+        metrics['mean'] = byStructure(np.bincount(planKeys, weights = doses, minlength = P * S) / volumes)
+        padded = np.append(sortedDoses, np.nan)
+        metrics['min'] = byStructure(padded[np.where(present, starts, len(sortedDoses))])
+        metrics['max'] = byStructure(padded[np.where(present, ends, len(sortedDoses))])
+        for x in dosePercents:
+            # x percent of the n voxels is ceil(x n / 100) voxels, the highest ones of the sorted slice
+            rank = volumes - np.ceil(x / 100.0 * volumes).astype(int)
+            index = starts + np.clip(rank, 0, np.maximum(volumes - 1, 0))
+            metrics['D' + str(x)] = byStructure(padded[np.where(present, index, len(sortedDoses))])
+        for d in volumeDoses:
+            metrics['V' + str(d)] = byStructure(np.bincount(planKeys, weights = doses >= d, minlength = P * S) / volumes)
+    return(metrics)
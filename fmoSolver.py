@@ -0,0 +1,82 @@
+# First-order solver of the IMRT (FMO) version of solveModel. Without the 20 msec constraint the model is a bound
+# constrained convex QP: 0 <= t <= t51 with the piecewise quadratic over/under penalty, so it does not need GUROBI.
+import time
+import math
+import numpy as np
+from scipy.optimize import minimize, Bounds
+from doseOperator import doseFromFluence, voxelPenalty, beamletUpperBounds
+
+## Accelerated projected gradient (FISTA) with backtracking on the step and an adaptive restart whenever the objective
+# goes up. fg returns the objective and the gradient.
+def acceleratedProjectedGradient(fg, x0, ub, maxIterations, tolerance):
+    x = np.clip(x0, 0.0, ub)
+    y = x.copy()
+    fx = fg(x)[0]
+    theta = 1.0
+    step = 1.0
+    for iteration in range(maxIterations):
+        fy, gy = fg(y)
+        while True:
+            xNew = np.clip(y - step * gy, 0.0, ub)
+            dx = xNew - y
+            fNew = fg(xNew)[0]
+            if fNew <= fy + np.dot(gy, dx) + np.dot(dx, dx) / (2.0 * step) or step < 1e-30:
+                break
+            step /= 2.0
+        if fNew > fx:
+            # Restart the momentum
+            y = x.copy()
+            theta = 1.0
+            continue
+        thetaNew = (1.0 + math.sqrt(1.0 + 4.0 * theta * theta)) / 2.0
+        y = xNew + ((theta - 1.0) / thetaNew) * (xNew - x)
+        converged = abs(fx - fNew) <= tolerance * max(abs(fx), 1.0)
+        x = xNew
+        fx = fNew
+        theta = thetaNew
+        if converged:
+            break
+    return(x)
+
+## Solve the FMO problem. method is 'lbfgsb' (scipy L-BFGS-B) or 'fista' (accelerated projected gradient). If an
+# operator (for instance a lowrankdose) is given, the iterations use its dose and gradient calls instead of D.
+# Returns the same dictionary as solveModel in the imrt case, plus the running time. z_output is always exact.
+def solveFMO(data, D, numProjections, k10, t51, method = 'lbfgsb', maxIterations = 5000, tolerance = 1e-10,
+             operator = None):
+    start = time.time()
+    ub = beamletUpperBounds(data, numProjections, k10, t51).ravel()
+    DT = D.T.tocsr()
+
+    def fg(tflat):
+        if operator is not None:
+            objVal, gradz = voxelPenalty(operator.dose(tflat), data)
+            return(objVal, operator.gradient(gradz))
+        objVal, gradz = voxelPenalty(data.yBar * D.dot(tflat), data)
+        return(objVal, data.yBar * DT.dot(gradz))
+
+    x0 = np.zeros(len(ub))
+    if 'lbfgsb' == method:
+        result = minimize(fg, x0, jac = True, method = 'L-BFGS-B', bounds = Bounds(np.zeros(len(ub)), ub),
+                          options = {'maxiter': maxIterations, 'ftol': tolerance, 'gtol': 1e-12, 'maxcor': 20})
+        print('L-BFGS-B finished after', result.nit, 'iterations:', result.message)
+        x = np.clip(result.x, 0.0, ub)
+    elif 'fista' == method:
+        x = acceleratedProjectedGradient(fg, x0, ub, maxIterations, tolerance)
+    else:
+        raise ValueError('unknown FMO method ' + str(method))
+    t_output = x.reshape(numProjections, data.L)
+    z_output = doseFromFluence(D, t_output, data.yBar)
+    objVal = voxelPenalty(z_output, data)[0]
+    diff = z_output - data.quadHelperThresh
+    d = {"t_out": t_output, "z_output": z_output, "z_plus_out": np.maximum(diff, 0.0),
+         "z_minus_out": np.maximum(-diff, 0.0), "objVal": objVal, "runtime": time.time() - start}
+    print('FMO objective by', method, ':', objVal, 'in', d['runtime'], 'seconds')
+    return(d)
+
+## Compare the native FMO plan with the GUROBI one. Returns the relative difference of the objectives (positive means
+# that the native plan is worse).
+def benchmarkAgainstGurobi(dNative, dGurobi, gurobiRuntime):
+    gap = (dNative['objVal'] - dGurobi['objVal']) / max(abs(dGurobi['objVal']), 1e-10)
+    print('FMO benchmark. Native objective:', dNative['objVal'], 'in', dNative['runtime'], 'seconds. GUROBI objective:',
+          dGurobi['objVal'], 'in', gurobiRuntime, 'seconds. Relative difference:', gap)
+    return(gap)
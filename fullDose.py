@@ -0,0 +1,107 @@
+# Dose of a plan on every voxel of the case. The plans are optimized on a subsample of the voxels (maxvoxels), so
+# z_output only covers those. Here the opening times t_out are applied to all the Dij triplets of the case, read chunk by
+# chunk (memory mapped raw files, the compact case or the compressed archives), and the dose is accumulated in a memory
+# mapped (z_dim, y_dim, x_dim) volume. The DVHs of the full grid are then computed chunk by chunk from the volume and the
+# structure mask, so that the memory used is bounded by the chunk size.
+import os
+import sys
+import numpy as np
+from compactCase import hasCompactCase, compactTripletChunks
+from dijReaders import TRIPLETFILES, hasCompressedCase, compressedTripletChunks
+from resultStore import resultsDirectory, loadRunInfo, loadRunArray, registerRunArray
+from dvhEngine import doseBins, batchDVH
+
+## Dimensions (z_dim, y_dim, x_dim) of the voxel big space, from the header of the sample mask
+def caseDimensions(base_dir, fname = 'samplemask.header'):
+    dims = dict()
+    with open(base_dir + fname, 'r') as header:
+        for line in header:
+            for name in ['x_dim', 'y_dim', 'z_dim']:
+                if name in line:
+                    dims[name] = int(line.split(' ')[2])
+    return((dims['z_dim'], dims['y_dim'], dims['x_dim']))
+
+## Triplets of the case in chunks of at most chunkTriplets: the raw files memory mapped if they exist, else the compact
+# case, else the compressed archives
+def tripletChunks(base_dir, chunkTriplets = 1 << 22):
+    if os.path.exists(base_dir + 'dij/Dijs_out.bin'):
+        arrays = [np.memmap(base_dir + 'dij/' + name, dtype=dtype, mode='r') for name, dtype in TRIPLETFILES]
+        for begin in range(0, len(arrays[2]), chunkTriplets):
+            yield([np.asarray(array[begin:begin + chunkTriplets]) for array in arrays])
+    elif hasCompactCase(base_dir):
+        for chunks in compactTripletChunks(base_dir, chunkTriplets):
+            yield(chunks)
+    elif hasCompressedCase(base_dir):
+        for chunks in compressedTripletChunks(base_dir, chunkTriplets):
+            yield(chunks)
+    else:
+        raise IOError('there are no Dij triplets in ' + base_dir)
+
+## Accumulate the dose of the opening times t_out (numProjections, L) on every voxel of the case into the .npy file at
+# path. The file is memory mapped and only the voxels of each chunk are updated. Returns the memory mapped volume.
+def fullResolutionDose(base_dir, t_out, L, k10, yBar, path, chunkTriplets = 1 << 22):
+    shape = caseDimensions(base_dir)
+    volume = np.lib.format.open_memmap(path, mode='w+', dtype=np.float64, shape=shape)
+    flat = volume.reshape(-1)
+    t_out = np.asarray(t_out)
+    total = 0
+    for bixels, voxels, Dijs in tripletChunks(base_dir, chunkTriplets):
+        intensities = t_out[bixels // L + k10, bixels % L]
+        chunkVoxels, where = np.unique(voxels, return_inverse=True)
+        flat[chunkVoxels] += yBar * np.bincount(where, weights = Dijs * intensities)
+        total += len(Dijs)
+    volume.flush()
+    print('Full resolution dose of', total, 'triplets written to', path)
+    return(volume)
+
+## Structure of every voxel of voxels (a slice of the big space) from the bit mask of the case. A voxel in several
+# structures gets the first one of ALLList, as in tomodata
+def structureLabels(structImage, ALLList):
+    labels = np.zeros(len(structImage), dtype=np.uint8)
+    for s in reversed(ALLList):
+        labels[0 != (structImage & np.uint32(2 ** (s - 1)))] = s
+    return(labels)
+
+## Cumulative DVHs of the structures of ALLList on the full grid, on numBins bins up to the largest dose. The volume and
+# the structure mask are read chunkVoxels voxels at a time. Returns the dictionary of batchDVH (with a single plan)
+def fullResolutionDVH(base_dir, volume, ALLList, numBins = 200, chunkVoxels = 1 << 22,
+                      struct_img_filename = 'roimask.img'):
+    flat = volume.reshape(-1)
+    structImage = np.memmap(base_dir + struct_img_filename, dtype=np.uint32, mode='r')
+    structures = np.unique(np.array(ALLList, dtype=int))
+    maxDose = max([float(flat[b:b + chunkVoxels].max()) for b in range(0, len(flat), chunkVoxels)] + [0.0])
+    bins = doseBins(maxDose if maxDose > 0.0 else 1.0, numBins)
+    atLeast = np.zeros((1, len(structures), len(bins)), dtype=np.int64)
+    volumes = np.zeros((1, len(structures)), dtype=np.int64)
+    for b in range(0, len(flat), chunkVoxels):
+        labels = structureLabels(np.asarray(structImage[b:b + chunkVoxels]), ALLList)
+        chunk = batchDVH([(np.asarray(flat[b:b + chunkVoxels]), labels)], structures, bins)
+        atLeast += chunk['atLeast']
+        volumes += chunk['volumes']
+    present = volumes[0] > 0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        dvh = atLeast / volumes[:, :, None].astype(float)
+    return({'bins': bins, 'structures': structures[present], 'dvh': dvh[:, present], 'volumes': volumes[:, present],
+            'atLeast': atLeast[:, present]})
+
+## Full resolution dose and DVHs of a stored run. The volume is written to the folder of the run as fullDose.npy and
+# the DVHs as fullDVH.npz. base_dir defaults to the case of the run
+def fullResolutionRun(outputDirectory, runName, base_dir = None, chunkTriplets = 1 << 22):
+    directory = resultsDirectory(outputDirectory)
+    info = loadRunInfo(directory, runName)
+    parameters = info['parameters']
+    if base_dir is None:
+        base_dir = parameters['base_dir']
+    t_out = loadRunArray(directory, runName, 't_out', mmap = False)
+    volume = fullResolutionDose(base_dir, t_out, parameters['L'], parameters['k10'], parameters['yBar'],
+                                directory + runName + '/fullDose.npy', chunkTriplets)
+    registerRunArray(directory, runName, 'fullDose')
+    dvhs = fullResolutionDVH(base_dir, volume, parameters['TARGETList'] + parameters['OARList'],
+                             chunkVoxels = chunkTriplets)
+    np.savez(directory + runName + '/fullDVH.npz', **dvhs)
+    return(volume, dvhs)
+
+# Compute the full resolution dose of stored runs: python fullDose.py outputDirectory runName [runName ...]
+if __name__ == '__main__':
+    for runName in sys.argv[2:]:
+        fullResolutionRun(sys.argv[1], runName)
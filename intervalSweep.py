@@ -0,0 +1,86 @@
+# Interval algebra on the apertures of several plans. The (leaf, begin, end) records of apertures.py of every plan are
+# turned into opening and closing events, and one sorted sweep over the events of all the leaves cuts the time line of
+# every leaf into elementary segments. Each segment knows which plans are open during it (a bit per plan), so the
+# difference, intersection and union of the plans, and their overlap per leaf, are selections over the same arrays.
+import numpy as np
+from resultStore import APERTUREDTYPE
+
+## Elementary segments of the leaves of plans (a list of aperture arrays, at most 63). Returns a dictionary of arrays with
+# the leaf, begin, end and state of every segment of positive length, sorted by leaf and time. Bit k of state is set
+# when plan k is open during the segment.
+def sweepIntervals(plans):
+    K = len(plans)
+    leaves = np.concatenate([np.zeros(0, dtype=np.intp)] + [np.tile(p['leaf'].astype(np.intp), 2) for p in plans])
+    times = np.concatenate([np.zeros(0)] + [np.concatenate([p['begin'], p['end']]) for p in plans])
+    deltas = np.zeros((K, len(times)), dtype=np.int64)
+    offset = 0
+    for k, p in enumerate(plans):
+        deltas[k, offset:offset + len(p)] = 1
+        deltas[k, offset + len(p):offset + 2 * len(p)] = -1
+        offset += 2 * len(p)
+    order = np.lexsort((times, leaves))
+    leaves = leaves[order]
+    times = times[order]
+    # Every aperture closes on its own leaf, so the running sums go back to zero at the end of each leaf
+    isOpen = np.cumsum(deltas[:, order], axis=1) > 0
+    state = np.zeros(len(times), dtype=np.int64)
+    for k in range(K):
+        state |= isOpen[k].astype(np.int64) << k
+    keep = (leaves[:-1] == leaves[1:]) & (times[1:] > times[:-1])
+    return({'leaf': leaves[:-1][keep], 'begin': times[:-1][keep], 'end': times[1:][keep], 'state': state[:-1][keep],
+            'plans': K})
+
+## Segments where every plan of include is open and no plan of exclude is (all of them open if include is empty and
+# exclude too, which is the union)
+def selectSegments(sweep, include = (), exclude = ()):
+    state = sweep['state']
+    includeBits = sum(1 << k for k in include)
+    excludeBits = sum(1 << k for k in exclude)
+    selected = (state & excludeBits) == 0
+    if includeBits > 0:
+        selected &= (state & includeBits) == includeBits
+    else:
+        selected &= state > 0
+    return(selected)
+
+## Merge the contiguous selected segments of each leaf into apertures. Apertures shorter than minLength are dropped
+def mergeSegments(sweep, selected, minLength = 0.0):
+    leaf = sweep['leaf']
+    starts = selected.copy()
+    starts[1:] &= ~(selected[:-1] & (leaf[1:] == leaf[:-1]))
+    ends = selected.copy()
+    ends[:-1] &= ~(selected[1:] & (leaf[:-1] == leaf[1:]))
+    apertures = np.zeros(int(starts.sum()), dtype=APERTUREDTYPE)
+    apertures['leaf'] = leaf[starts]
+    apertures['begin'] = sweep['begin'][starts]
+    apertures['end'] = sweep['end'][ends]
+    return(apertures[apertures['end'] - apertures['begin'] > minLength])
+
+## Times when plan k is open and none of the plans of others is
+def difference(sweep, k, others, minLength = 0.0):
+    return(mergeSegments(sweep, selectSegments(sweep, [k], others), minLength))
+
+## Times when all the plans (or those of which) are open
+def intersection(sweep, which = None, minLength = 0.0):
+    return(mergeSegments(sweep, selectSegments(sweep, range(sweep['plans']) if which is None else which), minLength))
+
+## Times when any plan is open
+def union(sweep, minLength = 0.0):
+    return(mergeSegments(sweep, selectSegments(sweep), minLength))
+
+## Overlap of the plans per leaf: the open time of every plan (plans, L), the time when all are open (sharedTime), the
+# time when any is open (unionTime) and their ratio (jaccard, NaN for the leaves that never open)
+def overlapMetrics(sweep, L):
+    lengths = sweep['end'] - sweep['begin']
+    leaf = sweep['leaf']
+    openTime = np.zeros((sweep['plans'], L))
+    for k in range(sweep['plans']):
+        inside = 0 != (sweep['state'] & (1 << k))
+        openTime[k] = np.bincount(leaf[inside], weights=lengths[inside], minlength=L)
+    shared = selectSegments(sweep, range(sweep['plans']))
+    anyOpen = selectSegments(sweep)
+    sharedTime = np.bincount(leaf[shared], weights=lengths[shared], minlength=L)
+    unionTime = np.bincount(leaf[anyOpen], weights=lengths[anyOpen], minlength=L)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        jaccard = np.where(unionTime > 0, sharedTime / unionTime, np.nan)
+    return({'openTime': openTime, 'sharedTime': sharedTime, 'unionTime': unionTime, 'jaccard': jaccard})
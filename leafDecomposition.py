@@ -0,0 +1,243 @@
+# Leaf-wise Lagrangian decomposition of the full LOT model of solveModel (elittle, mlittle, blittle version).
+# Once the dose constraints z = yBar * D t and the Average_LOT_c constraint are dualized, the model separates into one
+# subproblem per leaf. Each of them is a shortest path over the projections, with four states per projection.
+import multiprocessing
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from doseOperator import doseFromFluence, voxelPenalty, beamletUpperBounds
+
+# States of a leaf in a projection. They correspond to beta = 0, elittle = 1, mlittle = 1 and blittle = 1.
+CLOSED, OPENS, MIDDLE, CLOSES = 0, 1, 2, 3
+
+## Process pool for the leaf subproblems. The drivers are scripts without a __main__ guard, so the workers have to be
+# forked. Where fork is not available (Windows) return None and the subproblems are solved serially.
+def forkedPool(numworkers):
+    if numworkers < 2 or 'fork' not in multiprocessing.get_all_start_methods():
+        return(None)
+    return(ProcessPoolExecutor(max_workers = numworkers, mp_context = multiprocessing.get_context('fork')))
+
+## Minimize c * t subject to lo <= t <= hi. Returns the cost and the value of t.
+def linearBox(c, lo, hi):
+    if c < 0.0:
+        return(c * hi, hi)
+    return(c * lo, lo)
+
+## Minimize c1 * t1 + c2 * t2 subject to 0 <= t1 <= u1, 0 <= t2 <= u2 and t1 + t2 >= timeM. This is the minimum_lot_eb
+# constraint of an opening that starts in one projection and closes in the next one. The optimum is at a vertex.
+def pairBox(c1, c2, u1, u2, timeM):
+    if u1 + u2 < timeM:
+        return(np.inf, 0.0, 0.0)
+    candidates = [(u1, u2), (u1, max(0.0, timeM - u1)), (max(0.0, timeM - u2), u2)]
+    if timeM <= u1:
+        candidates.append((timeM, 0.0))
+    if timeM <= u2:
+        candidates.append((0.0, timeM))
+    best = (np.inf, 0.0, 0.0)
+    for t1, t2 in candidates:
+        cost = c1 * t1 + c2 * t2
+        if cost < best[0]:
+            best = (cost, t1, t2)
+    return(best)
+
+## Cost of the transition from state s in projection p to state s2 in projection p + 1. The opening time of an OPENS
+# projection is decided on its outgoing transition and the one of a CLOSES projection on its incoming transition,
+# because those are the ones that the minimum LOT constraints couple.
+def transitionCost(p, s, s2, c, u, timeM):
+    if CLOSED == s or CLOSES == s:
+        if CLOSED == s2 or OPENS == s2:
+            return(0.0)
+        return(np.inf)
+    if OPENS == s:
+        if CLOSED == s2 or OPENS == s2:
+            # minimum_lot_e: an opening that does not continue lasts at least timeM
+            if u[p] < timeM:
+                return(np.inf)
+            return(linearBox(c[p], timeM, u[p])[0])
+        if MIDDLE == s2:
+            return(linearBox(c[p], 0.0, u[p])[0])
+        return(pairBox(c[p], c[p + 1], u[p], u[p + 1], timeM)[0])
+    # MIDDLE
+    if CLOSES == s2:
+        return(linearBox(c[p + 1], 0.0, u[p + 1])[0])
+    return(0.0)
+
+## Solve the subproblem of one leaf by dynamic programming over the projections.
+# c: price of the opening time in each projection, u: upper bound of the opening time (0 or t51),
+# eCost: price of an opening event in each projection, canOpen: False in the ghost projections.
+# Returns the optimal cost, the states and the opening times of the leaf.
+def solveLeafSubproblem(c, u, eCost, canOpen, timeM, t51):
+    P = len(c)
+    nodeCost = np.full((P, 4), np.inf)
+    nodeCost[:, CLOSED] = 0.0
+    nodeCost[canOpen, OPENS] = eCost[canOpen]
+    fullyOpen = canOpen & (u >= t51)
+    nodeCost[fullyOpen, MIDDLE] = c[fullyOpen] * t51
+    nodeCost[canOpen, CLOSES] = 0.0
+    V = np.full((P, 4), np.inf)
+    pred = np.zeros((P, 4), dtype=int)
+    V[0, :] = nodeCost[0, :]
+    for p in range(1, P):
+        for s2 in range(4):
+            if np.isinf(nodeCost[p, s2]):
+                continue
+            for s in range(4):
+                if np.isinf(V[p - 1, s]):
+                    continue
+                value = V[p - 1, s] + transitionCost(p - 1, s, s2, c, u, timeM) + nodeCost[p, s2]
+                if value < V[p, s2]:
+                    V[p, s2] = value
+                    pred[p, s2] = s
+    # An opening in the last projection has no minimum_lot_e constraint
+    terminal = np.zeros(4)
+    terminal[OPENS] = linearBox(c[P - 1], 0.0, u[P - 1])[0]
+    last = int(np.argmin(V[P - 1, :] + terminal))
+    cost = V[P - 1, last] + terminal[last]
+    states = np.zeros(P, dtype=int)
+    states[P - 1] = last
+    for p in range(P - 1, 0, -1):
+        states[p - 1] = pred[p, states[p]]
+    # Recover the opening times that the transitions chose
+    t = np.zeros(P)
+    for p in range(P):
+        if MIDDLE == states[p]:
+            t[p] = t51
+        elif OPENS == states[p]:
+            if p == P - 1:
+                t[p] = linearBox(c[p], 0.0, u[p])[1]
+            elif CLOSED == states[p + 1] or OPENS == states[p + 1]:
+                t[p] = linearBox(c[p], timeM, u[p])[1]
+            elif MIDDLE == states[p + 1]:
+                t[p] = linearBox(c[p], 0.0, u[p])[1]
+            else:
+                _, t[p], t[p + 1] = pairBox(c[p], c[p + 1], u[p], u[p + 1], timeM)
+        elif CLOSES == states[p] and MIDDLE == states[p - 1]:
+            t[p] = linearBox(c[p], 0.0, u[p])[1]
+    return(cost, states, t)
+
+## Worker of the process pool. Solves the subproblems of a batch of leaves (one column of c and u per leaf).
+def solveLeafBatch(args):
+    c, u, eCost, canOpen, timeM, t51 = args
+    return([solveLeafSubproblem(c[:, i], u[:, i], eCost, canOpen, timeM, t51) for i in range(c.shape[1])])
+
+## Minimize f_v(z_v) + lambda_v * z_v over z_v >= 0 for every voxel, where f_v is the over/under quadratic penalty.
+# Returns the minimizers and the total value.
+def minimizeDoseTerm(lam, data):
+    thresh = data.quadHelperThresh
+    under = data.quadHelperUnder
+    over = data.quadHelperOver
+    with np.errstate(divide='ignore', invalid='ignore'):
+        zAbove = thresh - lam / (2.0 * over)
+        zBelow = np.where(under > 0.0, np.maximum(thresh - lam / (2.0 * under), 0.0), 0.0)
+    z = np.where(lam < 0.0, zAbove, zBelow)
+    return(z, voxelPenalty(z, data)[0] + np.dot(lam, z))
+
+## Primal heuristic. The plans of the leaf subproblems respect every LOT constraint except Average_LOT_c. Remove the
+# shortest openings (a whole OPENS, MIDDLE..., CLOSES run each time) until the average LOT is at least timeA.
+def averageLOTRepair(states, t, timeA):
+    states = states.copy()
+    t = t.copy()
+    numProjections, L = states.shape
+    runs = []
+    for l in range(L):
+        p = 0
+        while p < numProjections:
+            if OPENS == states[p, l]:
+                q = p + 1
+                while q < numProjections and MIDDLE == states[q, l]:
+                    q += 1
+                if q < numProjections and CLOSES == states[q, l]:
+                    q += 1
+                runs.append((t[p:q, l].sum(), l, p, q))
+                p = q
+            else:
+                p += 1
+    T = t.sum()
+    N = len(runs)
+    runs.sort()
+    for length, l, p, q in runs:
+        if T >= timeA * N:
+            break
+        states[p:q, l] = CLOSED
+        t[p:q, l] = 0.0
+        T -= length
+        N -= 1
+    return(states, t)
+
+## Leaf-wise Lagrangian decomposition of the full model. The dose multipliers and the Average LOT multiplier are updated
+# by subgradient ascent with a Polyak step. Every heuristicEvery iterations the leaf plans are repaired into a feasible
+# plan that provides the upper bound. Returns the same dictionary as solveModel plus the lower bound.
+def lagrangianDecomposition(data, D, numProjections, k10, t51, timeM, timeA, numworkers = 1, maxIterations = 300,
+                            theta = 1.0, gapTolerance = 0.01, heuristicEvery = 5):
+    L = data.L
+    u = beamletUpperBounds(data, numProjections, k10, t51)
+    canOpen = np.arange(numProjections) >= k10
+    DT = D.T.tocsr()
+    # Start from the stationarity conditions of the empty plan
+    lam = -voxelPenalty(np.zeros(D.shape[0]), data)[1]
+    mu = 0.0
+    bestLB = -np.inf
+    bestUB = np.inf
+    bestStates = np.zeros((numProjections, L), dtype=int)
+    bestT = np.zeros((numProjections, L))
+    noImprovement = 0
+    pool = forkedPool(numworkers)
+    leafBatches = np.array_split(np.arange(L), max(1, numworkers))
+    for iteration in range(maxIterations):
+        # Price the dose and the Average LOT terms of every beamlet
+        c = -data.yBar * DT.dot(lam).reshape(numProjections, L)
+        c[k10:, :] -= mu
+        eCost = np.where(canOpen, mu * timeA, 0.0)
+        jobs = [(c[:, batch], u[:, batch], eCost, canOpen, timeM, t51) for batch in leafBatches]
+        if pool is None:
+            results = [solveLeafBatch(job) for job in jobs]
+        else:
+            results = list(pool.map(solveLeafBatch, jobs))
+        states = np.zeros((numProjections, L), dtype=int)
+        t = np.zeros((numProjections, L))
+        leafCosts = 0.0
+        for batch, batchResults in zip(leafBatches, results):
+            for l, (cost, leafStates, leafT) in zip(batch, batchResults):
+                leafCosts += cost
+                states[:, l] = leafStates
+                t[:, l] = leafT
+        zstar, zcost = minimizeDoseTerm(lam, data)
+        LB = zcost + leafCosts
+        if LB > bestLB:
+            bestLB = LB
+            noImprovement = 0
+        else:
+            noImprovement += 1
+            if noImprovement >= 5:
+                theta /= 2.0
+                noImprovement = 0
+        if 0 == iteration % heuristicEvery or iteration == maxIterations - 1:
+            hStates, hT = averageLOTRepair(states, t, timeA)
+            UB = voxelPenalty(doseFromFluence(D, hT, data.yBar), data)[0]
+            if UB < bestUB:
+                bestUB = UB
+                bestStates = hStates
+                bestT = hT
+        gap = (bestUB - bestLB) / max(abs(bestUB), 1e-10)
+        print('Lagrangian iteration', iteration, 'lower bound:', bestLB, 'upper bound:', bestUB, 'gap:', gap)
+        if gap < gapTolerance or theta < 1e-6:
+            break
+        # Subgradient of the dual function
+        gLam = zstar - doseFromFluence(D, t, data.yBar)
+        gMu = timeA * np.sum(OPENS == states[k10:, :]) - t[k10:, :].sum()
+        norm = np.dot(gLam, gLam) + gMu * gMu
+        if norm < 1e-12:
+            break
+        step = theta * (bestUB - LB) / norm
+        lam = lam + step * gLam
+        mu = max(0.0, mu + step * gMu)
+    if pool is not None:
+        pool.shutdown()
+    z_output = doseFromFluence(D, bestT, data.yBar)
+    diff = z_output - data.quadHelperThresh
+    T = bestT[k10:, :].sum()
+    N = np.sum(OPENS == bestStates[k10:, :])
+    d = {"t_out": bestT, "z_output": z_output, "z_plus_out": np.maximum(diff, 0.0), "z_minus_out": np.maximum(-diff, 0.0),
+         "mlittle_out": (MIDDLE == bestStates).astype(float), "blittle_out": (CLOSES == bestStates).astype(float),
+         "elittle_out": (OPENS == bestStates).astype(float), "beta_output": (CLOSED != bestStates).astype(float),
+         "slackAvgLOT": T - timeA * N, "gurobisT": T, "gurobisN": N, "objVal": bestUB, "lowerBound": bestLB}
+    return(d)
@@ -0,0 +1,87 @@
+# Table of dose metrics (mean, minimum and maximum dose, Dx and Vx) of every structure of every stored run. The runs are
+# found through the results catalog and their doses read concurrently. The metrics of all of them are computed in one
+# pass by dvhEngine.doseMetrics and written as a single CSV with one row per run and structure.
+#    python planMetrics.py [outputDirectory]
+import sys
+import csv
+import numpy as np
+from resultStore import resultsDirectory, loadRunInfo, loadRunArray
+from caseCache import caseDirectory, loadCase
+from resultsCatalog import resultsCatalog
+from dvhEngine import dvhStructures, doseMetrics
+
+METRICSFILE = 'planMetrics.csv'
+
+## Dose of a plan from its opening times t_out (numProjections, L) and the Dij triplets of its case
+def doseFromTimes(t_out, case, parameters):
+    L = parameters['L']
+    leafs = case['bixels'] % L
+    projections = case['bixels'] // L + parameters['k10']
+    dose = np.bincount(case['smallvoxels'], weights = case['Dijs'] * t_out[projections, leafs],
+                       minlength = parameters['totalsmallvoxels'])
+    return(parameters['yBar'] * dose)
+
+## Dose, mask and info of a stored run. Runs without z_output are recomputed from t_out and the case cache
+def runDose(outputDirectory, runName):
+    directory = resultsDirectory(outputDirectory)
+    info = loadRunInfo(directory, runName)
+    mask = loadRunArray(directory, runName, 'mask', mmap = False)
+    if 'z_output' in info['arrays']:
+        dose = loadRunArray(directory, runName, 'z_output', mmap = False)
+    elif 't_out' in info['arrays']:
+        case = loadCase(caseDirectory(outputDirectory), info['parameters']['caseKey'])
+        dose = doseFromTimes(np.asarray(loadRunArray(directory, runName, 't_out')), case, info['parameters'])
+    else:
+        raise IOError('the run ' + runName + ' has neither z_output nor t_out')
+    return(dose, mask, info)
+
+## Rows of the metrics table of runs, a list of (dose, mask, info) of the runs of entries
+def metricsRows(entries, runs, dosePercents = (95, 2), volumeDoses = (10, 30, 50, 70)):
+    # The union of the structures of the runs. Each run only has rows for its own ones
+    structures = np.unique(np.concatenate([np.zeros(0, dtype=int)] +
+                                          [dvhStructures(info['parameters']['TARGETList'], info['parameters']['OARList'],
+                                                         mask) for _, mask, info in runs]))
+    metrics = doseMetrics([(dose, mask) for dose, mask, _ in runs], structures, dosePercents, volumeDoses)
+    names = ['mean', 'min', 'max'] + ['D' + str(x) for x in dosePercents] + ['V' + str(d) for d in volumeDoses]
+    rows = []
+    for p, (entry, (_, _, info)) in enumerate(zip(entries, runs)):
+        parameters = info['parameters']
+        structureNames = {index: name for index, name in parameters['structures']}
+        for s, index in enumerate(structures):
+            if 0 == metrics['volumes'][p, s]:
+                continue
+            row = {'runName': entry['chunkName'], 'site': entry['site'], 'projections': entry['projections'],
+                   'model': entry['model'], 'timeM': parameters['timeM'], 'timeA': parameters['timeA'],
+                   'structure': int(index), 'structureName': structureNames.get(int(index), ''),
+                   'target': int(index) in parameters['TARGETList'], 'voxels': int(metrics['volumes'][p, s])}
+            for name in names:
+                row[name] = float(metrics[name][p, s])
+            rows.append(row)
+    return(rows)
+
+## Write rows (dictionaries with the same keys) as a CSV table
+def writeTable(path, rows):
+    with open(path, 'w', newline = '') as f:
+        if len(rows) > 0:
+            writer = csv.DictWriter(f, fieldnames = list(rows[0].keys()))
+            writer.writeheader()
+            writer.writerows(rows)
+
+## Metrics of every stored run that matches query (the parameters of resultsCatalog.query). Writes them to
+# outputDirectory/planMetrics.csv (or path) and returns the rows
+def scoreRuns(outputDirectory = 'outputMultiProj/', path = None, dosePercents = (95, 2),
+              volumeDoses = (10, 30, 50, 70), **query):
+    catalog = resultsCatalog(outputDirectory)
+    entries = catalog.query(kind = 'store', **query)
+    futures = [catalog.executor.submit(runDose, outputDirectory, entry['chunkName']) for entry in entries]
+    runs = [future.result() for future in futures]
+    catalog.shutdown()
+    rows = metricsRows(entries, runs, dosePercents, volumeDoses)
+    if path is None:
+        path = outputDirectory + METRICSFILE
+    writeTable(path, rows)
+    print('Metrics of', len(runs), 'runs written to', path)
+    return(rows)
+
+if __name__ == '__main__':
+    scoreRuns(*sys.argv[1:2])
@@ -0,0 +1,91 @@
+# Re-scoring of stored plans under new penalty parameters, without solving again. The t_out arrays of the runs of the
+# same case are stacked as the columns of one fluence matrix, and the doses of all of them are obtained with a single
+# sparse Dij x matrix product, split by rows over a thread pool. The quadratic objective of solveModel is then evaluated
+# for every plan under every scenario (penalty table) at once, and the dose metrics of the plans are computed as in
+# planMetrics.py.
+import sys
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from resultStore import resultsDirectory, loadRunInfo, loadRunArray
+from caseCache import caseDirectory, loadCase
+from resultsCatalog import resultsCatalog
+from doseOperator import doseMatrixFromTriplets, batchPenalty
+from planMetrics import metricsRows, writeTable
+
+RESCORINGFILE = 'planRescoring.csv'
+RESCORINGMETRICSFILE = 'planRescoringMetrics.csv'
+
+## t_out, mask, penalty table (None for runs stored without it) and info of a stored run
+def readRun(outputDirectory, runName):
+    directory = resultsDirectory(outputDirectory)
+    info = loadRunInfo(directory, runName)
+    t_out = loadRunArray(directory, runName, 't_out', mmap = False)
+    mask = loadRunArray(directory, runName, 'mask', mmap = False)
+    table = None
+    if 'penaltyTable' in info['arrays']:
+        table = loadRunArray(directory, runName, 'penaltyTable', mmap = False)
+    return(t_out, mask, table, info)
+
+## D times the dense matrix T, with the rows of D split in blocks over the threads of executor
+def threadedProduct(D, T, executor, numBlocks):
+    bounds = np.linspace(0, D.shape[0], numBlocks + 1).astype(int)
+    futures = [executor.submit(lambda a, b: D[a:b].dot(T), a, b) for a, b in zip(bounds[:-1], bounds[1:]) if b > a]
+    return(np.vstack([np.zeros((0, T.shape[1]))] + [future.result() for future in futures]))
+
+## Doses (voxels, runs) of runs of the same case, a list of (t_out, mask, table, info), with one sparse product
+def caseDoses(outputDirectory, runs, executor, numthreads):
+    parameters = runs[0][3]['parameters']
+    case = loadCase(caseDirectory(outputDirectory), parameters['caseKey'])
+    numProjections = runs[0][0].shape[0]
+    D = doseMatrixFromTriplets(case['bixels'], case['smallvoxels'], case['Dijs'], parameters['L'],
+                               parameters['totalsmallvoxels'], numProjections, parameters['k10'])
+    T = np.column_stack([run[3]['parameters']['yBar'] * np.ravel(run[0]) for run in runs])
+    return(threadedProduct(D, T, executor, numthreads))
+
+## Re-score the stored runs that match query (the parameters of resultsCatalog.query). scenarios is a dictionary of
+# penalty tables (as built by doseOperator.penaltyTable) by name. The table a run was solved with is always scored as
+# the scenario 'stored' when the run has it. Writes the objectives to outputDirectory/planRescoring.csv and the dose
+# metrics to planRescoringMetrics.csv and returns both lists of rows
+def rescoreRuns(outputDirectory = 'outputMultiProj/', scenarios = None, numthreads = 8, dosePercents = (95, 2),
+                volumeDoses = (10, 30, 50, 70), **query):
+    if scenarios is None:
+        scenarios = dict()
+    catalog = resultsCatalog(outputDirectory, numthreads)
+    entries = catalog.query(kind = 'store', **query)
+    runs = [future.result() for future in
+            [catalog.executor.submit(readRun, outputDirectory, entry['chunkName']) for entry in entries]]
+    catalog.shutdown()
+    # The runs of the same case and number of projections share one product
+    groups = dict()
+    for i, (t_out, _, _, info) in enumerate(runs):
+        groups.setdefault((info['parameters']['caseKey'], t_out.shape), []).append(i)
+    executor = ThreadPoolExecutor(max_workers = numthreads)
+    rows = []
+    doses = [None] * len(runs)
+    for (key, shape), members in groups.items():
+        Z = caseDoses(outputDirectory, [runs[i] for i in members], executor, numthreads)
+        masks = np.column_stack([np.asarray(runs[i][1], dtype=np.intp) for i in members])
+        tables = [('stored', [runs[i][2] for i in members])] if all(runs[i][2] is not None for i in members) else []
+        tables += [(name, [table] * len(members)) for name, table in scenarios.items()]
+        for name, tableOf in tables:
+            # Per voxel parameters of every run, (voxels, runs)
+            thresh, under, over = [np.column_stack([tableOf[j][k][masks[:, j]] for j in range(len(members))])
+                                   for k in range(3)]
+            objVal, underPart, overPart = batchPenalty(Z, thresh, under, over)
+            for j, i in enumerate(members):
+                rows.append({'runName': entries[i]['chunkName'], 'scenario': name, 'objVal': objVal[j],
+                             'underPenalty': underPart[j], 'overPenalty': overPart[j],
+                             'storedObjVal': runs[i][3]['stats'].get('objVal', np.nan)})
+        for j, i in enumerate(members):
+            doses[i] = Z[:, j]
+        print('Re-scored', len(members), 'runs of the case', key, 'under', len(tables), 'scenarios')
+    executor.shutdown()
+    metrics = metricsRows(entries, [(doses[i], runs[i][1], runs[i][3]) for i in range(len(runs))], dosePercents,
+                          volumeDoses)
+    writeTable(outputDirectory + RESCORINGFILE, rows)
+    writeTable(outputDirectory + RESCORINGMETRICSFILE, metrics)
+    return(rows, metrics)
+
+# Re-score the stored runs under the penalty tables they were solved with: python planRescoring.py [outputDirectory]
+if __name__ == '__main__':
+    rescoreRuns(*sys.argv[1:2])
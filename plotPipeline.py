@@ -0,0 +1,155 @@
+# Post-processing of the runs: the DVH, sinogram and LOT histogram figures of stored runs are rendered in worker
+# processes. Every figure is drawn on its own matplotlib Figure with the Agg canvas, so there is no shared pyplot state
+# and no interactive backend. The inputs of each figure are hashed and the hash is kept next to it (.hash file), so the
+# figures whose inputs did not change are not drawn again.
+import os
+import sys
+import hashlib
+import numpy as np
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib import collections as mc
+from resultStore import resultsDirectory, loadRunInfo, loadRunArray
+from resultsCatalog import resultsCatalog
+from dvhEngine import dvhStructures, batchDVH
+from sinogramRaster import rasterizeApertures
+from leafDecomposition import forkedPool
+
+# Bump when the drawing code changes, so that the figures are drawn again
+PIPELINEVERSION = 1
+
+## Hash of the inputs of a figure: its kind and its arguments (arrays by content)
+def figureHash(kind, arguments):
+    h = hashlib.blake2b(digest_size = 16)
+    h.update((kind + str(PIPELINEVERSION)).encode())
+    for name in sorted(arguments):
+        value = arguments[name]
+        h.update(name.encode())
+        if isinstance(value, np.ndarray):
+            value = np.ascontiguousarray(value)
+            h.update((str(value.dtype) + str(value.shape)).encode())
+            h.update(value)
+        else:
+            h.update(repr(value).encode())
+    return(h.hexdigest())
+
+def newFigure():
+    fig = Figure()
+    FigureCanvasAgg(fig)
+    return(fig)
+
+def drawDVH(fig, z, mask, TARGETList, OARList, names, title):
+    dvhs = batchDVH([(z, mask)], dvhStructures(TARGETList, OARList, mask))
+    ax = fig.subplots()
+    for s, index in enumerate(dvhs['structures']):
+        ax.plot(dvhs['bins'], dvhs['dvh'][0, s], label=names.get(int(index), str(index)), linewidth=2)
+    lgd = ax.legend(fancybox=True, framealpha=0.5, bbox_to_anchor=(1.05, 1), loc=2)
+    ax.grid(True)
+    ax.set_xlabel('Dose Gray')
+    ax.set_ylabel('Fractional Volume')
+    ax.set_title(title)
+    return({'bbox_extra_artists': (lgd,), 'bbox_inches': 'tight'})
+
+def drawSinogram(fig, apertures, L, raster):
+    ax = fig.subplots()
+    if raster:
+        image, duration = rasterizeApertures(apertures, L)
+        ax.imshow(image, aspect='auto', origin='lower', interpolation='nearest', cmap='Reds', vmin=0.0, vmax=1.0,
+                  extent=[0.0, duration, -0.5, L - 0.5])
+    else:
+        lines = np.stack([np.column_stack([apertures['begin'], apertures['leaf']]),
+                          np.column_stack([apertures['end'], apertures['leaf']])], axis=1)
+        ax.add_collection(mc.LineCollection(lines, linewidths = 3, colors = 'red'))
+        ax.autoscale()
+    ax.set_title('Sinogram')
+    ax.set_xlabel('time in seconds')
+    ax.set_ylabel('leaves')
+    return(dict())
+
+def drawHistogram(fig, leavelengths, title, marks):
+    ax = fig.subplots()
+    if len(leavelengths) > 0:
+        bins = list(np.arange(leavelengths.min(), leavelengths.max(), 0.01)) + [leavelengths.max()]
+        ax.hist(leavelengths, bins = bins)
+    for mark in marks:
+        ax.text(mark, 7, str(mark)[0:6], color='r', rotation=89)
+    ax.set_xlabel('Leaf Opening Times')
+    ax.set_title(title)
+    return(dict())
+
+DRAWERS = {'dvh': drawDVH, 'sinogram': drawSinogram, 'histogram': drawHistogram}
+
+## Draw one figure into path unless it exists with the same inputs. Returns True if it was drawn
+def renderFigure(job):
+    kind, path, arguments = job
+    key = figureHash(kind, arguments)
+    if os.path.exists(path) and os.path.exists(path + '.hash'):
+        with open(path + '.hash', 'r') as f:
+            if f.read() == key:
+                return(False)
+    fig = newFigure()
+    options = DRAWERS[kind](fig, **arguments)
+    fig.savefig(path, **options)
+    with open(path + '.hash', 'w') as f:
+        f.write(key)
+    return(True)
+
+## Figures of a stored run as (kind, path, arguments) jobs, with the names and titles of OrganizedmultiTool.py
+def runFigures(outputDirectory, runName, raster = False):
+    directory = resultsDirectory(outputDirectory)
+    info = loadRunInfo(directory, runName)
+    parameters = info['parameters']
+    stats = info['stats']
+    jobs = []
+    mask = loadRunArray(directory, runName, 'mask', mmap = False)
+    if 'z_output' in info['arrays']:
+        if parameters.get('imrt', False):
+            title = 'DVH-' + parameters['tumorsite'] + ' IMRT benchmark'
+            if parameters.get('imrtwith20msecondsconstraint', False):
+                title += ' with 20 msec constraint'
+        else:
+            title = ('DVH-' + parameters['tumorsite'] + 'min. LOT = ' + str(parameters['timeM']) + ' and min.AvgLOT = ' +
+                     str(parameters['timeA']))
+        jobs.append(('dvh', outputDirectory + 'DVH' + runName + '.png',
+                     {'z': loadRunArray(directory, runName, 'z_output', mmap = False), 'mask': mask,
+                      'TARGETList': parameters['TARGETList'], 'OARList': parameters['OARList'],
+                      'names': {index: name for index, name in parameters['structures']}, 'title': title}))
+    if 'apertures' in info['arrays']:
+        jobs.append(('sinogram', outputDirectory + 'Sinogram' + runName + '.png',
+                     {'apertures': loadRunArray(directory, runName, 'apertures', mmap = False), 'L': parameters['L'],
+                      'raster': raster}))
+    if 'leavelengths' in info['arrays']:
+        if parameters.get('imrt', False):
+            title = 'histogram IMRT with intensity: ' + str(parameters['yBar'])
+            if parameters.get('imrtwith20msecondsconstraint', False):
+                title += 'with cutoff 20 msecs'
+            marks = []
+        else:
+            title = ('histogram: Min LOT Goal: ' + str(parameters['timeM']) + ' Actual:' + str(stats['minLength'])[0:6] +
+                     ' AvgLOT goal:' + str(parameters['timeA']) + ' Actual: ' + str(stats['avLength'])[0:6])
+            marks = [stats['minLength'], stats['avLength']]
+        jobs.append(('histogram', outputDirectory + 'histogram' + runName + '.png',
+                     {'leavelengths': loadRunArray(directory, runName, 'leavelengths', mmap = False),
+                      'title': title, 'marks': marks}))
+    return(jobs)
+
+## Draw the figures of the stored runs that match query (the parameters of resultsCatalog.query, or runNames) in
+# numworkers processes. Returns the number of figures drawn and skipped
+def renderRuns(outputDirectory = 'outputMultiProj/', numworkers = 4, raster = False, runNames = None, **query):
+    if runNames is None:
+        catalog = resultsCatalog(outputDirectory)
+        runNames = [entry['chunkName'] for entry in catalog.query(kind = 'store', **query)]
+        catalog.shutdown()
+    jobs = [job for runName in runNames for job in runFigures(outputDirectory, runName, raster)]
+    pool = forkedPool(min(numworkers, len(jobs)))
+    if pool is None:
+        drawn = [renderFigure(job) for job in jobs]
+    else:
+        drawn = list(pool.map(renderFigure, jobs))
+        pool.shutdown()
+    print('Figures of', len(runNames), 'runs:', sum(drawn), 'drawn and', len(drawn) - sum(drawn), 'unchanged')
+    return(sum(drawn), len(drawn) - sum(drawn))
+
+# Draw the figures of every stored run: python plotPipeline.py [outputDirectory]
+if __name__ == '__main__':
+    renderRuns(*sys.argv[1:2])
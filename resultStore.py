@@ -0,0 +1,139 @@
+# Columnar store of the results of the runs. Each run is a folder results/<chunkName>/ of the output directory with
+#  - one .npy file per solution array (t_out, z_output, beta_output, ...), which can be memory mapped
+#  - apertures.npy  the aperture intervals as a structured array with fields leaf, begin and end (in seconds)
+#  - run.json       the parameters of the run, its LOT statistics and its solver statistics
+# and results/runIndex.csv has one row per run with the scalar columns of INDEXCOLUMNS, so that a metric can be read
+# across a whole sweep without opening the folders of the runs.
+import os
+import csv
+import json
+import shutil
+import numpy as np
+
+RESULTSFOLDER = 'results/'
+INDEXFILE = 'runIndex.csv'
+APERTUREDTYPE = np.dtype([('leaf', np.uint8), ('begin', np.float64), ('end', np.float64)])
+# Columns of the run index and their types
+INDEXCOLUMNS = [('runName', str), ('tumorsite', str), ('initialProjections', int), ('treatmentName', str),
+                ('timeM', float), ('timeA', float), ('totalsmallvoxels', int), ('maxvoxels', int), ('yBar', float),
+                ('objVal', float), ('runtime', float), ('MIPGap', float), ('lowerBound', float), ('avLength', float),
+                ('minLength', float), ('totalLength', float), ('modFactor', float), ('gurobiAvLength', float),
+                ('numApertures', int)]
+MISSING = {str: '', int: -1, float: np.nan}
+
+## Folder of the store of the runs that write to outputDirectory
+def resultsDirectory(outputDirectory):
+    return(outputDirectory + RESULTSFOLDER)
+
+## Convert the list (one per leaf) of [begin, end] pairs of calculateT into the structured array of the store
+def aperturesFromIntervals(t):
+    apertures = np.zeros(sum(len(intervals) for intervals in t), dtype=APERTUREDTYPE)
+    i = 0
+    for l, intervals in enumerate(t):
+        for begin, end in intervals:
+            apertures[i] = (l, begin, end)
+            i += 1
+    return(apertures)
+
+## Convert the structured array of the store back into the list (one per leaf) of [begin, end] pairs
+def intervalsFromApertures(apertures, L):
+    t = [list() for _ in range(L)]
+    for leaf, begin, end in apertures:
+        t[leaf].append([begin, end])
+    return(t)
+
+## Plain python version of a value, so that it can be written to JSON
+def jsonValue(value):
+    if isinstance(value, np.generic):
+        return(value.item())
+    if isinstance(value, np.ndarray):
+        return(value.tolist())
+    if isinstance(value, (list, tuple)):
+        return([jsonValue(v) for v in value])
+    if isinstance(value, dict):
+        return({str(k): jsonValue(v) for k, v in value.items()})
+    return(value)
+
+## Write a run. parameters and stats are dictionaries of scalars (stats can also hold small lists), arrays a dictionary
+# of arrays and apertures the structured array of the aperture intervals (or None). The folder of the run is written
+# under a temporary name and then renamed, so that it is never seen half written. Rewriting a run replaces it.
+def writeRun(directory, runName, parameters, stats, arrays, apertures = None):
+    if not os.path.exists(directory):
+        os.makedirs(directory, exist_ok = True)
+    temporary = directory + runName + '.' + str(os.getpid()) + '.tmp/'
+    os.makedirs(temporary)
+    for name, array in arrays.items():
+        np.save(temporary + name + '.npy', np.asarray(array))
+    if apertures is not None:
+        np.save(temporary + 'apertures.npy', apertures)
+    info = {'runName': runName, 'parameters': jsonValue(parameters), 'stats': jsonValue(stats),
+            'arrays': sorted(arrays.keys()) + (['apertures'] if apertures is not None else [])}
+    with open(temporary + 'run.json', 'w') as f:
+        json.dump(info, f, indent = 1)
+    if os.path.exists(directory + runName):
+        shutil.rmtree(directory + runName)
+    os.replace(temporary, directory + runName)
+    row = dict(parameters)
+    row.update(stats)
+    row['runName'] = runName
+    if apertures is not None:
+        row['numApertures'] = len(apertures)
+    appendIndexRow(directory, row)
+
+## Append the index columns of row to the run index. Rows are written with a single call so that the runs of a sweep
+# can append at the same time.
+def appendIndexRow(directory, row):
+    path = directory + INDEXFILE
+    try:
+        with open(path, 'x') as f:
+            f.write(','.join(name for name, _ in INDEXCOLUMNS) + '\n')
+    except FileExistsError:
+        pass
+    values = []
+    for name, kind in INDEXCOLUMNS:
+        value = row.get(name, MISSING[kind])
+        if value is None:
+            value = MISSING[kind]
+        values.append(str(jsonValue(value)))
+    with open(path, 'a') as f:
+        f.write(','.join(values) + '\n')
+
+## Read the run index as a dictionary of typed column arrays. When a run was written more than once its last row counts.
+def readRunIndex(directory):
+    rows = dict()
+    if os.path.exists(directory + INDEXFILE):
+        with open(directory + INDEXFILE, 'r') as f:
+            for row in csv.DictReader(f):
+                rows[row['runName']] = row
+    columns = dict()
+    for name, kind in INDEXCOLUMNS:
+        values = [row.get(name, '') for row in rows.values()]
+        if str == kind:
+            columns[name] = np.array(values, dtype=str)
+        else:
+            columns[name] = np.array([kind(float(v)) if '' != v else MISSING[kind] for v in values],
+                                     dtype=np.int64 if int == kind else np.float64)
+    return(columns)
+
+## Add to the list of arrays of a run one that was written to its folder (as name.npy) after the run was stored
+def registerRunArray(directory, runName, name):
+    info = loadRunInfo(directory, runName)
+    if name not in info['arrays']:
+        info['arrays'] = sorted(info['arrays'] + [name])
+    temporary = directory + runName + '/run.json.' + str(os.getpid()) + '.tmp'
+    with open(temporary, 'w') as f:
+        json.dump(info, f, indent = 1)
+    os.replace(temporary, directory + runName + '/run.json')
+
+## Read the parameters and the statistics of a run
+def loadRunInfo(directory, runName):
+    with open(directory + runName + '/run.json', 'r') as f:
+        return(json.load(f))
+
+## Read one array of a run. By default it is memory mapped, so that only the parts that are used are read
+def loadRunArray(directory, runName, name, mmap = True):
+    return(np.load(directory + runName + '/' + name + '.npy', mmap_mode = 'r' if mmap else None))
+
+## Read the aperture intervals of a run as the list (one per leaf) of [begin, end] pairs of calculateT
+def loadRunApertures(directory, runName, L = 64):
+    return(intervalsFromApertures(loadRunArray(directory, runName, 'apertures', mmap = False), L))
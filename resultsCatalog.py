@@ -0,0 +1,173 @@
+# Catalog of the results in an output directory. The directory is scanned once and the parameters of every run are
+# parsed from its chunkName (site, projections, model, MinLOT, minAvgLot, voxels and intensity). The index is cached in
+# catalogIndex.json and rebuilt only when files are added to or removed from the directory. Results are loaded lazily
+# and concurrently through a thread pool.
+import os
+import re
+import json
+import pickle
+import types
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from resultStore import resultsDirectory, loadRunInfo, loadRunArray, intervalsFromApertures
+
+INDEXFILENAME = 'catalogIndex.json'
+# Old runs have no projections in their chunkName (ProstatefullModel-MinLOT-...)
+CHUNKPATTERN = re.compile(r'^(?P<site>[A-Za-z]+)-?(?:(?P<projections>\d+)-)?'
+                          r'(?P<model>(?:IMRT|pairModel|fullModel)[A-Za-z0-9.]*)-MinLOT-(?P<minLOT>[0-9.eE-]+)'
+                          r'-minAvgLot-(?P<minAvgLot>[0-9.eE-]+)-vxls-(?P<voxels>\d+)-ntnsty-(?P<intensity>[0-9.]+)$')
+# How the files of each kind are named from the chunkName: (prefix, suffix)
+FILEKINDS = {'pickleresults': ('pickleresults-', '.pkl'), 'calculateT': ('calculateT', '.pkl'), 'z': ('', '-z.pkl'),
+             'dataobject': ('', '-dataobject.pkl')}
+
+## Parse a chunkName. Returns None if it is not one
+def parseChunkName(chunkName):
+    match = CHUNKPATTERN.match(chunkName)
+    if match is None:
+        return(None)
+    fields = match.groupdict()
+    return({'site': fields['site'],
+            'projections': None if fields['projections'] is None else int(fields['projections']),
+            'model': fields['model'], 'minLOT': float(fields['minLOT']), 'minAvgLot': float(fields['minAvgLot']),
+            'voxels': int(fields['voxels']), 'intensity': float(fields['intensity'])})
+
+## Result of a load that may still be running. It can be indexed like the dictionary that it loads.
+class lazyresult:
+    def __init__(self, future):
+        self.future = future
+
+    def get(self):
+        return(self.future.result())
+
+    def __getitem__(self, key):
+        return(self.get()[key])
+
+    def __contains__(self, key):
+        return(key in self.get())
+
+class resultsCatalog:
+    def __init__(self, outputDirectory = 'outputMultiProj/', numthreads = 8):
+        self.outputDirectory = outputDirectory
+        self.executor = ThreadPoolExecutor(max_workers = numthreads)
+        self.entries = self.readIndex()
+
+    ## Modification times of the folders that are scanned. They change when files are added or removed
+    def signature(self):
+        folders = [self.outputDirectory, resultsDirectory(self.outputDirectory)]
+        return([os.path.getmtime(folder) if os.path.exists(folder) else 0.0 for folder in folders])
+
+    ## The cached index if it is up to date, else a new scan
+    def readIndex(self):
+        path = self.outputDirectory + INDEXFILENAME
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                cached = json.load(f)
+            if cached['signature'] == self.signature():
+                return(cached['entries'])
+        entries = self.scan()
+        if os.path.exists(self.outputDirectory):
+            with open(path, 'w') as f:
+                json.dump({'signature': self.signature(), 'entries': entries}, f, indent = 1)
+        return(entries)
+
+    ## Find the runs in the output directory and the kinds of results that each one has
+    def scan(self):
+        entries = dict()
+        def add(chunkName, kind, path):
+            fields = parseChunkName(chunkName)
+            if fields is None:
+                return
+            entry = entries.setdefault(chunkName, dict(fields, chunkName = chunkName, files = dict()))
+            entry['files'][kind] = path
+        if os.path.exists(self.outputDirectory):
+            for filename in os.listdir(self.outputDirectory):
+                for kind, (prefix, suffix) in FILEKINDS.items():
+                    if filename.startswith(prefix) and filename.endswith(suffix):
+                        add(filename[len(prefix):len(filename) - len(suffix)], kind, self.outputDirectory + filename)
+        store = resultsDirectory(self.outputDirectory)
+        if os.path.exists(store):
+            for runName in os.listdir(store):
+                if os.path.exists(store + runName + '/run.json'):
+                    add(runName, 'store', store + runName)
+        print('Results catalog: found', len(entries), 'runs in', self.outputDirectory)
+        return(entries)
+
+    ## Entries (sorted by chunkName) that match every parameter given. kind keeps only the runs that have that kind of
+    # result. For example query(model = 'pairModel', projections = 153)
+    def query(self, site = None, projections = None, model = None, minLOT = None, minAvgLot = None, voxels = None,
+              intensity = None, kind = None):
+        matches = []
+        for chunkName in sorted(self.entries):
+            entry = self.entries[chunkName]
+            if site is not None and entry['site'] != site:
+                continue
+            if projections is not None and entry['projections'] != projections:
+                continue
+            if model is not None and entry['model'] != model:
+                continue
+            if voxels is not None and entry['voxels'] != voxels:
+                continue
+            if any(value is not None and not np.isclose(entry[name], value) for name, value in
+                   [('minLOT', minLOT), ('minAvgLot', minAvgLot), ('intensity', intensity)]):
+                continue
+            if kind is not None and kind not in entry['files'] and not self.storeCanServe(entry, kind):
+                continue
+            matches.append(entry)
+        return(matches)
+
+    ## The results store has what the pickleresults and calculateT pickles used to have
+    def storeCanServe(self, entry, kind):
+        return('store' in entry['files'] and kind in ['pickleresults', 'calculateT', 'store'])
+
+    ## Start loading one kind of result of an entry. Returns a lazyresult
+    def load(self, entry, kind):
+        if kind in entry['files'] and 'store' != kind:
+            return(lazyresult(self.executor.submit(self.readPickle, entry['files'][kind])))
+        if self.storeCanServe(entry, kind):
+            return(lazyresult(self.executor.submit(self.readStore, entry)))
+        raise IOError('there is no ' + kind + ' result for ' + entry['chunkName'])
+
+    ## Start loading one kind of result of every entry, concurrently
+    def loadMany(self, entries, kind):
+        return([self.load(entry, kind) for entry in entries])
+
+    ## Load the only run that matches the query. For example fetch('calculateT', model = 'IMRT', voxels = 16677)
+    def fetch(self, kind, **query):
+        matches = self.query(kind = kind, **query)
+        if 1 != len(matches):
+            raise LookupError(str(len(matches)) + ' runs match ' + str(query) + ': ' +
+                              str([entry['chunkName'] for entry in matches]))
+        return(self.load(matches[0], kind))
+
+    @staticmethod
+    def readPickle(path):
+        with open(path, 'rb') as f:
+            return(pickle.load(f))
+
+    ## A run of the results store as a dictionary with the keys of the pickleresults and calculateT pickles. The arrays
+    # are memory mapped. data only has the fields that the plots use.
+    def readStore(self, entry):
+        directory = resultsDirectory(self.outputDirectory)
+        runName = entry['chunkName']
+        info = loadRunInfo(directory, runName)
+        parameters = info['parameters']
+        result = dict(info['stats'])
+        result['parameters'] = parameters
+        for name in info['arrays']:
+            if 'apertures' != name:
+                result[name] = loadRunArray(directory, runName, name)
+        if 'apertures' in info['arrays']:
+            result['t'] = intervalsFromApertures(loadRunArray(directory, runName, 'apertures', mmap = False),
+                                                 parameters['L'])
+        if 't_out' in result:
+            result['tim'] = result['t_out']
+        result['data'] = types.SimpleNamespace(mask = result['mask'], TARGETList = parameters['TARGETList'],
+                                               OARList = parameters['OARList'],
+                                               AllDict = {index: name for index, name in parameters['structures']},
+                                               totalsmallvoxels = parameters['totalsmallvoxels'],
+                                               timeM = parameters['timeM'], timeA = parameters['timeA'],
+                                               L = parameters['L'], yBar = parameters['yBar'])
+        return(result)
+
+    def shutdown(self):
+        self.executor.shutdown()
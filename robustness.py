@@ -0,0 +1,104 @@
+# Robustness of a stored plan to leaf timing errors. Many perturbed deliveries of its apertures are sampled: a latency
+# at the opening and at the closing of every aperture, a bias of every leaf and the loss of the openings shorter than
+# the truncation threshold. The fluences of a batch of samples are the columns of one matrix, so their doses come from
+# a single sparse Dij x matrix product, and the dose metrics of every sample from one call to dvhEngine.doseMetrics.
+# Batches run in forked worker processes. Every batch has its own seed spawned from the seed of the evaluation, so the
+# results do not depend on the number of workers.
+import sys
+import numpy as np
+from resultStore import resultsDirectory, loadRunInfo, loadRunArray
+from caseCache import caseDirectory, loadCase
+from doseOperator import doseMatrixFromTriplets
+from dvhEngine import dvhStructures, doseMetrics
+from deliverySimulator import deliveredFluence
+from leafDecomposition import forkedPool
+from planMetrics import writeTable
+
+# Latencies and bias in seconds. Openings shorter than truncation are not delivered
+PERTURBATION = {'openLatencyMean': 0.0, 'openLatencySd': 0.002, 'closeLatencyMean': 0.0, 'closeLatencySd': 0.002,
+                'leafBiasSd': 0.001, 'truncation': 0.01}
+# Plan being evaluated. Set before the pool is forked, so that the workers inherit the dose matrix
+robustPlan = dict()
+
+## Apertures of samples perturbed copies of apertures, as a dictionary of arrays whose leaf is sample * L + leaf
+def perturbApertures(apertures, L, samples, perturbation, rng):
+    n = len(apertures)
+    lengths = apertures['end'] - apertures['begin']
+    begin = apertures['begin'][None, :] + rng.normal(perturbation['openLatencyMean'], perturbation['openLatencySd'],
+                                                    (samples, n))
+    bias = rng.normal(0.0, perturbation['leafBiasSd'], (samples, L))
+    end = apertures['end'][None, :] + rng.normal(perturbation['closeLatencyMean'], perturbation['closeLatencySd'],
+                                                (samples, n)) + bias[:, apertures['leaf'].astype(np.intp)]
+    end = np.maximum(end, begin)
+    end = np.where(lengths[None, :] < perturbation['truncation'], begin, end)
+    leaf = np.arange(samples)[:, None] * L + apertures['leaf'][None, :].astype(np.int64)
+    return({'leaf': leaf.ravel(), 'begin': begin.ravel(), 'end': end.ravel()})
+
+## Doses (voxels, samples) of the fluences (numProjections, samples, L)
+def sampleDoses(fluences):
+    T = fluences.transpose(0, 2, 1).reshape(-1, fluences.shape[1])
+    return(robustPlan['yBar'] * robustPlan['D'].dot(T))
+
+## Metrics of one batch of samples of robustPlan drawn with seed
+def sampleBatch(job):
+    seed, samples = job
+    plan = robustPlan
+    rng = np.random.default_rng(seed)
+    perturbed = perturbApertures(plan['apertures'], plan['L'], samples, plan['perturbation'], rng)
+    fluences = deliveredFluence(perturbed, plan['numProjections'], samples * plan['L'], plan['t51'], plan['model'])
+    Z = sampleDoses(fluences.reshape(plan['numProjections'], samples, plan['L']))
+    metrics = doseMetrics([(Z[:, s], plan['mask']) for s in range(samples)], plan['structures'], plan['dosePercents'],
+                          plan['volumeDoses'])
+    return({name: metrics[name] for name in plan['names']})
+
+## Spread of the dose metrics of a stored run over samples perturbed deliveries. The same seed gives the same samples.
+# Writes a row per structure and metric with the nominal value and the mean, standard deviation and 5th and 95th
+# percentiles of the samples to outputDirectory/robustness-<runName>.csv and returns the rows
+def robustnessRun(outputDirectory, runName, samples = 1000, batchSize = 50, numworkers = 4, seed = 0,
+                  perturbation = None, model = 'window', dosePercents = (95, 2), volumeDoses = (10, 30, 50, 70)):
+    global robustPlan
+    directory = resultsDirectory(outputDirectory)
+    info = loadRunInfo(directory, runName)
+    parameters = info['parameters']
+    t_out = loadRunArray(directory, runName, 't_out', mmap = False)
+    mask = loadRunArray(directory, runName, 'mask', mmap = False)
+    apertures = loadRunArray(directory, runName, 'apertures', mmap = False)
+    case = loadCase(caseDirectory(outputDirectory), parameters['caseKey'])
+    numProjections = t_out.shape[0]
+    D = doseMatrixFromTriplets(case['bixels'], case['smallvoxels'], case['Dijs'], parameters['L'],
+                               parameters['totalsmallvoxels'], numProjections, parameters['k10'])
+    names = ['mean', 'min', 'max'] + ['D' + str(x) for x in dosePercents] + ['V' + str(d) for d in volumeDoses]
+    robustPlan = {'D': D, 'yBar': parameters['yBar'], 'apertures': apertures, 'L': parameters['L'], 'mask': mask,
+                  'numProjections': numProjections, 't51': parameters['t51'], 'model': model, 'names': names,
+                  'perturbation': dict(PERTURBATION, **(perturbation or dict())), 'dosePercents': dosePercents,
+                  'volumeDoses': volumeDoses,
+                  'structures': dvhStructures(parameters['TARGETList'], parameters['OARList'], mask)}
+    sizes = [min(batchSize, samples - b) for b in range(0, samples, batchSize)]
+    jobs = list(zip(np.random.SeedSequence(seed).spawn(len(sizes)), sizes))
+    pool = forkedPool(numworkers)
+    if pool is None:
+        results = [sampleBatch(job) for job in jobs]
+    else:
+        results = list(pool.map(sampleBatch, jobs))
+        pool.shutdown()
+    nominalFluence = deliveredFluence(apertures, numProjections, parameters['L'], parameters['t51'], model)
+    nominal = doseMetrics([(sampleDoses(nominalFluence[:, None, :])[:, 0], mask)], robustPlan['structures'],
+                          dosePercents, volumeDoses)
+    structureNames = {index: name for index, name in parameters['structures']}
+    rows = []
+    for s, index in enumerate(robustPlan['structures']):
+        for name in names:
+            values = np.concatenate([result[name][:, s] for result in results])
+            rows.append({'runName': runName, 'structure': int(index),
+                         'structureName': structureNames.get(int(index), ''), 'metric': name,
+                         'nominal': nominal[name][0, s], 'mean': values.mean(), 'sd': values.std(),
+                         'p5': np.percentile(values, 5), 'p95': np.percentile(values, 95)})
+    robustPlan = dict()
+    writeTable(outputDirectory + 'robustness-' + runName + '.csv', rows)
+    print('Robustness of', runName, 'evaluated over', samples, 'samples (seed', str(seed) + ')')
+    return(rows)
+
+# Evaluate stored runs: python robustness.py outputDirectory runName [runName ...]
+if __name__ == '__main__':
+    for runName in sys.argv[2:]:
+        robustnessRun(sys.argv[1], runName)
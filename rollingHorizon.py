@@ -0,0 +1,239 @@
+# Rolling-horizon decomposition of the LOT models over windows of projections. Each window is a small GUROBI model of
+# the projections inside it, with every other projection fixed at the incumbent plan. Windows overlap so that the LOT
+# constraints are stitched across their boundaries, and windows that are not neighbours are solved concurrently.
+import numpy as np
+from gurobipy import *
+from concurrent.futures import ThreadPoolExecutor
+from doseOperator import doseFromFluence, voxelPenalty, beamletUpperBounds
+
+## Windows of windowSize projections, windowOverlap of them shared with the next window, covering every real
+# projection. In the pair model the windows start on even projections so that no pair is cut.
+def rollingWindows(numProjections, k10, windowSize, windowOverlap, pairSolution):
+    step = max(1, windowSize - windowOverlap)
+    start = k10
+    if pairSolution:
+        windowSize += windowSize % 2
+        step += step % 2
+        start -= start % 2
+    windows = []
+    a = start
+    while True:
+        b = min(a + windowSize, numProjections)
+        windows.append((a, b))
+        if b >= numProjections:
+            break
+        a += step
+    return(windows)
+
+## Group the windows into batches that can be solved at the same time. Two windows in a batch leave at least one
+# projection in between, so that the boundary projections of each one stay fixed while the other one changes.
+def independentBatches(windows):
+    batches = []
+    for w in windows:
+        for batch in batches:
+            if all(w[0] > o[1] or o[0] > w[1] for o in batch):
+                batch.append(w)
+                break
+        else:
+            batches.append([w])
+    return(batches)
+
+## Arrays (numProjections x L) of the incumbent plan. Starts from a solveModel dictionary when given, else all closed
+def initialPlan(numProjections, L, pairSolution, d = None):
+    keys = ['t', 'beta'] + (['gamma'] if pairSolution else ['elittle', 'mlittle', 'blittle'])
+    dictKeys = {'t': 't_out', 'beta': 'beta_output', 'gamma': 'gamma_out', 'elittle': 'elittle_out',
+                'mlittle': 'mlittle_out', 'blittle': 'blittle_out'}
+    plan = dict()
+    for key in keys:
+        if d is None:
+            plan[key] = np.zeros((numProjections, L))
+        else:
+            plan[key] = np.array(d[dictKeys[key]], dtype=float)
+    return(plan)
+
+## Objective of solveModel for a whole plan
+def planObjective(data, D, plan):
+    return(voxelPenalty(doseFromFluence(D, plan['t'], data.yBar), data)[0])
+
+## Total opening time and number of opening events counted by the Average_LOT_c constraint
+def planLOT(plan, k10, pairSolution):
+    events = plan['gamma'] if pairSolution else plan['elittle']
+    return(plan['t'][k10:, :].sum(), np.round(events[k10:, :]).sum())
+
+## Solve the model restricted to the projections a <= p < b. Everything else stays at the incumbent plan. Returns the
+# new plan and its objective, or None if GUROBI did not find a solution.
+def solveWindow(data, D, window, plan, ub, k10, t51, timeM, timeA, pairSolution, threads, timeLimit):
+    a, b = window
+    numProjections, L = plan['t'].shape
+    leaves = range(L)
+    windowProjections = range(a, b)
+    # Dose delivered by the fixed projections, and the columns of the window
+    tOutside = plan['t'].copy()
+    tOutside[a:b, :] = 0.0
+    zFixed = doseFromFluence(D, tOutside, data.yBar)
+    cols = (np.arange(a, b)[:, None] * L + np.arange(L)[None, :]).ravel()
+    Dw = D[:, cols].tocsr()
+    Dw.eliminate_zeros()
+    touched = np.where(np.diff(Dw.indptr) > 0)[0]
+    env = Env()
+    m = Model("rollingWindow", env = env)
+    m.params.OutputFlag = 0
+    m.params.Threads = threads
+    m.params.TimeLimit = timeLimit
+    m.params.MIPGap = 0.01
+    t = m.addVars(leaves, windowProjections, lb = 0.0, ub = t51, vtype = GRB.CONTINUOUS, name = "t")
+    beta = m.addVars(leaves, windowProjections, vtype = GRB.BINARY, name = "beta")
+    if pairSolution:
+        gamma = m.addVars(leaves, [p for p in windowProjections if 0 == p % 2 and p + 1 < numProjections],
+                          vtype = GRB.BINARY, name = "gamma")
+    else:
+        elittle = m.addVars(leaves, windowProjections, vtype = GRB.BINARY, name = "elittle")
+        mlittle = m.addVars(leaves, windowProjections, vtype = GRB.BINARY, name = "mlittle")
+        blittle = m.addVars(leaves, windowProjections, vtype = GRB.BINARY, name = "blittle")
+    z_plus = m.addVars(touched, lb = 0.0, vtype = GRB.CONTINUOUS, name = "z_plus")
+    z_minus = m.addVars(touched, lb = 0.0, vtype = GRB.CONTINUOUS, name = "z_minus")
+    m.update()
+    for l in leaves:
+        for p in windowProjections:
+            t[l, p].UB = ub[p, l]
+            t[l, p].Start = plan['t'][p, l]
+            beta[l, p].Start = plan['beta'][p, l]
+            if p < k10:
+                beta[l, p].UB = 0.0
+            if pairSolution:
+                if (l, p) in gamma:
+                    gamma[l, p].Start = plan['gamma'][p, l]
+            else:
+                elittle[l, p].Start = plan['elittle'][p, l]
+                mlittle[l, p].Start = plan['mlittle'][p, l]
+                blittle[l, p].Start = plan['blittle'][p, l]
+
+    # Variable inside the window or fixed value outside of it
+    def val(variables, key, l, p):
+        if a <= p < b:
+            return(variables[l, p])
+        return(float(plan[key][p, l]))
+
+    for v in touched:
+        expr = LinExpr(float(zFixed[v] - data.quadHelperThresh[v]))
+        for k in range(Dw.indptr[v], Dw.indptr[v + 1]):
+            j = Dw.indices[k]
+            expr.add(t[j % L, a + j // L], float(data.yBar * Dw.data[k]))
+        m.addConstr(z_plus[v] - z_minus[v] == expr, name = "positive_only[" + str(v) + "]")
+    myObj = QuadExpr(0.0)
+    for v in touched:
+        myObj.add(data.quadHelperUnder[v] * z_minus[v] * z_minus[v] + data.quadHelperOver[v] * z_plus[v] * z_plus[v])
+    m.addConstrs((t[l, p] <= t51 * beta[l, p] for l in leaves for p in windowProjections), "time_per_projection_b")
+    allts = LinExpr(0.0)
+    allns = LinExpr(0.0)
+    if pairSolution:
+        for (l, p) in gamma.keys():
+            m.addConstr(gamma[l, p] <= beta[l, p] + beta[l, p + 1], "gamma_1")
+            m.addConstr(beta[l, p] + beta[l, p + 1] <= 2 * gamma[l, p], "gamma_2")
+            m.addConstr(t[l, p] + t[l, p + 1] >= timeM * gamma[l, p], "minimum_lot")
+            if p >= k10:
+                allns.add(gamma[l, p])
+        events = plan['gamma']
+    else:
+        m.addConstrs((t51 * mlittle[l, p] <= t[l, p] for l in leaves for p in windowProjections), "time_per_projection_a")
+        m.addConstrs((elittle[l, p] + mlittle[l, p] + blittle[l, p] == beta[l, p] for l in leaves for p in windowProjections),
+                     "three_options")
+        # Constraints between consecutive projections, including the ones that cross the boundaries of the window
+        for l in leaves:
+            for p in range(max(a - 1, 0), min(b, numProjections - 1)):
+                eNow = val(elittle, 'elittle', l, p)
+                mNow = val(mlittle, 'mlittle', l, p)
+                tNow = val(t, 't', l, p)
+                tNext = val(t, 't', l, p + 1)
+                m.addConstr(val(mlittle, 'mlittle', l, p + 1) <= mNow + eNow, "m_follows_m_or_e")
+                m.addConstr(val(blittle, 'blittle', l, p + 1) <= mNow + eNow, "b_follows_m_or_e")
+                m.addConstr(tNow + tNext >= timeM * (eNow + val(blittle, 'blittle', l, p + 1) - 1), "minimum_lot_eb")
+                m.addConstr(tNow >= timeM * (eNow + val(elittle, 'elittle', l, p + 1) - val(beta, 'beta', l, p + 1)),
+                            "minimum_lot_e")
+            for p in windowProjections:
+                if p >= k10:
+                    allns.add(elittle[l, p])
+        events = plan['elittle']
+    for l in leaves:
+        for p in windowProjections:
+            if p >= k10:
+                allts.add(t[l, p])
+    # Average_LOT_c with the contribution of the fixed projections
+    fixedT = tOutside[k10:, :].sum()
+    fixedEvents = events.copy()
+    fixedEvents[a:b, :] = 0.0
+    fixedN = np.round(fixedEvents[k10:, :]).sum()
+    m.addConstr(float(fixedT) + allts >= timeA * (float(fixedN) + allns), "Average_LOT_c")
+    m.setObjective(myObj, GRB.MINIMIZE)
+    m.optimize()
+    if 0 == m.SolCount:
+        m.dispose()
+        env.dispose()
+        return(None)
+    newPlan = {key: value.copy() for key, value in plan.items()}
+    for l in leaves:
+        for p in windowProjections:
+            newPlan['t'][p, l] = t[l, p].X
+            newPlan['beta'][p, l] = round(beta[l, p].X)
+            if pairSolution:
+                if (l, p) in gamma:
+                    newPlan['gamma'][p, l] = round(gamma[l, p].X)
+            else:
+                newPlan['elittle'][p, l] = round(elittle[l, p].X)
+                newPlan['mlittle'][p, l] = round(mlittle[l, p].X)
+                newPlan['blittle'][p, l] = round(blittle[l, p].X)
+    m.dispose()
+    env.dispose()
+    return(planObjective(data, D, newPlan), newPlan)
+
+## Rolling-horizon solver. Sweeps the windows in passes, solving the batches of independent windows concurrently on
+# numcores cores. Stops when a whole pass improves the objective by less than tolerance (relative) or after maxPasses.
+# Returns the same dictionary as solveModel.
+def solveRollingHorizon(data, D, numProjections, k10, t51, timeM, timeA, pairSolution, numcores, windowSize = 20,
+                        windowOverlap = 4, tolerance = 0.005, maxPasses = 10, windowTimeLimit = 600, initial = None):
+    ub = beamletUpperBounds(data, numProjections, k10, t51)
+    plan = initialPlan(numProjections, data.L, pairSolution, initial)
+    objVal = planObjective(data, D, plan)
+    batches = independentBatches(rollingWindows(numProjections, k10, windowSize, windowOverlap, pairSolution))
+    print('Rolling horizon with', sum(len(batch) for batch in batches), 'windows in', len(batches), 'batches')
+    for passNumber in range(maxPasses):
+        passStart = objVal
+        for batch in batches:
+            workers = min(len(batch), numcores)
+            threads = max(1, numcores // workers)
+            with ThreadPoolExecutor(max_workers = workers) as executor:
+                results = list(executor.map(lambda w: solveWindow(data, D, w, plan, ub, k10, t51, timeM, timeA,
+                                                                   pairSolution, threads, windowTimeLimit), batch))
+            solved = [(w, r) for w, r in zip(batch, results) if r is not None]
+            if 0 == len(solved):
+                continue
+            # Merge every window of the batch. Each one kept the Average LOT with the others at the incumbent values,
+            # so the merged plan is checked, and if it does not help only the best window is kept.
+            merged = {key: value.copy() for key, value in plan.items()}
+            for (a, b), (_, windowPlan) in solved:
+                for key in merged.keys():
+                    merged[key][a:b, :] = windowPlan[key][a:b, :]
+            mergedT, mergedN = planLOT(merged, k10, pairSolution)
+            mergedObj = planObjective(data, D, merged)
+            bestObj, bestPlan = min((r for _, r in solved), key = lambda r: r[0])
+            if mergedT >= timeA * mergedN - 1e-6 and mergedObj <= bestObj and mergedObj < objVal:
+                objVal, plan = mergedObj, merged
+            elif bestObj < objVal:
+                objVal, plan = bestObj, bestPlan
+        improvement = (passStart - objVal) / max(abs(passStart), 1e-10)
+        print('Rolling horizon pass', passNumber, 'objective:', objVal, 'relative improvement:', improvement)
+        if improvement < tolerance:
+            break
+    z_output = doseFromFluence(D, plan['t'], data.yBar)
+    diff = z_output - data.quadHelperThresh
+    T, N = planLOT(plan, k10, pairSolution)
+    d = {"t_out": plan['t'], "z_output": z_output, "z_plus_out": np.maximum(diff, 0.0),
+         "z_minus_out": np.maximum(-diff, 0.0), "beta_output": plan['beta'], "slackAvgLOT": T - timeA * N,
+         "gurobisT": T, "gurobisN": N, "objVal": objVal}
+    if pairSolution:
+        d["gamma_out"] = plan['gamma']
+    else:
+        d["elittle_out"] = plan['elittle']
+        d["mlittle_out"] = plan['mlittle']
+        d["blittle_out"] = plan['blittle']
+    return(d)
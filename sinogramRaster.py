@@ -0,0 +1,63 @@
+# Raster sinograms. The apertures (the structured arrays of apertures.py) are rasterized into a leaf x time bin image,
+# where every pixel holds the fraction of the bin during which the leaf is open, and drawn with a single imshow. This
+# is much faster than a line per aperture on plans with thousands of apertures.
+import numpy as np
+import matplotlib.pyplot as plt
+
+## Rasterize the apertures into an (L, numBins) image over [0, duration]. Every pixel is the fraction of its bin during
+# which the leaf is open. duration defaults to the end of the last aperture.
+def rasterizeApertures(apertures, L, numBins = 2048, duration = None):
+    if duration is None:
+        duration = apertures['end'].max() if len(apertures) > 0 else 1.0
+    binWidth = duration / float(numBins)
+    leaves = apertures['leaf'].astype(np.intp)
+    first = np.clip(apertures['begin'] / binWidth, 0.0, numBins)
+    last = np.clip(apertures['end'] / binWidth, 0.0, numBins)
+    i0 = np.minimum(np.floor(first).astype(np.intp), numBins - 1)
+    i1 = np.minimum(np.floor(last).astype(np.intp), numBins - 1)
+    image = np.zeros((L, numBins + 1))
+    inside = i0 == i1
+    np.add.at(image, (leaves[inside], i0[inside]), last[inside] - first[inside])
+    # Apertures over several bins: partial first and last bins, and a difference array for the bins in between
+    span = ~inside
+    np.add.at(image, (leaves[span], i0[span]), i0[span] + 1 - first[span])
+    np.add.at(image, (leaves[span], i1[span]), last[span] - i1[span])
+    between = np.zeros((L, numBins + 1))
+    np.add.at(between, (leaves[span], i0[span] + 1), 1.0)
+    np.add.at(between, (leaves[span], i1[span]), -1.0)
+    image += np.cumsum(between, axis=1)
+    return(image[:, :numBins], duration)
+
+## Draw the image of one plan and save it in path
+def plotSinogramRaster(apertures, L, path, title = 'Sinogram', numBins = 2048, duration = None, cmap = 'Reds'):
+    image, duration = rasterizeApertures(apertures, L, numBins, duration)
+    fig, ax = plt.subplots()
+    ax.imshow(image, aspect='auto', origin='lower', interpolation='nearest', cmap=cmap, vmin=0.0, vmax=1.0,
+              extent=[0.0, duration, -0.5, L - 0.5])
+    ax.set_title(title)
+    ax.set_xlabel('time in seconds')
+    ax.set_ylabel('leaves')
+    fig.savefig(path)
+    plt.close(fig)
+
+## Draw two plans in the same image: the first one in red, the second one in blue and the overlap in purple
+def plotSinogramRasterComparison(apertures1, apertures2, L, path, title = 'Sinogram Comparison', numBins = 2048,
+                                 duration = None):
+    if duration is None:
+        duration = max([a['end'].max() for a in [apertures1, apertures2] if len(a) > 0] + [1.0])
+    first, _ = rasterizeApertures(apertures1, L, numBins, duration)
+    second, _ = rasterizeApertures(apertures2, L, numBins, duration)
+    first = np.clip(first, 0.0, 1.0)
+    second = np.clip(second, 0.0, 1.0)
+    both = np.minimum(first, second)
+    weights = [1.0 - np.maximum(first, second), first - both, second - both, both]
+    colors = [(1.0, 1.0, 1.0), (1.0, 0.0, 0.0), (0.0, 0.0, 1.0), (0.5, 0.0, 0.5)]
+    rgb = sum(w[:, :, None] * np.array(c)[None, None, :] for w, c in zip(weights, colors))
+    fig, ax = plt.subplots()
+    ax.imshow(np.clip(rgb, 0.0, 1.0), aspect='auto', origin='lower', interpolation='nearest',
+              extent=[0.0, duration, -0.5, L - 0.5])
+    ax.set_title(title)
+    ax.set_xlabel('time in seconds')
+    ax.set_ylabel('leaves')
+    fig.savefig(path)
+    plt.close(fig)
@@ -0,0 +1,122 @@
+# Distances between the sinograms of every pair of runs of an output directory: the total time during which exactly
+# one of the two plans has a leaf open (disagreement) and the Jaccard index of the open times of every leaf. The pairs
+# are compared with intervalSweep in forked worker processes. The aperture arrays of the runs that only have a
+# pickleresults file are cached as .npy files, and the matrix is cached in sinogramSimilarity.npz together with the
+# modification time of the file of every run, so that adding a run only compares it with the others.
+import os
+import pickle
+import numpy as np
+import matplotlib.pyplot as plt
+from resultStore import resultsDirectory, loadRunArray, aperturesFromIntervals
+from resultsCatalog import resultsCatalog
+from intervalSweep import sweepIntervals, overlapMetrics
+from leafDecomposition import forkedPool
+
+SIMILARITYFILE = 'sinogramSimilarity.npz'
+APERTURECACHE = 'sinogramCache/'
+# Aperture arrays of the runs being compared. Set before the pool is forked, so that the workers inherit them
+workerApertures = []
+
+## Path of the file the apertures of a run come from: its apertures.npy in the results store, or its pickleresults file
+def aperturesSource(outputDirectory, entry):
+    if 'store' in entry['files']:
+        return(resultsDirectory(outputDirectory) + entry['chunkName'] + '/apertures.npy')
+    return(entry['files']['pickleresults'])
+
+## Apertures of a run. Those of the pickleresults files are converted once and cached
+def runApertures(outputDirectory, entry):
+    if 'store' in entry['files']:
+        return(loadRunArray(resultsDirectory(outputDirectory), entry['chunkName'], 'apertures', mmap = False))
+    cached = outputDirectory + APERTURECACHE + entry['chunkName'] + '.npy'
+    if os.path.exists(cached) and os.path.getmtime(cached) >= os.path.getmtime(entry['files']['pickleresults']):
+        return(np.load(cached))
+    with open(entry['files']['pickleresults'], 'rb') as f:
+        apertures = aperturesFromIntervals(pickle.load(f)['t'])
+    os.makedirs(outputDirectory + APERTURECACHE, exist_ok = True)
+    np.save(cached, apertures)
+    return(apertures)
+
+## Disagreement time and per leaf Jaccard index of two aperture arrays
+def sinogramDistance(apertures1, apertures2, L):
+    overlap = overlapMetrics(sweepIntervals([apertures1, apertures2]), L)
+    return(overlap['unionTime'].sum() - overlap['sharedTime'].sum(), overlap['jaccard'])
+
+## Distances of a batch of pairs (i, j) of workerApertures
+def pairBatch(job):
+    pairs, L = job
+    return([sinogramDistance(workerApertures[i], workerApertures[j], L) for i, j in pairs])
+
+## Previous matrix of the output directory, if any
+def readSimilarity(outputDirectory):
+    path = outputDirectory + SIMILARITYFILE
+    if not os.path.exists(path):
+        return(None)
+    with np.load(path) as cached:
+        return({name: cached[name] for name in cached.files})
+
+## Distance matrices of the runs of outputDirectory that match query (the parameters of resultsCatalog.query) and have
+# apertures. Returns a dictionary with the runNames, the (N, N) disagreement time, the (N, N, L) per leaf Jaccard index
+# and its (N, N) mean over the leaves that open in either plan. Only the pairs with a new or changed run are compared.
+def similarityMatrix(outputDirectory = 'outputMultiProj/', numworkers = 4, L = 64, **query):
+    global workerApertures
+    catalog = resultsCatalog(outputDirectory)
+    entries = [entry for entry in catalog.query(**query)
+               if 'store' in entry['files'] or 'pickleresults' in entry['files']]
+    catalog.shutdown()
+    runNames = np.array([entry['chunkName'] for entry in entries], dtype=str)
+    signatures = np.array([os.path.getmtime(aperturesSource(outputDirectory, entry)) for entry in entries])
+    N = len(entries)
+    disagreement = np.zeros((N, N))
+    jaccard = np.full((N, N, L), np.nan)
+    known = np.zeros(N, dtype=bool)
+    cached = readSimilarity(outputDirectory)
+    if cached is not None and cached['jaccard'].shape[2] == L:
+        previous = {name: i for i, name in enumerate(cached['runNames'])}
+        old = np.array([previous.get(name, -1) for name in runNames], dtype=int)
+        known = old >= 0
+        known[known] = cached['signatures'][old[known]] == signatures[known]
+        index = np.nonzero(known)[0]
+        disagreement[np.ix_(index, index)] = cached['disagreement'][np.ix_(old[index], old[index])]
+        jaccard[np.ix_(index, index)] = cached['jaccard'][np.ix_(old[index], old[index])]
+    pairs = [(i, j) for i in range(N) for j in range(i + 1, N) if not (known[i] and known[j])]
+    workerApertures = [runApertures(outputDirectory, entry) for entry in entries]
+    for i in range(N):
+        jaccard[i, i] = overlapMetrics(sweepIntervals([workerApertures[i]]), L)['jaccard']
+    batches = [list(batch) for batch in np.array_split(np.array(pairs, dtype=int).reshape(-1, 2),
+                                                       max(1, min(len(pairs), 4 * numworkers))) if len(batch) > 0]
+    jobs = [([tuple(pair) for pair in batch], L) for batch in batches]
+    pool = forkedPool(numworkers)
+    if pool is None:
+        results = [pairBatch(job) for job in jobs]
+    else:
+        results = list(pool.map(pairBatch, jobs))
+        pool.shutdown()
+    for (batch, _), batchResults in zip(jobs, results):
+        for (i, j), (distance, leafJaccard) in zip(batch, batchResults):
+            disagreement[i, j] = disagreement[j, i] = distance
+            jaccard[i, j] = jaccard[j, i] = leafJaccard
+    workerApertures = []
+    opened = np.sum(~np.isnan(jaccard), axis=2)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        meanJaccard = np.where(opened > 0, np.nansum(jaccard, axis=2) / opened, np.nan)
+    result = {'runNames': runNames, 'signatures': signatures, 'disagreement': disagreement, 'jaccard': jaccard,
+              'meanJaccard': meanJaccard}
+    np.savez(outputDirectory + SIMILARITYFILE, **result)
+    print('Sinogram distances of', N, 'runs:', len(pairs), 'pairs compared and', N * (N - 1) // 2 - len(pairs),
+          'taken from the cache')
+    return(result)
+
+## Heat map of the disagreement times of the matrix
+def plotSimilarityMatrix(result, path):
+    N = len(result['runNames'])
+    fig, ax = plt.subplots(figsize = (4 + 0.3 * N, 3 + 0.3 * N))
+    image = ax.imshow(result['disagreement'], cmap = 'viridis', interpolation = 'nearest')
+    fig.colorbar(image, ax = ax, label = 'disagreement time in seconds')
+    ax.set_xticks(range(N))
+    ax.set_yticks(range(N))
+    ax.set_xticklabels(result['runNames'], rotation = 90, fontsize = 6)
+    ax.set_yticklabels(result['runNames'], fontsize = 6)
+    ax.set_title('Sinogram disagreement between runs')
+    fig.tight_layout()
+    fig.savefig(path)
+    plt.close(fig)
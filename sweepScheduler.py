@@ -0,0 +1,187 @@
+# Scheduler of parameter sweeps of OrganizedmultiTool.py on Linux. A grid of sites, projections, models, timeM, timeA
+# and maxvoxels is expanded into a graph of jobs: the MIP runs need the hints of their relaxed run, and with warm starts
+# also the small (2000 voxel) run, so those are scheduled first instead of being spawned by solveModel. The jobs run as
+# separate processes, numworkers at a time, each with its share of the cores as GUROBI Threads. A job that finished
+# leaves a marker in outputDirectory/sweepJobs/ and is skipped by the next sweep, and so is a job whose outputs exist
+# (written by a run outside the scheduler): its Feasible file, or its row in the run index and, for a relaxed run, the
+# hints file of that row. With shareCases a case server
+# (caseServer.py) preprocesses each case once and the jobs attach to its shared memory instead of reading the case.
+#    python sweepScheduler.py [numworkers] [shareCases]
+import os
+import sys
+import time
+import subprocess
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from caseServer import READYMESSAGE
+from resultStore import resultsDirectory, readRunIndex
+
+JOBFOLDER = 'sweepJobs/'
+WARMSTARTVOXELS = 2000
+# Models: (imrt, imrtwith20msecondsconstraint, pairSolution, treatmentName)
+MODELS = {'IMRT': (1, 0, 0, 'IMRT'), 'IMRT20': (1, 1, 0, 'IMRT20msec'), 'pairModel': (0, 0, 1, 'pairModel'),
+          'fullModel': (0, 0, 0, 'fullModel')}
+# Intensity (yBar) of the runs, part of the name of their Feasible file
+INTENSITY = 700
+# Default sweep of the command line
+SWEEP = {'sites': ['Prostate'], 'projections': [51], 'models': ['pairModel', 'fullModel'], 'timeMs': [0.02, 0.03],
+         'timeAs': [0.077, 0.17], 'maxvoxels': [9000], 'warmStart': True}
+
+## Name of a job. Its marker and its log are named after it
+def jobName(site, projections, model, relaxed, timeM, timeA, maxvoxels, warmStart):
+    return(site + '-' + str(projections) + '-' + model + ('relaxedVersion' if relaxed else '') + '-MinLOT-' + str(timeM) +
+           '-minAvgLot-' + str(timeA) + '-vxls-' + str(maxvoxels) + ('-warmStart' if warmStart else ''))
+
+## Add the job of a run, and the jobs it depends on, to jobs (a dictionary by name). Returns its name
+def addJob(jobs, site, projections, model, relaxed, timeM, timeA, maxvoxels, warmStart):
+    imrt, imrt20, pair, treatmentName = MODELS[model]
+    if imrt:
+        relaxed, warmStart = False, False
+    # The small run is its own warm start
+    if relaxed or WARMSTARTVOXELS == maxvoxels:
+        warmStart = False
+    name = jobName(site, projections, model, relaxed, timeM, timeA, maxvoxels, warmStart)
+    if name in jobs:
+        return(name)
+    dependencies = []
+    if not imrt and not relaxed:
+        # solveModel reads the hints of the relaxed run of the same size and the warm start of the small run
+        dependencies.append(addJob(jobs, site, projections, model, True, timeM, timeA, maxvoxels, False))
+        if warmStart:
+            dependencies.append(addJob(jobs, site, projections, model, False, timeM, timeA, WARMSTARTVOXELS, False))
+    arguments = [timeM, timeA, imrt, imrt20, pair, int(relaxed), projections, int(warmStart), maxvoxels]
+    jobs[name] = {'name': name, 'arguments': [str(a) for a in arguments], 'site': site, 'dependencies': dependencies,
+                  'case': (site, projections, maxvoxels), 'imrt': imrt, 'relaxed': relaxed,
+                  'treatmentName': treatmentName + ('relaxedVersion' if relaxed else ''), 'timeM': timeM, 'timeA': timeA}
+    return(name)
+
+## Jobs of every combination of the grid
+def expandGrid(sites, projections, models, timeMs, timeAs, maxvoxels, warmStart = True):
+    jobs = dict()
+    for site in sites:
+        for p in projections:
+            for model in models:
+                for timeM in timeMs:
+                    for timeA in timeAs:
+                        for voxels in maxvoxels:
+                            addJob(jobs, site, p, model, False, timeM, timeA, voxels, warmStart)
+    return(jobs)
+
+def markerPath(outputDirectory, name):
+    return(outputDirectory + JOBFOLDER + name + '.done')
+
+## Whether the outputs of a job exist. The LOT runs write Feasible<feasibleName>.pkl, whose name only depends on the
+# arguments. The chunkName of the other runs depends on the voxels of the case, so they are looked up in the run index
+# (index is readRunIndex of the results store): the run must be in the store and a relaxed run must have its hints file
+def outputsExist(job, outputDirectory, index):
+    site, projections, maxvoxels = job['case']
+    if not job['imrt'] and not job['relaxed']:
+        feasibleName = (site + '-' + str(projections) + job['treatmentName'] + '-MinLOT-' + str(job['timeM']) +
+                        '-minAvgLot-' + str(job['timeA']) + '-vxls-' + str(maxvoxels) + '-ntnsty-' + str(INTENSITY))
+        return(os.path.exists(outputDirectory + 'Feasible' + feasibleName + '.pkl'))
+    rows = np.nonzero((index['tumorsite'] == site) & (index['initialProjections'] == projections) &
+                      (index['treatmentName'] == job['treatmentName']) & (index['maxvoxels'] == maxvoxels) &
+                      np.isclose(index['timeM'], job['timeM']) & np.isclose(index['timeA'], job['timeA']))[0]
+    for runName in index['runName'][rows]:
+        if not os.path.exists(resultsDirectory(outputDirectory) + runName + '/run.json'):
+            continue
+        if not job['relaxed'] or os.path.exists(outputDirectory + 'hints' + runName + '.pkl'):
+            return(True)
+    return(False)
+
+## Start the case server of a (site, projections, maxvoxels) case and wait until its case is published. Returns the
+# process, or None if it stopped before
+def startServer(case, outputDirectory, script, workingDirectory):
+    site, projections, maxvoxels = case
+    name = 'caseServer-' + site + '-' + str(projections) + '-vxls-' + str(maxvoxels)
+    # Only the case settings matter to the server: the model arguments are placeholders
+    command = [sys.executable, script, '0.02', '0.077', '0', '0', '1', '0', str(projections), '0', str(maxvoxels), '1',
+               site, 'serve']
+    path = outputDirectory + JOBFOLDER + name + '.log'
+    with open(path, 'w') as log:
+        server = subprocess.Popen(command, stdout = log, stderr = subprocess.STDOUT, cwd = workingDirectory)
+    while server.poll() is None:
+        with open(path, 'r') as log:
+            if READYMESSAGE in log.read():
+                print('Case server of', name, 'ready')
+                return(server)
+        time.sleep(1.0)
+    print('The case server', name, 'failed. See', path)
+    return(None)
+
+## Stop the case servers, which removes their shared memory
+def stopServers(servers):
+    for server in servers:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+## Run one job in its own process and leave its marker if it succeeds. Returns its exit code
+def runJob(job, threads, outputDirectory, script, workingDirectory, shareCases = False):
+    command = [sys.executable, script] + job['arguments'] + [str(threads), job['site']]
+    if shareCases:
+        command.append('attach')
+    with open(outputDirectory + JOBFOLDER + job['name'] + '.log', 'w') as log:
+        code = subprocess.call(command, stdout = log, stderr = subprocess.STDOUT, cwd = workingDirectory)
+    if 0 == code:
+        with open(markerPath(outputDirectory, job['name']), 'w') as marker:
+            marker.write(' '.join(command) + '\n')
+    return(code)
+
+## Run the jobs in dependency order, numworkers at a time with totalCores // numworkers GUROBI threads each. Jobs with a
+# marker or with their outputs are skipped, and the jobs that depend on a failed job are not run. With shareCases a case server is started for
+# every case of the jobs to run and stopped at the end. Returns the names of the finished, skipped and failed jobs
+def runSweep(jobs, numworkers = 4, totalCores = None, outputDirectory = 'outputMultiProj/',
+             script = 'OrganizedmultiTool.py', workingDirectory = '.', dryRun = False, shareCases = False):
+    if totalCores is None:
+        totalCores = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+    threads = max(1, totalCores // numworkers)
+    os.makedirs(outputDirectory + JOBFOLDER, exist_ok = True)
+    index = readRunIndex(resultsDirectory(outputDirectory))
+    status = {name: 'done' if os.path.exists(markerPath(outputDirectory, name)) or
+              outputsExist(job, outputDirectory, index) else 'waiting' for name, job in jobs.items()}
+    skipped = [name for name in jobs if 'done' == status[name]]
+    finished = []
+    failed = []
+    servers = []
+    if shareCases and not dryRun:
+        # The jobs of a case whose server failed read the case themselves
+        cases = sorted(set(job['case'] for name, job in jobs.items() if 'waiting' == status[name]))
+        servers = [startServer(case, outputDirectory, script, workingDirectory) for case in cases]
+    executor = ThreadPoolExecutor(max_workers = numworkers)
+    running = dict()
+    while True:
+        for name, job in jobs.items():
+            if 'waiting' != status[name]:
+                continue
+            states = [status[dependency] for dependency in job['dependencies']]
+            if any(state in ['failed', 'blocked'] for state in states):
+                status[name] = 'blocked'
+                failed.append(name)
+            elif all('done' == state for state in states):
+                status[name] = 'running'
+                print('Starting', name, 'with', threads, 'threads')
+                if dryRun:
+                    running[executor.submit(lambda: 0)] = name
+                else:
+                    running[executor.submit(runJob, job, threads, outputDirectory, script, workingDirectory,
+                                            shareCases)] = name
+        if 0 == len(running):
+            break
+        completed, _ = wait(running, return_when = FIRST_COMPLETED)
+        for future in completed:
+            name = running.pop(future)
+            if 0 == future.result():
+                status[name] = 'done'
+                finished.append(name)
+            else:
+                status[name] = 'failed'
+                failed.append(name)
+                print('Job', name, 'failed. See', outputDirectory + JOBFOLDER + name + '.log')
+    executor.shutdown()
+    stopServers(servers)
+    print('Sweep:', len(finished), 'jobs run,', len(skipped), 'skipped and', len(failed), 'failed or blocked')
+    return(finished, skipped, failed)
+
+if __name__ == '__main__':
+    runSweep(expandGrid(**SWEEP), *[int(a) for a in sys.argv[1:2]], shareCases = sys.argv[2:3] == ['1'])